@@ -1,17 +1,137 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, g, session, Response, stream_with_context, jsonify
+from flask import has_request_context, before_render_template, template_rendered, send_from_directory
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 import sqlite3
 import bcrypt
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 import re
+import sys
+import queue
+import json
+import base64
+import os
+import time
+import pickle
+import hashlib
+import functools
+import threading
+import uuid
+import atexit
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from itertools import groupby, islice
+from contextlib import contextmanager
+import click
+import urllib.request
+import csv
+import io
+import gzip
+import mimetypes
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from werkzeug.utils import safe_join
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+try:
+    import psycopg2
+    import psycopg2.errors
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:  # Potrzebne tylko przy STORAGE_BACKEND = 'postgresql'
+    psycopg2 = None
+try:
+    import brotli
+except ImportError:  # Bez modułu brotli odpowiedzi są kompresowane tylko gzipem
+    brotli = None
 
 app = Flask(__name__)
 app.secret_key = 'secret-key'  # Zmień na bezpieczniejszy
+app.config.from_mapping(
+    STORAGE_BACKEND='sqlite',  # 'sqlite' (plik DATABASE) albo 'postgresql' (POSTGRES_DSN)
+    DATABASE='database/library.db',
+    POSTGRES_DSN='dbname=libraryhub',
+    POSTGRES_REPORTING_DSN=None,  # Replika dla raportów administratora (domyślnie POSTGRES_DSN)
+    POSTGRES_POOL_SIZE=10,    # Maksymalna liczba połączeń PostgreSQL na proces
+    DB_POOL_SIZE=8,       # Maksymalna liczba bezczynnych połączeń trzymanych w puli
+    DB_BUSY_TIMEOUT=5000,  # ms oczekiwania na blokadę zapisu zamiast natychmiastowego błędu
+    DB_SYNCHRONOUS='NORMAL',  # W trybie WAL NORMAL jest bezpieczny i oszczędza fsync przy każdym commit
+    DB_CACHE_SIZE_KB=20000,   # Rozmiar pamięci podręcznej stron na połączenie
+    DB_MMAP_SIZE=268435456,   # 256 MB odczytów przez mmap zamiast read()
+    CATALOG_SEARCH_LIMIT=200,  # Maksymalna liczba wyników wyszukiwania
+    CATALOG_PAGE_SIZE=50,      # Domyślna liczba książek na stronie katalogu
+    CATALOG_MAX_PAGE_SIZE=500,  # Górna granica parametru ?limit=
+    POPULARITY_WINDOW_DAYS=31,  # Ile dni dziennych liczników trzymamy dla rankingów tygodnia/miesiąca
+    CACHE_BACKEND='memory',   # 'memory' (jeden proces) albo 'file' (wspólny katalog dla wielu workerów)
+    CACHE_DIR='database/cache',
+    CACHE_DEFAULT_TTL=60,     # Sekundy; wpisy są też unieważniane przy każdej zmianie danych
+    CACHE_MAX_ENTRIES=1024,   # Limit LRU dla backendu 'memory'
+    CACHE_SWEEP_INTERVAL=60,  # Co ile sekund backend 'file' usuwa przeterminowane pliki (stare generacje)
+    FINE_ACCRUAL_BATCH_SIZE=100000,  # Wypożyczeń na transakcję; małe partie wielokrotnie zapisują te same strony indeksu
+    FINE_ACCRUAL_INTERVAL=0,  # Co ile sekund naliczać kary w tle przy `python app.py` (0 - wyłączone)
+    HOLD_EXPIRY_INTERVAL=900,  # Co ile sekund wygaszać nieodebrane rezerwacje przy `python app.py` (0 - wyłączone)
+    HOLD_EXPIRY_BATCH_SIZE=1000,  # Rezerwacji na transakcję przy wygaszaniu
+    BCRYPT_ROUNDS=12,         # Koszt bcrypt; po zmianie hasła są przeliczane przy następnym logowaniu
+    PASSWORD_HASH_WORKERS=2,  # Procesy liczące bcrypt poza wątkami żądań (0 - w wątku żądania)
+    PASSWORD_HASH_MAX_PENDING=8,  # Ile operacji na hasłach naraz; kolejne żądania dostają 503
+    PASSWORD_HASH_TIMEOUT=10,  # Sekundy oczekiwania na wynik z puli
+    USER_CACHE_TTL=300,       # Sekundy; load_user czyta użytkownika z pamięci podręcznej zamiast z bazy
+    SESSION_USER_TTL=0,       # Sekundy zaufania do danych użytkownika w podpisanej sesji (0 - wyłączone)
+    IMPORT_BATCH_SIZE=50000,  # Książek na transakcję przy imporcie z pliku
+    IMPORT_MAX_REJECTS_SHOWN=100,  # Ile odrzuconych wierszy pokazać na stronie importu
+    PROFILE_PAGE_SIZE=50,     # Zwróconych wypożyczeń na stronie historii w profilu
+    SLOW_REQUEST_MS=0,        # Logowanie żądań wolniejszych niż tyle ms (0 - wyłączone)
+    METRICS_TOKEN=None,       # Token (Authorization: Bearer) dla /metrics; bez niego tylko sesja administratora
+    METRICS_ALLOW_LOCALHOST=False,  # /metrics bez logowania z 127.0.0.1 - nie za lokalnym reverse proxy
+    EVENTS_MAX_CLIENTS=200,   # Otwartych strumieni /events na proces (każdy zajmuje wątek serwera)
+    EVENTS_KEEPALIVE=25,      # Sekundy między komentarzami podtrzymującymi połączenie SSE
+    EVENTS_RETRY_MS=10000,    # Po ilu ms przeglądarka ponawia zerwane połączenie
+    # Kanał zdarzeń /events: 'process' - tylko zmiany z bieżącego procesu (jeden worker),
+    # 'database' - tabela live_events czytana co EVENTS_POLL_INTERVAL s przez każdy proces
+    # (kilka workerów lub serwerów), None - 'database' przy PostgreSQL lub CACHE_BACKEND = 'file'
+    EVENTS_CHANNEL=None,
+    EVENTS_POLL_INTERVAL=1.0,
+    # Raporty administratora (popularne, użytkownicy, kary): 'primary' - zwykłe połączenie,
+    # 'readonly' - osobna pula połączeń tylko do odczytu (dane bieżące),
+    # 'snapshot' - kopia bazy odświeżana co REPORTING_SNAPSHOT_INTERVAL sekund (dane mogą być opóźnione)
+    REPORTING_DB_MODE='readonly',
+    REPORTING_SNAPSHOT_PATH='database/reporting.db',
+    REPORTING_SNAPSHOT_INTERVAL=300,
+    COMPRESS_MIN_SIZE=1024,   # Bajtów; mniejsze odpowiedzi HTML/JSON idą bez kompresji
+    COMPRESS_LEVEL=6,         # Poziom gzip dla odpowiedzi dynamicznych (1-9)
+    BROTLI_QUALITY=5,         # Jakość brotli dla odpowiedzi dynamicznych (0-11), jeśli moduł jest zainstalowany
+    STATIC_IMMUTABLE_MAX_AGE=31536000,  # Sekundy pamięci podręcznej plików statycznych z ?v=<skrót>
+    VENDOR_ASSETS_FROM_CDN=False,  # Bootstrap i FontAwesome z CDN zamiast static/vendor (strony wymagają internetu)
+    JINJA_BYTECODE_CACHE_DIR='database/jinja_cache',  # Skompilowane szablony wspólne dla workerów (None - wyłączone)
+    FRAGMENT_CACHE_MAX_ENTRIES=20000,  # Wyrenderowanych wierszy katalogu w pamięci procesu (LRU)
+    # Dziennik wypożyczeń (circulation_events): 'sync' - w tej samej transakcji co zmiana,
+    # 'batched' - po zatwierdzeniu do kolejki zapisywanej partiami w tle, None - wyłączony.
+    # Uwaga: 'batched' traci zdarzenia jeszcze niezapisane przy awarii lub zabiciu procesu
+    # (zwykle ostatnie CIRCULATION_LOG_FLUSH_INTERVAL s, a przy niedostępnej bazie całą
+    # kolejkę) - replay-circulation nie odtworzy wtedy tych zmian
+    CIRCULATION_LOG_MODE='sync',
+    CIRCULATION_LOG_FLUSH_INTERVAL=1.0,  # Sekundy między zapisami partii
+    CIRCULATION_LOG_BATCH_SIZE=500,      # Tyle zdarzeń w kolejce wymusza zapis przed upływem interwału
+    CIRCULATION_LOG_MAX_PENDING=100000,  # Limit kolejki, gdy baza jest niedostępna (nadmiar jest pomijany)
+)
+app.config.from_envvar('LIBRARYHUB_SETTINGS', silent=True)
+if app.config['JINJA_BYTECODE_CACHE_DIR']:
+    # Nowy worker wczytuje skompilowane szablony zamiast parsować je od nowa;
+    # Jinja porównuje sumę kontrolną źródła, więc zmieniony szablon kompiluje się ponownie
+    try:
+        os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE_DIR'])
+    except OSError:
+        app.logger.warning('Brak katalogu %s - szablony bez pamięci podręcznej kodu',
+                           app.config['JINJA_BYTECODE_CACHE_DIR'])
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
 # Stałe konfiguracyjne
 MAX_BORROWS_PER_USER = 3  # Maksymalna liczba wypożyczeń na użytkownika
+MAX_RESERVATIONS_PER_USER = 5  # Maksymalna liczba aktywnych rezerwacji na użytkownika
+HOLD_DAYS = 3  # Dni na odbiór egzemplarza odłożonego dla rezerwacji
+FINE_PER_DAY = 0.60  # Kara w PLN za każdy dzień spóźnienia
+LOAN_DAYS = 30  # Okres wypożyczenia
+DAY = 86400  # Sekund w dniu - daty w bazie to liczby sekund epoki Unix
 
 # Klasa użytkownika
 class User(UserMixin):
@@ -23,6 +143,990 @@ class User(UserMixin):
     def get_id(self):
         return str(self.id)
 
+# Metryki wydajności (format tekstowy Prometheus)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRIC_TYPES = {
+    'libraryhub_requests_total': ('counter', 'Liczba żądań według endpointu, metody i statusu'),
+    'libraryhub_request_duration_seconds': ('histogram', 'Czas obsługi żądania'),
+    'libraryhub_sql_statements_total': ('counter', 'Liczba instrukcji SQL wykonanych w żądaniach'),
+    'libraryhub_sql_duration_seconds_total': ('counter', 'Łączny czas wykonywania instrukcji SQL w żądaniach'),
+    'libraryhub_template_render_seconds': ('histogram', 'Czas renderowania szablonu'),
+    'libraryhub_errors_total': ('counter', 'Wyjątki według endpointu i typu (handled="true" - przechwycone w widoku)'),
+    'libraryhub_cache_hits_total': ('counter', 'Trafienia pamięci podręcznej'),
+    'libraryhub_cache_misses_total': ('counter', 'Chybienia pamięci podręcznej'),
+    'libraryhub_response_bytes_total': ('counter', 'Bajty wysłanych odpowiedzi HTML/JSON wg kodowania'),
+    'libraryhub_circulation_events_total': ('counter', 'Zdarzenia zapisane w dzienniku wypożyczeń'),
+    'libraryhub_circulation_events_dropped_total': ('counter', 'Zdarzenia pominięte przy pełnej kolejce dziennika'),
+}
+
+class Metrics:
+    """Liczniki i histogramy bieżącego procesu (każdy worker ma własne)"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self, extra_counters=()):
+        """Tekst w formacie ekspozycji Prometheus 0.0.4"""
+        with self._lock:
+            counters = list(self._counters.items()) + list(extra_counters)
+            histograms = [(key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items()]
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                kind, help_text = METRIC_TYPES[name]
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), value in sorted(counters):
+            describe(name)
+            lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        for (name, labels), (buckets, total, count) in sorted(histograms):
+            describe(name)
+            for bound, bucket_count in zip(self.buckets, buckets):
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', repr(bound)),)), bucket_count))
+            lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(total)))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels)
+    return '{%s}' % ','.join(escaped)
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+metrics = Metrics()
+
+def record_sql(elapsed):
+    """Wywoływane przez InstrumentedCursor - sumuje instrukcje SQL bieżącego żądania"""
+    if has_request_context() and 'sql_count' in g:
+        g.sql_count += 1
+        g.sql_time += elapsed
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Kursor mierzący czas execute* (pobieranie wierszy nie jest wliczane)"""
+
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            record_sql(time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            record_sql(time.perf_counter() - start)
+
+    def executescript(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executescript(*args)
+        finally:
+            record_sql(time.perf_counter() - start)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Połączenie, którego kursory (także z conn.execute) są mierzone"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+def report_error():
+    """Dla bloków `except Exception`, które zwracają stronę zastępczą: log i licznik błędów"""
+    exc = sys.exc_info()[1]
+    endpoint = request.endpoint if has_request_context() else None
+    app.logger.exception('Błąd obsłużony w %s', endpoint)
+    metrics.inc('libraryhub_errors_total', {'endpoint': endpoint or 'none',
+                                            'type': type(exc).__name__, 'handled': 'true'})
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'none'
+    metrics.inc('libraryhub_requests_total', {'endpoint': endpoint, 'method': request.method,
+                                              'status': str(response.status_code)})
+    metrics.observe('libraryhub_request_duration_seconds', {'endpoint': endpoint}, elapsed)
+    metrics.inc('libraryhub_sql_statements_total', {'endpoint': endpoint}, g.sql_count)
+    metrics.inc('libraryhub_sql_duration_seconds_total', {'endpoint': endpoint}, g.sql_time)
+    slow_ms = app.config['SLOW_REQUEST_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        app.logger.warning('Wolne żądanie %s %s: %.1f ms, SQL: %d instrukcji, %.1f ms',
+                           request.method, request.full_path, elapsed * 1000, g.sql_count, g.sql_time * 1000)
+    return response
+
+@app.teardown_request
+def record_request_error(exc):
+    if exc is not None:
+        metrics.inc('libraryhub_errors_total', {'endpoint': request.endpoint or 'none',
+                                                'type': type(exc).__name__, 'handled': 'false'})
+
+@before_render_template.connect_via(app)
+def _template_render_started(sender, template, context, **extra):
+    g.setdefault('template_starts', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _template_render_finished(sender, template, context, **extra):
+    starts = g.get('template_starts')
+    if starts:
+        metrics.observe('libraryhub_template_render_seconds', {'template': template.name or 'string'},
+                        time.perf_counter() - starts.pop())
+
+# Pliki statyczne i kompresja odpowiedzi
+# Biblioteki z CDN kopiowane do static/ (flask --app app vendor-assets) - oddziały bez
+# dostępu do internetu dostają je z serwera aplikacji. Brak plików zatrzymuje start i build-assets;
+# CDN jest używany tylko po jawnym VENDOR_ASSETS_FROM_CDN = True
+BOOTSTRAP_CDN = 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/'
+FONTAWESOME_CDN = 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/'
+VENDOR_ASSETS = {
+    'vendor/bootstrap/css/bootstrap.min.css': BOOTSTRAP_CDN + 'css/bootstrap.min.css',
+    'vendor/bootstrap/js/bootstrap.bundle.min.js': BOOTSTRAP_CDN + 'js/bootstrap.bundle.min.js',
+    'vendor/fontawesome/css/all.min.css': FONTAWESOME_CDN + 'css/all.min.css',
+}
+# all.min.css wczytuje czcionki ze ścieżki względnej ../webfonts/
+VENDOR_ASSETS.update(('vendor/fontawesome/webfonts/' + name, FONTAWESOME_CDN + 'webfonts/' + name)
+                     for name in ('fa-brands-400.woff2', 'fa-brands-400.ttf', 'fa-regular-400.woff2',
+                                  'fa-regular-400.ttf', 'fa-solid-900.woff2', 'fa-solid-900.ttf',
+                                  'fa-v4compatibility.woff2', 'fa-v4compatibility.ttf'))
+ASSET_MANIFEST = 'assets.json'
+PRECOMPRESSED_TYPES = ('.css', '.js', '.svg', '.json', '.txt', '.ttf', '.map')
+CONTENT_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESS_MIMETYPES = ('text/html', 'application/json', 'text/csv', 'text/plain', 'text/css', 'text/javascript')
+_asset_versions = {}
+_asset_manifest = None
+
+def _load_asset_manifest():
+    global _asset_manifest
+    if _asset_manifest is None:
+        try:
+            with open(os.path.join(app.static_folder, ASSET_MANIFEST), encoding='utf-8') as f:
+                _asset_manifest = json.load(f)
+        except (OSError, ValueError):
+            _asset_manifest = {}
+    return _asset_manifest
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+def asset_version(filename):
+    """Skrót treści pliku z static/ (z manifestu build-assets, a bez niego liczony
+    i odświeżany po zmianie mtime); None, gdy pliku nie ma"""
+    version = _load_asset_manifest().get(filename)
+    if version:
+        return version
+    try:
+        path = safe_join(app.static_folder, filename)
+        mtime = os.stat(path).st_mtime_ns if path else None
+    except OSError:
+        mtime = None
+    if mtime is None:
+        return None
+    cached = _asset_versions.get(filename)
+    if cached is None or cached[0] != mtime:
+        cached = _asset_versions[filename] = (mtime, _file_digest(path))
+    return cached[1]
+
+@app.url_defaults
+def add_asset_version(endpoint, values):
+    # url_for('static', ...) dostaje ?v=<skrót>, więc nowa treść to nowy adres
+    if endpoint == 'static' and 'v' not in values:
+        version = asset_version(values.get('filename', ''))
+        if version:
+            values['v'] = version
+
+@app.template_global()
+def asset_url(filename):
+    """Adres pliku z static/; biblioteka z VENDOR_ASSETS idzie z CDN tylko przy VENDOR_ASSETS_FROM_CDN"""
+    if filename in VENDOR_ASSETS and app.config['VENDOR_ASSETS_FROM_CDN']:
+        return VENDOR_ASSETS[filename]
+    return url_for('static', filename=filename)
+
+def missing_vendor_assets():
+    return sorted(filename for filename in VENDOR_ASSETS
+                  if not os.path.isfile(os.path.join(app.static_folder, *filename.split('/'))))
+
+def check_vendor_assets():
+    """Przy starcie i build-assets: strony bez Bootstrapa i FontAwesome są nieużywalne,
+    więc brak plików w static/vendor jest błędem, a nie cichym przejściem na CDN"""
+    if app.config['VENDOR_ASSETS_FROM_CDN']:
+        return
+    missing = missing_vendor_assets()
+    if missing:
+        raise RuntimeError('Brak plików w static/: %s - uruchom flask --app app vendor-assets '
+                           '(albo ustaw VENDOR_ASSETS_FROM_CDN = True)' % ', '.join(missing))
+
+def accepted_encoding(available=('br', 'gzip')):
+    for encoding in available:
+        if encoding == 'br' and brotli is None:
+            continue
+        if request.accept_encodings.quality(encoding) > 0:
+            return encoding
+    return None
+
+def static_file(filename):
+    """Pliki statyczne: gotowy wariant .br/.gz, jeśli klient go przyjmuje, a dla
+    adresu z aktualnym ?v= - pamięć podręczna na rok bez ponownej walidacji"""
+    response = None
+    if os.path.splitext(filename)[1] in PRECOMPRESSED_TYPES:
+        for encoding, suffix in CONTENT_ENCODINGS:
+            path = safe_join(app.static_folder, filename + suffix)
+            if path and os.path.isfile(path) and accepted_encoding((encoding,)):
+                response = send_from_directory(app.static_folder, filename + suffix,
+                                               mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = app.send_static_file(filename)
+        response.vary.add('Accept-Encoding')
+    else:
+        response = app.send_static_file(filename)
+    version = request.args.get('v')
+    if version and version == asset_version(filename):
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['STATIC_IMMUTABLE_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+app.view_functions['static'] = static_file
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli dla HTML, JSON i CSV od COMPRESS_MIN_SIZE bajtów; strumienie
+    (/events, eksport) i pliki idą bez zmian"""
+    if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES or not 200 <= response.status_code < 300):
+        return response
+    data = response.get_data()
+    encoding = accepted_encoding() if len(data) >= app.config['COMPRESS_MIN_SIZE'] else None
+    response.vary.add('Accept-Encoding')
+    if encoding == 'br':
+        data = brotli.compress(data, quality=app.config['BROTLI_QUALITY'])
+    elif encoding == 'gzip':
+        data = gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL'])
+    if encoding:
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        # Silny ETag opisuje bajty odpowiedzi; skompresowane są inne, a treść ta sama
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+    metrics.inc('libraryhub_response_bytes_total', {'encoding': encoding or 'identity'}, len(data))
+    return response
+
+def build_assets(folder):
+    """Manifest skrótów i warianty .gz/.br plików z folder (zostają tylko mniejsze
+    od oryginału); zwraca manifest"""
+    manifest = {}
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, folder).replace(os.sep, '/')
+            if filename == ASSET_MANIFEST or name.endswith(('.gz', '.br')):
+                continue
+            manifest[filename] = _file_digest(path)
+            if os.path.splitext(name)[1] not in PRECOMPRESSED_TYPES:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                variants['.br'] = brotli.compress(data, quality=11)
+            for suffix, compressed in variants.items():
+                if len(compressed) < len(data):
+                    with open(path + suffix, 'wb') as f:
+                        f.write(compressed)
+                elif os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    with open(os.path.join(folder, ASSET_MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+@app.cli.command('vendor-assets')
+@click.option('--force', is_flag=True, help='Pobierz ponownie pliki, które już są')
+def vendor_assets_command(force):
+    """Pobiera Bootstrap i FontAwesome z CDN do static/vendor (na maszynie z internetem)"""
+    for filename, source in sorted(VENDOR_ASSETS.items()):
+        path = os.path.join(app.static_folder, *filename.split('/'))
+        if os.path.exists(path) and not force:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(source, timeout=30) as remote:
+            data = remote.read()
+        with open(path, 'wb') as f:
+            f.write(data)
+        click.echo('%s (%d B)' % (filename, len(data)))
+    click.echo('Gotowe - teraz flask --app app build-assets')
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Skróty i warianty .gz/.br plików statycznych - uruchamiane przy wdrożeniu"""
+    global _asset_manifest
+    try:
+        check_vendor_assets()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    start = time.perf_counter()
+    manifest = build_assets(app.static_folder)
+    _asset_manifest = None
+    _asset_versions.clear()
+    click.echo('Plików: %d, manifest w %s (%.2f s)' % (len(manifest), ASSET_MANIFEST, time.perf_counter() - start))
+
+# Połączenia z bazą danych
+_db_pool = queue.LifoQueue()
+_report_pool = queue.LifoQueue()
+
+def _apply_pragmas(conn):
+    conn.execute('PRAGMA busy_timeout = %d' % int(app.config['DB_BUSY_TIMEOUT']))
+    conn.execute('PRAGMA cache_size = -%d' % int(app.config['DB_CACHE_SIZE_KB']))
+    conn.execute('PRAGMA mmap_size = %d' % int(app.config['DB_MMAP_SIZE']))
+    conn.execute('PRAGMA temp_store = MEMORY')
+
+def connect_db():
+    """Otwiera nowe połączenie z bazą i ustawia pragmy (raz na połączenie)"""
+    conn = sqlite3.connect(app.config['DATABASE'], check_same_thread=False, factory=InstrumentedConnection)
+    _apply_pragmas(conn)
+    conn.execute('PRAGMA synchronous = %s' % app.config['DB_SYNCHRONOUS'])
+    return conn
+
+def connect_readonly(path):
+    """Połączenie tylko do odczytu (mode=ro i query_only) - nie może wziąć blokady zapisu"""
+    uri = 'file:%s?mode=ro' % urllib.request.pathname2url(os.path.abspath(path))
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=InstrumentedConnection)
+    _apply_pragmas(conn)
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+def _acquire_connection(pool, key, opener):
+    """Pobiera połączenie z puli albo otwiera nowe; połączenia z innym kluczem
+    (inna ścieżka bazy, podmieniona kopia) są zamykane"""
+    while True:
+        try:
+            conn_key, conn = pool.get_nowait()
+        except queue.Empty:
+            return opener()
+        if conn_key == key:
+            return conn
+        conn.close()
+
+def _release_connection(conn, pool, key):
+    """Oddaje połączenie do puli (lub zamyka je, gdy pula jest pełna)"""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        if pool.qsize() < app.config['DB_POOL_SIZE']:
+            pool.put_nowait((key, conn))
+            return
+    except sqlite3.Error:
+        pass
+    conn.close()
+
+def get_db():
+    """Zwraca połączenie przypisane do bieżącego kontekstu aplikacji"""
+    if 'db' not in g:
+        g.db = _acquire_connection(_db_pool, app.config['DATABASE'], connect_db)
+    return g.db
+
+_snapshot_lock = threading.Lock()
+
+def refresh_report_snapshot():
+    """Kopiuje bazę przez backup API do pliku tymczasowego i atomowo podmienia kopię raportową.
+    Backup czyta w jednej transakcji odczytu - w trybie WAL nie blokuje zapisów."""
+    path = app.config['REPORTING_SNAPSHOT_PATH']
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with _snapshot_lock:
+        source = sqlite3.connect(app.config['DATABASE'])
+        target = sqlite3.connect(tmp)
+        try:
+            source.backup(target)
+            # Kopia jest tylko czytana - bez WAL nie potrzebuje plików -wal/-shm
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            source.close()
+        os.replace(tmp, path)
+
+def _report_key():
+    if app.config['REPORTING_DB_MODE'] == 'snapshot':
+        path = app.config['REPORTING_SNAPSHOT_PATH']
+        if not os.path.exists(path):
+            refresh_report_snapshot()
+        stat = os.stat(path)
+        # Nowy i-węzeł po os.replace - połączenia do starej kopii nie wracają do użycia
+        return ('snapshot', path, stat.st_ino, stat.st_mtime_ns)
+    return ('readonly', app.config['DATABASE'])
+
+def get_report_db():
+    """Połączenie dla ciężkich odczytów administracyjnych (REPORTING_DB_MODE)"""
+    if app.config['REPORTING_DB_MODE'] == 'primary':
+        return get_db()
+    if 'report_db' not in g:
+        key = _report_key()
+        g.report_db = (key, _acquire_connection(_report_pool, key, lambda: connect_readonly(key[1])))
+    return g.report_db[1]
+
+@contextmanager
+def write_transaction(conn):
+    """Transakcja BEGIN IMMEDIATE - blokada zapisu od pierwszej instrukcji, więc
+    odczyty wewnątrz transakcji nie mogą się zdezaktualizować przed zapisem"""
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        yield c
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+@app.teardown_appcontext
+def close_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        _release_connection(conn, _db_pool, app.config['DATABASE'])
+    report = g.pop('report_db', None)
+    if report is not None:
+        _release_connection(report[1], _report_pool, report[0])
+    for pool, pg_conn in g.pop('pg_conns', ()):
+        pool.putconn(pg_conn)
+
+# Pamięć podręczna dla stron czytanych częściej niż zmienianych
+class MemoryCacheBackend:
+    """LRU z TTL w pamięci bieżącego procesu"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class FileCacheBackend:
+    """Wpisy jako pliki w katalogu - wspólne dla wielu procesów na jednej maszynie.
+
+    Wpisów starych generacji (po Cache.invalidate) nikt już nie czyta, więc co
+    sweep_interval sekund set() usuwa pliki, których termin minął.
+    """
+
+    def __init__(self, directory, sweep_interval=60):
+        self.directory = directory
+        self.sweep_interval = sweep_interval
+        self._next_sweep = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _expired(expires_at, now):
+        # Inny nagłówek niż termin (np. plik w starym formacie) też jest do usunięcia
+        return not isinstance(expires_at, (int, float, type(None))) or \
+            (expires_at is not None and expires_at < now)
+
+    def get(self, key, default=None):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expired = self._expired(pickle.load(f), time.time())
+                if not expired:
+                    return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return default
+        self.delete(key)
+        return default
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        path = self._path(key)
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            # Termin osobno przed wartością - sweep() nie wczytuje całych stron
+            pickle.dump(expires_at, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        # os.replace jest atomowe - inny proces nie zobaczy połowy pliku
+        os.replace(tmp_path, path)
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.sweep()
+
+    def sweep(self):
+        """Usuwa przeterminowane wpisy i porzucone pliki tymczasowe; liczba usuniętych"""
+        now = time.time()
+        removed = 0
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith('.tmp'):
+                    expired = entry.stat().st_mtime < now - 60  # porzucony zapis
+                else:
+                    with open(entry.path, 'rb') as f:
+                        expired = self._expired(pickle.load(f), now)
+                if expired:
+                    os.remove(entry.path)
+                    removed += 1
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+        return removed
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(os.listdir(self.directory))
+
+_MISSING = object()
+
+class Cache:
+    """TTL + unieważnianie całych przestrzeni nazw + liczniki trafień.
+
+    Unieważnienie zmienia "generację" przestrzeni nazw zapisaną w backendzie,
+    więc działa także między procesami korzystającymi z FileCacheBackend.
+    """
+
+    def __init__(self, backend, default_ttl=60):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+    def _generation(self, namespace):
+        key = 'generation:' + namespace
+        generation = self.backend.get(key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.backend.set(key, generation)
+        return generation
+
+    def _count(self, counters, namespace):
+        with self._lock:
+            counters[namespace] = counters.get(namespace, 0) + 1
+
+    def get_or_set(self, namespace, key, factory, ttl=None):
+        """Zwraca wartość z pamięci podręcznej albo wylicza ją przez factory()"""
+        full_key = '%s:%s:%s' % (namespace, self._generation(namespace), key)
+        value = self.backend.get(full_key, _MISSING)
+        if value is not _MISSING:
+            self._count(self.hits, namespace)
+            return value
+        self._count(self.misses, namespace)
+        value = factory()
+        self.backend.set(full_key, value, ttl or self.default_ttl)
+        return value
+
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            self.backend.set('generation:' + namespace, uuid.uuid4().hex)
+
+    def stats(self):
+        with self._lock:
+            namespaces = sorted(set(self.hits) | set(self.misses))
+            return {
+                'backend': type(self.backend).__name__,
+                'entries': len(self.backend),
+                'namespaces': {ns: {'hits': self.hits.get(ns, 0), 'misses': self.misses.get(ns, 0)}
+                               for ns in namespaces},
+            }
+
+_cache = None
+
+def get_cache():
+    """Tworzy (przy pierwszym użyciu) pamięć podręczną według konfiguracji"""
+    global _cache
+    if _cache is None:
+        if app.config['CACHE_BACKEND'] == 'file':
+            backend = FileCacheBackend(app.config['CACHE_DIR'], app.config['CACHE_SWEEP_INTERVAL'])
+        else:
+            backend = MemoryCacheBackend(app.config['CACHE_MAX_ENTRIES'])
+        _cache = Cache(backend, app.config['CACHE_DEFAULT_TTL'])
+    return _cache
+
+def invalidate_cache(*namespaces):
+    """Wywoływane po zatwierdzeniu zmian, które wpływają na zapamiętane strony"""
+    get_cache().invalidate(*namespaces)
+
+# Haszowanie haseł w puli procesów
+class PasswordHasherBusy(Exception):
+    """Wszystkie miejsca na operacje na hasłach są zajęte albo pula nie odpowiedziała w czasie"""
+
+def _hash_password_worker(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check_password_worker(password, hashed):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+def password_needs_rehash(hashed, rounds):
+    """Czy hash ('$2b$12$...') ma inny koszt niż skonfigurowany"""
+    try:
+        return int(hashed.split('$')[2]) != rounds
+    except (IndexError, ValueError):
+        return True
+
+class PasswordHasher:
+    """bcrypt poza wątkiem żądania: pula procesów omija GIL, a limit oczekujących
+    operacji sprawia, że fala logowań nie zajmie wszystkich wątków serwera"""
+
+    def __init__(self, rounds, workers, max_pending, timeout):
+        self.rounds = rounds
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        if workers:
+            self._executor = ProcessPoolExecutor(workers)
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        if self._executor is None:
+            try:
+                return func(*args)
+            finally:
+                self._slots.release()
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # Miejsce zwalnia dopiero zakończone zadanie - po przekroczeniu czasu bcrypt
+        # nadal zajmuje pulę, więc nie może go zastąpić kolejne zlecenie
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        return self._run(_hash_password_worker, password, self.rounds)
+
+    def check(self, password, hashed):
+        return self._run(_check_password_worker, password, hashed)
+
+    def needs_rehash(self, hashed):
+        return password_needs_rehash(hashed, self.rounds)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+_password_hasher = None
+
+def get_password_hasher():
+    """Tworzy (przy pierwszym użyciu) pulę haszowania według konfiguracji"""
+    global _password_hasher
+    if _password_hasher is None:
+        _password_hasher = PasswordHasher(app.config['BCRYPT_ROUNDS'], app.config['PASSWORD_HASH_WORKERS'],
+                                          app.config['PASSWORD_HASH_MAX_PENDING'],
+                                          app.config['PASSWORD_HASH_TIMEOUT'])
+    return _password_hasher
+
+BUSY_MESSAGE = 'Serwer jest przeciążony, spróbuj ponownie za chwilę'
+
+# Zdarzenia na żywo (Server-Sent Events) dla otwartych stron katalogu i profilu
+class EventBroker:
+    """Rozsyła zdarzenia do strumieni /events bieżącego procesu (EVENTS_CHANNEL = 'process' -
+    zmian z innych workerów nie widzi). Ostatnie zdarzenia publiczne są pamiętane dla wznowień
+    z nagłówkiem Last-Event-ID."""
+
+    def __init__(self, backlog=256, queue_size=1000):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._recent = deque(maxlen=backlog)
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return bool(self._subscribers)
+
+    @property
+    def last_id(self):
+        return self._next_id - 1
+
+    def publish(self, event, data, user_id=None, storage=None):
+        """user_id=None - do wszystkich, inaczej tylko do strumieni tego użytkownika"""
+        with self._lock:
+            message = (self._next_id, event, data, user_id)
+            self._next_id += 1
+            subscribers = self._recipients(message)
+        self._send(subscribers, message)
+
+    def _recipients(self, message):
+        """Pod self._lock: zapamiętuje zdarzenie publiczne i wybiera strumienie, które je dostaną"""
+        if message[3] is None:
+            self._recent.append(message)
+        return [q for q, owner in self._subscribers.items() if message[3] is None or owner == message[3]]
+
+    @staticmethod
+    def _send(subscribers, message):
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(message)
+            except queue.Full:
+                pass  # Klient nie odbiera - po ponownym połączeniu przeładuje stronę
+
+    def subscribe(self, user_id=None, last_event_id=None, max_clients=None):
+        """Kolejka zdarzeń dla nowego strumienia albo None, gdy osiągnięto limit klientów"""
+        subscription = queue.Queue(self.queue_size)
+        with self._lock:
+            if max_clients is not None and len(self._subscribers) >= max_clients:
+                return None
+            if last_event_id is not None:
+                for message in self._recent:
+                    if message[0] > last_event_id:
+                        subscription.put_nowait(message)
+            self._subscribers[subscription] = user_id
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.pop(subscription, None)
+
+class DatabaseEventBroker(EventBroker):
+    """Zdarzenia /events przez tabelę live_events (EVENTS_CHANNEL = 'database') - strumień
+    dostaje zmiany ze wszystkich workerów i serwerów. publish dopisuje wiersz, a wątek procesu
+    (działa, dopóki są strumienie) co poll_interval s czyta nowe wiersze po id i rozsyła je.
+    Id zdarzeń są wspólne, więc wznowienie z Last-Event-ID działa też na innym workerze."""
+
+    def __init__(self, poll_interval, queue_size=1000):
+        super().__init__(queue_size=queue_size)
+        self.poll_interval = poll_interval
+        self._last_seen = 0
+        self._thread = None
+
+    @property
+    def active(self):
+        # Strumieni innych procesów nie widać - zdarzenie zapisujemy zawsze
+        return True
+
+    @property
+    def last_id(self):
+        return self._last_seen
+
+    def publish(self, event, data, user_id=None, storage=None):
+        # Żądanie podaje swój magazyn - drugie połączenie z puli przy pełnej puli czekałoby bez końca
+        if storage is not None:
+            storage.append_live_event(event, json.dumps(data, ensure_ascii=False), user_id)
+            return
+        with open_storage() as storage:
+            storage.append_live_event(event, json.dumps(data, ensure_ascii=False), user_id)
+
+    def subscribe(self, user_id=None, last_event_id=None, max_clients=None):
+        subscription = queue.Queue(self.queue_size)
+        with self._lock:
+            if max_clients is not None and len(self._subscribers) >= max_clients:
+                return None
+            if self._thread is None:
+                # Nowy wątek zaczyna od końca tabeli - wcześniejsze zmiany są już na stronie
+                with open_storage() as storage:
+                    self._last_seen = storage.last_live_event_id()
+                self._thread = threading.Thread(target=self._run, name='live-events', daemon=True)
+                self._thread.start()
+            if last_event_id is not None and last_event_id < self._last_seen:
+                with open_storage() as storage:
+                    rows = storage.live_events(last_event_id, self._last_seen, self.queue_size)
+                for row in rows:
+                    if row[3] is None or row[3] == user_id:
+                        subscription.put_nowait((row[0], row[1], json.loads(row[2]), row[3]))
+            self._subscribers[subscription] = user_id
+        return subscription
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            try:
+                with open_storage() as storage:
+                    rows = storage.live_events(self._last_seen)
+            except Exception:
+                app.logger.exception('Błąd odczytu live_events')
+                continue
+            for event_id, event, data, user_id in rows:
+                message = (event_id, event, json.loads(data), user_id)
+                with self._lock:
+                    self._last_seen = event_id
+                    subscribers = self._recipients(message)
+                self._send(subscribers, message)
+
+# Tyle ostatnich wierszy live_events zostaje dla wznowień z Last-Event-ID
+LIVE_EVENTS_KEPT = 1000
+
+_event_broker = None
+
+def events_channel():
+    channel = app.config['EVENTS_CHANNEL']
+    if channel is None:
+        multi_process = _using_postgres() or app.config['CACHE_BACKEND'] == 'file'
+        channel = 'database' if multi_process else 'process'
+    return channel
+
+def get_event_broker():
+    """Tworzy (przy pierwszym użyciu) broker zdarzeń według EVENTS_CHANNEL"""
+    global _event_broker
+    if _event_broker is None:
+        if events_channel() == 'database':
+            _event_broker = DatabaseEventBroker(app.config['EVENTS_POLL_INTERVAL'])
+        else:
+            _event_broker = EventBroker()
+    return _event_broker
+
+def loan_status(due_date, now):
+    """(pozostałe dni jak w PROFILE_SQL, moment kolejnej zmiany albo None)"""
+    days_left = max(0, int(due_date - now + DAY - 1) // DAY)
+    if days_left == 0:
+        return 0, None
+    return days_left, due_date - (days_left - 1) * DAY
+
+def format_event(event_id, event, data):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (event_id, event, json.dumps(data, ensure_ascii=False))
+
+def event_stream(subscription, loans, last_id):
+    """Generator strumienia SSE. loans: {id wypożyczenia: termin zwrotu} zalogowanego
+    użytkownika - zdarzenie `due` wysyłane jest tylko, gdy zmienia się liczba pozostałych dni.
+    Zdarzenia `due` niosą id ostatniego zdarzenia, żeby wznowienie niczego nie pominęło."""
+    schedule = {}
+
+    def due_events(borrow_ids, now):
+        for borrow_id in borrow_ids:
+            days_left, schedule[borrow_id] = loan_status(loans[borrow_id], now)
+            yield format_event(last_id, 'due', {'borrow_id': borrow_id, 'days_left': days_left,
+                                                'due': loans[borrow_id]})
+
+    try:
+        yield 'retry: %d\n\n' % app.config['EVENTS_RETRY_MS']
+        yield from due_events(list(loans), time.time())
+        while True:
+            now = time.time()
+            pending = [when for when in schedule.values() if when is not None]
+            timeout = min([app.config['EVENTS_KEEPALIVE']] + [max(0.0, when - now) for when in pending])
+            try:
+                last_id, event, data, _ = subscription.get(timeout=timeout)
+            except queue.Empty:
+                now = time.time()
+                changed = [borrow_id for borrow_id, when in schedule.items() if when is not None and when <= now]
+                if changed:
+                    yield from due_events(changed, now)
+                else:
+                    yield ': keepalive\n\n'
+                continue
+            if event == 'loans':
+                loans = dict(data['loans'])
+                schedule.clear()
+                yield format_event(last_id, event, {'active': len(loans)})
+                yield from due_events(list(loans), time.time())
+            else:
+                yield format_event(last_id, event, data)
+    finally:
+        get_event_broker().unsubscribe(subscription)
+
+def publish_availability(storage, *book_ids):
+    """Po zatwierdzeniu zmiany wysyła aktualną liczbę egzemplarzy do otwartych katalogów"""
+    broker = get_event_broker()
+    if not broker.active:
+        return
+    for book_id in book_ids:
+        book = storage.get_book(book_id)
+        if book:
+            broker.publish('availability', {'book_id': book[0], 'available': book[4]}, storage=storage)
+
+def publish_loans(storage, user_id):
+    """Aktywne wypożyczenia użytkownika (liczba i terminy) do jego otwartych stron"""
+    broker = get_event_broker()
+    if broker.active:
+        broker.publish('loans', {'loans': storage.active_loans(user_id)}, user_id=str(user_id),
+                       storage=storage)
+
 # Funkcje walidacji
 def validate_username(username):
     """Walidacja nazwy użytkownika"""
@@ -56,11 +1160,13 @@ def validate_book_data(title, author, available, isbn=None):
 
     # Walidacja ISBN
     if isbn:
-        isbn_clean = isbn.replace('-', '').replace(' ', '')
-        if not isbn_clean.isdigit() or len(isbn_clean) not in [10, 13]:
-            return False, "ISBN musi mieć 10 lub 13 cyfr"
-        if len(isbn_clean) == 13 and not isbn_clean.startswith('978'):
-            return False, "13-cyfrowy ISBN musi zaczynać się od 978"
+        isbn_clean = clean_isbn(isbn)
+        if not ISBN_PATTERN.fullmatch(isbn_clean):
+            return False, "ISBN musi mieć 10 lub 13 cyfr (ISBN-10 może kończyć się na X)"
+        if len(isbn_clean) == 13 and isbn_clean[:3] not in ('978', '979'):
+            return False, "13-cyfrowy ISBN musi zaczynać się od 978 lub 979"
+        if canonical_isbn(isbn_clean) is None:
+            return False, "Nieprawidłowa cyfra kontrolna ISBN"
 
     try:
         available_int = int(available)
@@ -73,65 +1179,376 @@ def validate_book_data(title, author, available, isbn=None):
 
     return True, ""
 
-def get_user_unpaid_fines_total(user_id):
-    """Pobiera sumę nieopłaconych kar użytkownika"""
-    try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-        c.execute('SELECT SUM(amount) FROM fines WHERE user_id = ? AND paid = 0', (user_id,))
-        total = c.fetchone()[0]
-        conn.close()
-        return total if total else 0
-    except Exception:
-        return 0
+def clean_isbn(isbn):
+    """Usuwa z ISBN myślniki i spacje"""
+    if not isbn:
+        return None
+    return isbn.replace('-', '').replace(' ', '').upper()
+
+# ISBN-10 (ostatni znak może być X) albo ISBN-13, po clean_isbn
+ISBN_PATTERN = re.compile(r'\d{9}[\dX]|\d{13}')
+
+def isbn13_check_digit(digits):
+    """Cyfra kontrolna dla 12 pierwszych cyfr ISBN-13 (wagi 1, 3, 1, 3...)"""
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits[:12]))
+    return str(-total % 10)
+
+def canonical_isbn(isbn):
+    """Klucz ISBN zapisywany w kolumnie books.isbn: ISBN-13 bez myślników (ISBN-10
+    przeliczony na 978...). None dla pustego numeru lub błędnej cyfry kontrolnej."""
+    isbn = clean_isbn(isbn)
+    if not isbn or not ISBN_PATTERN.fullmatch(isbn):
+        return None
+    if len(isbn) == 10:
+        total = sum((10 - i) * (10 if d == 'X' else int(d)) for i, d in enumerate(isbn))
+        if total % 11:
+            return None
+        isbn = '978' + isbn[:9]
+        return isbn + isbn13_check_digit(isbn)
+    if isbn[:3] not in ('978', '979') or isbn[12] != isbn13_check_digit(isbn):
+        return None
+    return isbn
+
+def build_fts_query(search):
+    """Zamienia frazę użytkownika na zapytanie FTS5 (wszystkie słowa, dopasowanie prefiksowe)"""
+    folded = search.replace('ł', 'l').replace('Ł', 'L')
+    # Każde słowo w cudzysłowie, aby znaki specjalne FTS5 (-, *, :) nie psuły zapytania
+    return ' '.join('"%s"*' % word for word in re.findall(r'\w+', folded))
+
+def search_books(c, search):
+    """Wyszukiwanie w katalogu: ISBN jednym odczytem indeksu books.isbn, tekst przez FTS5 (ranking bm25)"""
+    isbn = clean_isbn(search)
+    if ISBN_PATTERN.fullmatch(isbn):
+        # Numery z błędną cyfrą kontrolną (sprzed migracji 8) szukamy w postaci zapisanej
+        c.execute('SELECT * FROM books WHERE isbn = ?', (canonical_isbn(isbn) or isbn,))
+        books = c.fetchall()
+        if books:
+            return books
 
-def get_user_borrow_count(user_id):
-    """Pobiera liczbę aktywnych wypożyczeń użytkownika"""
+    query = build_fts_query(search)
+    if not query:
+        return []
+    # Tytuł ważniejszy od autora
+    c.execute('''SELECT b.* FROM books_fts
+                 JOIN books b ON b.id = books_fts.rowid
+                 WHERE books_fts MATCH ?
+                 ORDER BY bm25(books_fts, 2.0, 1.0)
+                 LIMIT ?''', (query, app.config['CATALOG_SEARCH_LIMIT']))
+    return c.fetchall()
+
+# Kolumny tabeli books w kolejności zwracanej przez SELECT *
+BOOK_COLUMNS = ('id', 'title', 'author', 'added_date', 'available', 'last_edited', 'isbn')
+
+def encode_cursor(book):
+    """Kursor stronicowania: pozycja (tytuł, id) ostatniej książki na stronie"""
+    return base64.urlsafe_b64encode(json.dumps([book[1], book[0]]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Zwraca (tytuł, id) albo None dla pustego lub uszkodzonego kursora"""
+    if not cursor:
+        return None
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM borrows WHERE user_id = ? AND returned = 0', (user_id,))
-        count = c.fetchone()[0]
-        conn.close()
-        return count
-    except Exception:
-        return 0
+        title, book_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(title), int(book_id)
+    except (ValueError, TypeError):
+        return None
 
-# Obliczanie dni spóźnienia i opłaty - POPRAWIONE
-def calculate_fine(borrow_date, return_date, returned, actual_return_date=None):
-    """Oblicza karę za spóźnienie"""
+def get_page_size():
+    """Rozmiar strony z parametru ?limit= ograniczony do CATALOG_MAX_PAGE_SIZE"""
     try:
-        return_date_obj = datetime.strptime(return_date, '%Y-%m-%d %H:%M:%S')
-
-        if returned and actual_return_date:
-            end_date = datetime.strptime(actual_return_date, '%Y-%m-%d %H:%M:%S')
-        else:
-            end_date = datetime.now()
-
-        if end_date > return_date_obj:
-            days_late = (end_date - return_date_obj).days
-            fine = days_late * 0.60  # 0,60 PLN za dzień
-            return max(fine, 0)
-    except (ValueError, TypeError):
+        size = int(request.args.get('limit', app.config['CATALOG_PAGE_SIZE']))
+    except ValueError:
+        size = app.config['CATALOG_PAGE_SIZE']
+    return max(1, min(size, app.config['CATALOG_MAX_PAGE_SIZE']))
+
+def query_books_page(c, after, limit):
+    """Stronicowanie keyset po (title, id) - koszt nie rośnie z numerem strony.
+    Pobiera limit + 1 wierszy, żeby wiedzieć, czy istnieje kolejna strona."""
+    if after:
+        c.execute('SELECT * FROM books WHERE (title, id) > (?, ?) ORDER BY title, id LIMIT ?',
+                  (after[0], after[1], limit + 1))
+    else:
+        c.execute('SELECT * FROM books ORDER BY title, id LIMIT ?', (limit + 1,))
+    return c
+
+_daily_borrows_pruned = None
+
+def prune_daily_borrows(c, now, param='?'):
+    """Usuwa dzienne liczniki spoza okna POPULARITY_WINDOW_DAYS - raz na dobę w procesie,
+    przy pierwszym wypożyczeniu danego dnia (zakres po początku klucza głównego)"""
+    global _daily_borrows_pruned
+    today = date.fromtimestamp(now)
+    if _daily_borrows_pruned == today:
+        return
+    c.execute('DELETE FROM book_daily_borrows WHERE day < {0}'.format(param),
+              ((today - timedelta(days=app.config['POPULARITY_WINDOW_DAYS'])).isoformat(),))
+    _daily_borrows_pruned = today
+
+# Miejsce w kolejce to liczba czekających przed użytkownikiem (zakres indeksu, tylko do wyświetlenia)
+USER_RESERVATIONS_SQL = '''
+    SELECT r.id, r.book_id, b.title, r.status,
+           CASE WHEN r.status = 'waiting' THEN
+               r.queue_seq - (SELECT MIN(q.queue_seq) FROM reservations q
+                              WHERE q.book_id = r.book_id AND q.status = 'waiting') + 1 END,
+           r.expires_date
+    FROM reservations r JOIN books b ON b.id = r.book_id
+    WHERE r.user_id = {0} AND r.status IN ('waiting', 'ready')
+    ORDER BY r.id'''
+
+# Dziennik wypożyczeń: niezmienne zdarzenia (created_date, event, borrow_id, user_id, book_id,
+# amount, due_date, actor_id). 'borrow' (due_date - termin), 'return' (amount - kara przy
+# zwrocie, actor_id - administrator, jeśli zwrot przyjął on), 'fine' (kara naliczona przez
+# accrue_fines), 'payment' (amount - opłacona kwota), 'adjust' (zmiana liczby posiadanych
+# egzemplarzy książki przez administratora: amount - różnica, borrow_id = CATALOG_EVENT_ID).
+# Z samego dziennika da się odtworzyć tabele borrows i fines (replay_borrow_events) oraz
+# sprawdzić available (egzemplarze = available + wypożyczone + odłożone dla rezerwacji).
+CIRCULATION_EVENT_INSERT = '''INSERT INTO circulation_events
+    (created_date, event, borrow_id, user_id, book_id, amount, due_date, actor_id) VALUES '''
+CIRCULATION_EVENT_SQL = CIRCULATION_EVENT_INSERT + '({0}, {0}, {0}, {0}, {0}, {0}, {0}, {0})'
+# borrow_id zdarzeń katalogu - w CIRCULATION_REPLAY_SQL są przed wszystkimi wypożyczeniami
+CATALOG_EVENT_ID = 0
+# Zdarzenia jednego wypożyczenia razem, 'borrow' na początku - zdarzenie z kolejki
+# zapisującej partiami może mieć większe id niż późniejsze zdarzenie z innego procesu
+CIRCULATION_REPLAY_SQL = '''SELECT created_date, event, borrow_id, user_id, book_id, amount, due_date, actor_id
+    FROM circulation_events ORDER BY borrow_id, event <> 'borrow', id'''
+# Liczba wypożyczeń, których wiersz w borrows / fines różni się od odtworzonego w replay_borrows /
+# replay_fines albo istnieje tylko po jednej stronie
+CIRCULATION_DIFF_SQL = '''SELECT
+    (SELECT COUNT(DISTINCT id) FROM (
+        SELECT id FROM (SELECT id, user_id, book_id, borrow_date, return_date, returned,
+                               COALESCE(fine_amount, 0) FROM borrows
+                        EXCEPT SELECT * FROM replay_borrows) a
+        UNION ALL
+        SELECT id FROM (SELECT * FROM replay_borrows
+                        EXCEPT SELECT id, user_id, book_id, borrow_date, return_date, returned,
+                                      COALESCE(fine_amount, 0) FROM borrows) b) d),
+    (SELECT COUNT(DISTINCT borrow_id) FROM (
+        SELECT borrow_id FROM (SELECT borrow_id, user_id, amount, calculated_date, paid FROM fines
+                               EXCEPT SELECT * FROM replay_fines) a
+        UNION ALL
+        SELECT borrow_id FROM (SELECT * FROM replay_fines
+                               EXCEPT SELECT borrow_id, user_id, amount, calculated_date, paid FROM fines) b) d)'''
+# Książki, których available nie zgadza się z egzemplarzami z dziennika (replay_stock) pomniejszonymi
+# o odtworzone aktywne wypożyczenia i odłożone egzemplarze: (id, oczekiwane available)
+CIRCULATION_STOCK_DIFF_SQL = '''SELECT b.id, COALESCE(s.copies, 0) - COALESCE(a.n, 0) - COALESCE(h.n, 0)
+    FROM books b
+    LEFT JOIN replay_stock s ON s.book_id = b.id
+    LEFT JOIN (SELECT book_id, COUNT(*) AS n FROM replay_borrows WHERE returned = 0 GROUP BY book_id) a
+           ON a.book_id = b.id
+    LEFT JOIN (SELECT book_id, COUNT(*) AS n FROM reservations WHERE status = 'ready' GROUP BY book_id) h
+           ON h.book_id = b.id
+    WHERE b.available <> COALESCE(s.copies, 0) - COALESCE(a.n, 0) - COALESCE(h.n, 0)
+    ORDER BY b.id'''
+
+def backfill_circulation_events(c):
+    """Zdarzenia dla historii sprzed dziennika. Wstawiane fazami (wszystkie 'borrow', potem
+    'fine', 'return', 'payment'), więc w obrębie wypożyczenia kolejność jest jak przy pracy
+    aplikacji. Termin zwróconych wypożyczeń nie jest zapisany - przyjmujemy LOAN_DAYS."""
+    c.execute('''INSERT INTO circulation_events (created_date, event, borrow_id, user_id, book_id, due_date)
+                 SELECT borrow_date, 'borrow', id, user_id, book_id,
+                        CASE WHEN returned = 1 THEN borrow_date + %d ELSE return_date END
+                 FROM borrows ORDER BY id''' % (LOAN_DAYS * DAY))
+    c.execute('''INSERT INTO circulation_events (created_date, event, borrow_id, user_id, amount)
+                 SELECT calculated_date, 'fine', borrow_id, user_id, amount FROM fines ORDER BY borrow_id''')
+    c.execute('''INSERT INTO circulation_events (created_date, event, borrow_id, user_id, book_id, amount)
+                 SELECT return_date, 'return', id, user_id, book_id, fine_amount
+                 FROM borrows WHERE returned = 1 ORDER BY id''')
+    c.execute('''INSERT INTO circulation_events (created_date, event, borrow_id, user_id, book_id, amount)
+                 SELECT CASE WHEN b.returned = 1 AND b.return_date > f.calculated_date
+                             THEN b.return_date ELSE f.calculated_date END,
+                        'payment', f.borrow_id, f.user_id, b.book_id, f.amount
+                 FROM fines f JOIN borrows b ON b.id = f.borrow_id
+                 WHERE f.paid = 1 ORDER BY f.borrow_id''')
+
+def replay_borrow_events(events):
+    """Stan jednego wypożyczenia po zdarzeniach (kolejność jak w CIRCULATION_REPLAY_SQL):
+    (wiersz borrows, wiersz fines albo None); (None, None) bez zdarzenia 'borrow'.
+    Reguły jak w Storage.borrow_book, _close_borrow, accrue_fines i pay_fine."""
+    borrow = fine = None
+    for created, event, borrow_id, user_id, book_id, amount, due_date, actor_id in events:
+        if event == 'borrow':
+            borrow = [borrow_id, user_id, book_id, created, due_date, 0, 0]
+        elif borrow is None:
+            continue
+        elif event == 'return':
+            if borrow[5]:
+                continue
+            borrow[4:7] = [created, 1, amount if amount is not None else 0]
+            if amount and amount > 0 and not (fine and fine[4]):
+                fine = [borrow_id, user_id, amount, created, 0]
+        elif event == 'fine':
+            if not (fine and fine[4]):
+                fine = [borrow_id, user_id, amount, created, 0]
+        elif event == 'payment':
+            if fine:
+                fine[4] = 1
+            if not borrow[5]:
+                borrow[4:6] = [created, 1]
+    return (tuple(borrow) if borrow else None), (tuple(fine) if fine else None)
+
+def replayed_rows(events, stock):
+    """(wiersz borrows, wiersz fines albo None) dla każdego wypożyczenia w dzienniku; zdarzenia
+    'adjust' są po drodze sumowane w stock: {id książki: liczba egzemplarzy}"""
+    for borrow_id, group in groupby(events, key=lambda event: event[2]):
+        if borrow_id == CATALOG_EVENT_ID:
+            for event in group:
+                if event[1] == 'adjust':
+                    stock[event[4]] = stock.get(event[4], 0) + event[5]
+            continue
+        borrow, fine = replay_borrow_events(group)
+        if borrow:
+            yield borrow, fine
+
+class CirculationLog:
+    """Zdarzenia zatwierdzonych transakcji czekające na zapis partiami (CIRCULATION_LOG_MODE =
+    'batched'). Wątek zapisuje je co CIRCULATION_LOG_FLUSH_INTERVAL s albo po zebraniu
+    CIRCULATION_LOG_BATCH_SIZE, jedną transakcją; przy awarii procesu giną niezapisane."""
+
+    def __init__(self, interval, batch_size, max_pending):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # Partie zapisywane po kolei
+        self._wakeup = threading.Event()
+        self._thread = None
+        atexit.register(self.flush)
+
+    def enqueue(self, events):
+        with self._lock:
+            # Baza niedostępna zbyt długo - tracimy najstarsze zamiast całej pamięci
+            overflow = len(self._pending) + len(events) - self.max_pending
+            for _ in range(min(overflow, len(self._pending))):
+                self._pending.popleft()
+            self._pending.extend(events)
+            full = len(self._pending) >= self.batch_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='circulation-log', daemon=True)
+                self._thread.start()
+        self._dropped(overflow)
+        if full:
+            self._wakeup.set()
+
+    def _dropped(self, count):
+        if count > 0:
+            app.logger.error('Kolejka dziennika wypożyczeń pełna - pominięto %d zdarzeń', count)
+            metrics.inc('libraryhub_circulation_events_dropped_total', {}, count)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Zapisuje oczekujące zdarzenia; po błędzie wracają na początek kolejki (w granicy
+        max_pending - przy dłuższej niedostępności bazy giną najstarsze, jak w enqueue)"""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+                self._pending.clear()
+            if not batch:
+                return 0
+            try:
+                with open_storage() as storage:
+                    storage.append_circulation_events(batch)
+            except Exception:
+                app.logger.exception('Błąd zapisu dziennika wypożyczeń (%d zdarzeń)', len(batch))
+                with self._lock:
+                    overflow = len(self._pending) + len(batch) - self.max_pending
+                    self._pending.extendleft(reversed(batch[max(overflow, 0):]))
+                self._dropped(overflow)
+                return 0
+        metrics.inc('libraryhub_circulation_events_total', {'mode': 'batched'}, len(batch))
+        return len(batch)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+_circulation_log = None
+
+def get_circulation_log():
+    """Tworzy (przy pierwszym użyciu) kolejkę dziennika według konfiguracji"""
+    global _circulation_log
+    if _circulation_log is None:
+        _circulation_log = CirculationLog(app.config['CIRCULATION_LOG_FLUSH_INTERVAL'],
+                                          app.config['CIRCULATION_LOG_BATCH_SIZE'],
+                                          app.config['CIRCULATION_LOG_MAX_PENDING'])
+    return _circulation_log
+
+# Obliczanie dni spóźnienia i opłaty
+def calculate_fine(due_date, end_date):
+    """Oblicza karę za spóźnienie (daty jako sekundy epoki)"""
+    if due_date is None or end_date <= due_date:
         return 0
-    return 0
+    days_late = (end_date - due_date) // DAY
+    return days_late * FINE_PER_DAY
 
-# Obliczanie pozostałego czasu zwrotu
-def calculate_days_left(return_date):
-    """Oblicza pozostałe dni do zwrotu"""
+def encode_history_cursor(borrow_date, borrow_id):
+    """Kursor historii wypożyczeń: pozycja (data wypożyczenia, id) ostatniego wiersza"""
+    return base64.urlsafe_b64encode(json.dumps([borrow_date, borrow_id]).encode('utf-8')).decode('ascii')
+
+def decode_history_cursor(cursor):
+    if not cursor:
+        return None
     try:
-        return_date_obj = datetime.strptime(return_date, '%Y-%m-%d %H:%M:%S')
-        now = datetime.now()
-        delta = return_date_obj - now
-        days_left = delta.days + (1 if delta.seconds > 0 else 0)
-        return max(days_left, 0)
+        borrow_date, borrow_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return int(borrow_date), int(borrow_id)
     except (ValueError, TypeError):
-        return 0
-
-# Inicjalizacja bazy danych
-def init_db():
-    conn = sqlite3.connect('database/library.db')
-    c = conn.cursor()
+        return None
+
+# Dane strony profilu jednym zapytaniem (Storage.profile): liczba aktywnych wypożyczeń, suma
+# nieopłaconych kar i wypożyczenia - krotki (tytuł, data wypożyczenia, termin/data zwrotu,
+# zwrócona, pozostałe dni lub None, kara, id, id książki). Aktywne są zawsze na pierwszej
+# stronie, zwrócone stronicowane keyset po (borrow_date, id) malejąco. Pozostałe dni do
+# zwrotu zaokrąglane w górę, nie mniej niż 0.
+PROFILE_SQL = '''
+    SELECT s.active, s.unpaid, p.title, p.borrow_date, p.return_date, p.returned,
+           p.days_left, p.fine, p.id, p.book_id
+    FROM (SELECT (SELECT COUNT(*) FROM borrows WHERE user_id = {0} AND returned = 0) AS active,
+                 (SELECT COALESCE(SUM(amount), 0) FROM fines
+                  WHERE user_id = {0} AND paid = 0) AS unpaid) s
+    LEFT JOIN (
+        SELECT b.title, br.borrow_date, br.return_date, br.returned,
+               CASE WHEN br.return_date > {0} THEN (br.return_date - {0} + %d) / %d ELSE 0 END AS days_left,
+               COALESCE(br.fine_amount, 0) AS fine, br.id, br.book_id
+        FROM borrows br JOIN books b ON br.book_id = b.id
+        WHERE br.user_id = {0} AND br.returned = 0 AND {0}
+        UNION ALL
+        SELECT * FROM (
+            SELECT b.title, br.borrow_date, br.return_date, br.returned,
+                   CAST(NULL AS INTEGER), COALESCE(br.fine_amount, 0), br.id, br.book_id
+            FROM borrows br JOIN books b ON br.book_id = b.id
+            WHERE br.user_id = {0} AND br.returned = 1
+              AND (br.borrow_date, br.id) < ({0}, {0})
+            ORDER BY br.borrow_date DESC, br.id DESC
+            LIMIT {0}) history
+    ) p ON true
+    ORDER BY p.returned, p.borrow_date DESC, p.id DESC''' % (DAY - 1, DAY)
+
+def profile_from_rows(rows, limit):
+    """Wiersze zapytania profilu (aktywne, kary, dane wypożyczenia..., id, id książki) -> wynik Storage.profile"""
+    active_count, unpaid_total = rows[0][0], rows[0][1]
+    borrows = [row[2:10] for row in rows if row[2] is not None]
+    history = [row for row in rows if row[5]]
+    next_cursor = None
+    if len(history) > limit:
+        borrows.pop()
+        next_cursor = encode_history_cursor(history[limit - 1][3], history[limit - 1][8])
+    return borrows, active_count, unpaid_total, next_cursor
+
+@app.template_filter('datetime')
+def format_datetime(value, fmt='%Y-%m-%d %H:%M:%S'):
+    """Daty są przechowywane jako sekundy epoki i formatowane dopiero w szablonie"""
+    if value is None:
+        return ''
+    return datetime.fromtimestamp(value).strftime(fmt)
+
+# Migracje schematu bazy danych
+def _migration_1_base_schema(c):
+    """Podstawowe tabele (bazy sprzed systemu migracji mogą już je mieć)"""
     c.execute('''CREATE TABLE IF NOT EXISTS users
                  (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT, is_admin INTEGER)''')
     c.execute('''CREATE TABLE IF NOT EXISTS books
@@ -144,92 +1561,1968 @@ def init_db():
                  (id INTEGER PRIMARY KEY, borrow_id INTEGER, user_id INTEGER,
                   amount REAL, calculated_date TEXT, paid INTEGER)''')
 
-    # Sprawdź czy kolumna ISBN istnieje, jeśli nie - dodaj
+    # Stare bazy mogą nie mieć kolumny ISBN
     c.execute("PRAGMA table_info(books)")
     columns = [column[1] for column in c.fetchall()]
     if 'isbn' not in columns:
         c.execute('ALTER TABLE books ADD COLUMN isbn TEXT')
 
-    # Domyślny admin
-    c.execute('SELECT COUNT(*) FROM users')
-    if c.fetchone()[0] == 0:
-        hashed = bcrypt.hashpw('admin123'.encode('utf-8'), bcrypt.gensalt())
-        c.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)',
-                  ('admin', hashed.decode('utf-8'), 1))
-
-    # Przykładowe książki z ISBN
-    c.execute('SELECT COUNT(*) FROM books')
-    if c.fetchone()[0] == 0:
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        books = [
-            ('Wiedźmin', 'Andrzej Sapkowski', 5, '978-83-7469-707-3'),
-            ('Lalka', 'Bolesław Prus', 3, '978-83-240-0123-4'),
-            ('Solaris', 'Stanisław Lem', 2, '978-83-7392-845-6'),
-            ('Pan Tadeusz', 'Adam Mickiewicz', 4, '978-83-240-0567-8'),
-            ('Quo Vadis', 'Henryk Sienkiewicz', 3, '978-83-240-0890-1')
-        ]
-        for title, author, available, isbn in books:
-            c.execute('INSERT INTO books (title, author, added_date, available, last_edited, isbn) VALUES (?, ?, ?, ?, ?, ?)',
+def _migration_2_indexes(c):
+    """Indeksy pod najczęstsze warunki WHERE/ORDER BY"""
+    # Aktywne wypożyczenia (returned = 0) to mały podzbiór historii - indeks częściowy
+    # obsługuje katalog, limit wypożyczeń, profil i sprawdzanie przed usunięciem
+    c.execute('CREATE INDEX IF NOT EXISTS idx_borrows_active_user ON borrows(user_id, book_id) WHERE returned = 0')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_borrows_active_book ON borrows(book_id) WHERE returned = 0')
+    # Historia wypożyczeń użytkownika sortowana po dacie oraz ranking popularności
+    c.execute('CREATE INDEX IF NOT EXISTS idx_borrows_user_date ON borrows(user_id, borrow_date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_borrows_book ON borrows(book_id)')
+    # Suma nieopłaconych kar (indeks pokrywający) i lista kar administratora
+    c.execute('CREATE INDEX IF NOT EXISTS idx_fines_unpaid_user ON fines(user_id, amount) WHERE paid = 0')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_fines_paid_date ON fines(paid, calculated_date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_fines_borrow ON fines(borrow_id)')
+    # Katalog sortowany po tytule
+    c.execute('CREATE INDEX IF NOT EXISTS idx_books_title ON books(title)')
+    c.execute('ANALYZE')
+
+# Tokenizer unicode61 usuwa polskie znaki diakrytyczne poza "ł", które nie ma rozkładu
+# w Unicode - zamieniamy je ręcznie po obu stronach (indeks i zapytanie)
+FTS_FOLD_SQL = "replace(replace({0}, 'ł', 'l'), 'Ł', 'L')"
+
+def _migration_3_fulltext_search(c):
+    """Indeks pełnotekstowy FTS5 tytułów i autorów oraz ISBN bez myślników"""
+    # Wyszukiwanie po ISBN jest dokładnym dopasowaniem, więc wartości muszą być znormalizowane
+    c.execute("UPDATE OR IGNORE books SET isbn = replace(replace(isbn, '-', ''), ' ', '') WHERE isbn IS NOT NULL")
+    c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+                     title, author, content='', tokenize='unicode61 remove_diacritics 2')""")
+    _create_books_fts_triggers(c)
+    c.execute('INSERT INTO books_fts (books_fts) VALUES (\'delete-all\')')
+    c.execute('INSERT INTO books_fts (rowid, title, author) SELECT id, %s, %s FROM books'
+              % (FTS_FOLD_SQL.format('title'), FTS_FOLD_SQL.format('author')))
+
+def _create_books_fts_triggers(c):
+    """Wyzwalacze utrzymujące books_fts w zgodzie z tabelą books"""
+    fold_new = (FTS_FOLD_SQL.format('new.title'), FTS_FOLD_SQL.format('new.author'))
+    fold_old = (FTS_FOLD_SQL.format('old.title'), FTS_FOLD_SQL.format('old.author'))
+    c.execute('''CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+                     INSERT INTO books_fts (rowid, title, author) VALUES (new.id, %s, %s);
+                 END''' % fold_new)
+    c.execute('''CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+                     INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.id, %s, %s);
+                 END''' % fold_old)
+    c.execute('''CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN
+                     INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.id, %s, %s);
+                     INSERT INTO books_fts (rowid, title, author) VALUES (new.id, %s, %s);
+                 END''' % (fold_old + fold_new))
+
+EPOCH_DAY_SQL = "date({0}, 'unixepoch', 'localtime')"  # SQLite; PostgresStorage.epoch_day_sql
+
+def rebuild_popularity(c, param='?', epoch_day_sql=EPOCH_DAY_SQL):
+    """Przelicza liczniki popularności od zera na podstawie tabeli borrows"""
+    c.execute('UPDATE books SET borrow_count = (SELECT COUNT(*) FROM borrows WHERE borrows.book_id = books.id)')
+    c.execute('DELETE FROM book_daily_borrows')
+    c.execute('''INSERT INTO book_daily_borrows (day, book_id, borrows)
+                 SELECT %s AS day, book_id, COUNT(*) FROM borrows
+                 WHERE borrow_date >= %s
+                 GROUP BY day, book_id''' % (epoch_day_sql.format('borrow_date'), param),
+              (int(time.time()) - app.config['POPULARITY_WINDOW_DAYS'] * DAY,))
+
+def _migration_4_popularity_counters(c):
+    """Zmaterializowane liczniki wypożyczeń zamiast GROUP BY po całej historii"""
+    c.execute('ALTER TABLE books ADD COLUMN borrow_count INTEGER NOT NULL DEFAULT 0')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_books_borrow_count ON books(borrow_count DESC)')
+    # Dzienne liczniki dla rankingów tygodniowych i miesięcznych
+    c.execute('''CREATE TABLE IF NOT EXISTS book_daily_borrows
+                 (day TEXT, book_id INTEGER, borrows INTEGER NOT NULL,
+                  PRIMARY KEY (day, book_id)) WITHOUT ROWID''')
+    # Daty były wtedy tekstem - liczniki przelicza migracja 6 po konwersji
+
+def _migration_5_fine_accrual(c):
+    """Jedna kara na wypożyczenie (UPSERT), indeks przeterminowanych i stan zadań wsadowych"""
+    # Aplikacja nie tworzy duplikatów, ale na wszelki wypadek zostawiamy najnowszy wpis
+    c.execute('DELETE FROM fines WHERE id NOT IN (SELECT MAX(id) FROM fines GROUP BY borrow_id)')
+    c.execute('DROP INDEX IF EXISTS idx_fines_borrow')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_fines_borrow ON fines(borrow_id)')
+    # Pokrywający (user_id) - naliczanie kar nie musi czytać wierszy tabeli borrows
+    c.execute('CREATE INDEX IF NOT EXISTS idx_borrows_active_due ON borrows(return_date, user_id) WHERE returned = 0')
+    c.execute('CREATE TABLE IF NOT EXISTS job_state (name TEXT PRIMARY KEY, value TEXT)')
+
+def _epoch_sql(column):
+    """Tekstowa data lokalna '%Y-%m-%d %H:%M:%S' -> sekundy epoki (NULL pozostaje NULL)"""
+    return "CAST(strftime('%%s', %s, 'utc') AS INTEGER)" % column
+
+def _migration_6_epoch_timestamps(c):
+    """Daty jako liczby całkowite (sekundy epoki) - bez strptime i z arytmetyką w SQL.
+    SQLite nie zmienia typu kolumny, więc tabele są przebudowywane."""
+    c.execute('''CREATE TABLE books_new
+                 (id INTEGER PRIMARY KEY, title TEXT, author TEXT, added_date INTEGER,
+                  available INTEGER, last_edited INTEGER, isbn TEXT UNIQUE,
+                  borrow_count INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('''INSERT INTO books_new (id, title, author, added_date, available, last_edited, isbn, borrow_count)
+                 SELECT id, title, author, %s, available, %s, isbn, borrow_count FROM books'''
+              % (_epoch_sql('added_date'), _epoch_sql('last_edited')))
+    c.execute('''CREATE TABLE borrows_new
+                 (id INTEGER PRIMARY KEY, user_id INTEGER, book_id INTEGER,
+                  borrow_date INTEGER, return_date INTEGER, returned INTEGER, fine_amount REAL)''')
+    c.execute('''INSERT INTO borrows_new (id, user_id, book_id, borrow_date, return_date, returned, fine_amount)
+                 SELECT id, user_id, book_id, %s, %s, returned, fine_amount FROM borrows'''
+              % (_epoch_sql('borrow_date'), _epoch_sql('return_date')))
+    c.execute('''CREATE TABLE fines_new
+                 (id INTEGER PRIMARY KEY, borrow_id INTEGER, user_id INTEGER,
+                  amount REAL, calculated_date INTEGER, paid INTEGER)''')
+    c.execute('''INSERT INTO fines_new (id, borrow_id, user_id, amount, calculated_date, paid)
+                 SELECT id, borrow_id, user_id, amount, %s, paid FROM fines'''
+              % _epoch_sql('calculated_date'))
+
+    # Usunięcie tabel usuwa też ich indeksy i wyzwalacze FTS - tworzymy je ponownie
+    for table in ('books', 'borrows', 'fines'):
+        c.execute('DROP TABLE %s' % table)
+        c.execute('ALTER TABLE %s_new RENAME TO %s' % (table, table))
+    _create_books_fts_triggers(c)
+    c.execute('CREATE INDEX idx_books_title ON books(title)')
+    c.execute('CREATE INDEX idx_books_borrow_count ON books(borrow_count DESC)')
+    c.execute('CREATE INDEX idx_borrows_active_user ON borrows(user_id, book_id) WHERE returned = 0')
+    c.execute('CREATE INDEX idx_borrows_active_book ON borrows(book_id) WHERE returned = 0')
+    c.execute('CREATE INDEX idx_borrows_user_date ON borrows(user_id, borrow_date)')
+    c.execute('CREATE INDEX idx_borrows_book ON borrows(book_id)')
+    c.execute('CREATE INDEX idx_borrows_active_due ON borrows(return_date, user_id) WHERE returned = 0')
+    c.execute('CREATE INDEX idx_fines_unpaid_user ON fines(user_id, amount) WHERE paid = 0')
+    c.execute('CREATE INDEX idx_fines_paid_date ON fines(paid, calculated_date)')
+    c.execute('CREATE UNIQUE INDEX idx_fines_borrow ON fines(borrow_id)')
+
+    # Punkt kontrolny naliczania kar zawierał daty tekstowe
+    c.execute("DELETE FROM job_state WHERE name IN ('fine_accrual', 'fine_accrual_last_run')")
+    rebuild_popularity(c)
+    c.execute('ANALYZE')
+
+def _migration_7_row_versions(c):
+    """Licznik zmian wiersza książki (dostępność, edycja, import) - ETag w /api/v1"""
+    c.execute('ALTER TABLE books ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+def backfill_canonical_isbns(c, param='?'):
+    """Zamienia zapisane ISBN na klucz canonical_isbn (ISBN-10 -> ISBN-13). Numery z błędną
+    cyfrą kontrolną oraz te, których klucz ma już inna książka, zostają bez zmian."""
+    c.execute("UPDATE books SET isbn = NULL WHERE isbn = ''")
+    c.execute('SELECT id, isbn FROM books WHERE isbn IS NOT NULL AND length(isbn) != 13')
+    for book_id, isbn in c.fetchall():
+        key = canonical_isbn(isbn)
+        if key is None or key == isbn:
+            continue
+        c.execute('SELECT 1 FROM books WHERE isbn = %s' % param, (key,))
+        if c.fetchone() is None:
+            c.execute('UPDATE books SET isbn = %s, version = version + 1 WHERE id = %s' % (param, param),
+                      (key, book_id))
+
+def _migration_8_canonical_isbn(c):
+    """ISBN jako klucz ISBN-13 - wyszukiwanie i wykrywanie duplikatów to jeden odczyt indeksu"""
+    backfill_canonical_isbns(c)
+
+def _migration_9_reservations(c):
+    """Kolejka rezerwacji: status 'waiting' -> 'ready' (egzemplarz odłożony do expires_date)
+    -> 'fulfilled' po wypożyczeniu; albo 'cancelled' / 'expired'"""
+    c.execute('''CREATE TABLE reservations
+                 (id INTEGER PRIMARY KEY, user_id INTEGER, book_id INTEGER, created_date INTEGER,
+                  status TEXT NOT NULL, expires_date INTEGER)''')
+    # Głowa kolejki i miejsce w niej; gotowe rezerwacje książki
+    c.execute('CREATE INDEX idx_reservations_book ON reservations(book_id, status, id)')
+    # Limit i gotowa rezerwacja przy wypożyczeniu, lista w profilu
+    c.execute('CREATE INDEX idx_reservations_user ON reservations(user_id, status, book_id)')
+    c.execute("CREATE INDEX idx_reservations_ready_expiry ON reservations(expires_date) WHERE status = 'ready'")
+
+def _migration_10_circulation_events(c):
+    """Dziennik zdarzeń wypożyczeń (tylko dopisywanie) z odtworzoną historią"""
+    c.execute('''CREATE TABLE circulation_events
+                 (id INTEGER PRIMARY KEY, created_date INTEGER NOT NULL, event TEXT NOT NULL,
+                  borrow_id INTEGER NOT NULL, user_id INTEGER, book_id INTEGER, amount REAL,
+                  due_date INTEGER, actor_id INTEGER)''')
+    backfill_circulation_events(c)
+
+def backfill_stock_events(c):
+    """Zdarzenia 'adjust' z bieżącą liczbą egzemplarzy książek sprzed ich rejestrowania"""
+    c.execute('''INSERT INTO circulation_events (created_date, event, borrow_id, book_id, amount)
+                 SELECT COALESCE(b.added_date, 0), 'adjust', %d, b.id, b.available
+                        + (SELECT COUNT(*) FROM borrows br WHERE br.book_id = b.id AND br.returned = 0)
+                        + (SELECT COUNT(*) FROM reservations r WHERE r.book_id = b.id AND r.status = 'ready')
+                 FROM books b ORDER BY b.id''' % CATALOG_EVENT_ID)
+
+def backfill_reservation_queue(c):
+    c.execute('''UPDATE reservations SET queue_seq =
+                     (SELECT COUNT(*) FROM reservations q
+                      WHERE q.book_id = reservations.book_id AND q.status = 'waiting' AND q.id <= reservations.id)
+                 WHERE status = 'waiting' ''')
+
+def _migration_11_reservation_queue_seq(c):
+    """Numer w kolejce książki - miejsce to różnica z numerem jej początku (indeks częściowy)
+    zamiast liczenia wszystkich czekających przed rezerwacją"""
+    c.execute('ALTER TABLE reservations ADD COLUMN queue_seq INTEGER')
+    backfill_reservation_queue(c)
+    c.execute("CREATE INDEX idx_reservations_queue ON reservations(book_id, queue_seq) WHERE status = 'waiting'")
+
+def _migration_12_live_events(c):
+    """Ostatnie zdarzenia /events dla strumieni wszystkich procesów (EVENTS_CHANNEL = 'database')"""
+    c.execute('''CREATE TABLE live_events
+                 (id INTEGER PRIMARY KEY, event TEXT NOT NULL, data TEXT NOT NULL, user_id TEXT)''')
+
+def _migration_13_stock_events(c):
+    """Zmiany liczby egzemplarzy w dzienniku - stan początkowy każdej książki"""
+    backfill_stock_events(c)
+
+# Lista migracji: (wersja, funkcja). Nowe migracje dopisujemy wyłącznie na końcu.
+MIGRATIONS = [
+    (1, _migration_1_base_schema),
+    (2, _migration_2_indexes),
+    (3, _migration_3_fulltext_search),
+    (4, _migration_4_popularity_counters),
+    (5, _migration_5_fine_accrual),
+    (6, _migration_6_epoch_timestamps),
+    (7, _migration_7_row_versions),
+    (8, _migration_8_canonical_isbn),
+    (9, _migration_9_reservations),
+    (10, _migration_10_circulation_events),
+    (11, _migration_11_reservation_queue_seq),
+    (12, _migration_12_live_events),
+    (13, _migration_13_stock_events),
+]
+
+def migrate_db(conn, target=None):
+    """Stosuje brakujące migracje; wersja schematu trzymana jest w PRAGMA user_version"""
+    c = conn.cursor()
+    for version, migration in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        # BEGIN IMMEDIATE serializuje migracje uruchamiane równolegle przez kilka procesów
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            c.execute('PRAGMA user_version')
+            if c.fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            migration(c)
+            c.execute('PRAGMA user_version = %d' % version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    c.execute('PRAGMA user_version')
+    return c.fetchone()[0]
+
+# Inicjalizacja bazy danych
+def init_db():
+    with open_storage() as storage:
+        storage.migrate()
+
+        # Domyślny admin
+        if storage.user_count() == 0:
+            storage.add_user('admin', _hash_password_worker('admin123', app.config['BCRYPT_ROUNDS']), True)
+
+        # Przykładowe książki z ISBN
+        if storage.book_count() == 0:
+            books = [
+                ('Wiedźmin', 'Andrzej Sapkowski', 5, '978-83-7469-707-1'),
+                ('Lalka', 'Bolesław Prus', 3, '978-83-240-0123-1'),
+                ('Solaris', 'Stanisław Lem', 2, '978-83-7392-845-9'),
+                ('Pan Tadeusz', 'Adam Mickiewicz', 4, '978-83-240-0567-3'),
+                ('Quo Vadis', 'Henryk Sienkiewicz', 3, '978-83-240-0890-2')
+            ]
+            for title, author, available, isbn in books:
+                storage.add_book(title, author, available, canonical_isbn(isbn))
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Tworzy bazę danych i stosuje brakujące migracje"""
+    init_db()
+    click.echo('Baza danych gotowa')
+
+# Naliczanie kar dla niezwróconych wypożyczeń (Storage.accrue_fines)
+# Zdarzenia 'fine' dla kar zmienionych w partii accrue_fines (calculated_date = moment przebiegu)
+ACCRUED_FINE_EVENTS_SQL = '''INSERT INTO circulation_events (created_date, event, borrow_id, user_id, amount)
+    SELECT f.calculated_date, 'fine', f.borrow_id, f.user_id, f.amount
+    FROM borrows b JOIN fines f ON f.borrow_id = b.id
+    WHERE b.returned = 0 AND b.return_date <= {0}
+      AND (b.return_date, b.id) > ({0}, {0}) AND (b.return_date, b.id) <= ({0}, {0})
+      AND f.calculated_date = {0} AND f.paid = 0
+    ORDER BY b.id'''
+
+def start_fine_accrual_scheduler(interval):
+    """Wątek w tle naliczający kary co interval sekund (dla pojedynczego procesu)"""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with open_storage() as storage:
+                    storage.accrue_fines()
+            except Exception:
+                app.logger.exception('Błąd naliczania kar')
+
+    thread = threading.Thread(target=run, name='fine-accrual', daemon=True)
+    thread.start()
+    return thread
+
+def start_hold_expiry_scheduler(interval):
+    """Wątek w tle wygaszający nieodebrane rezerwacje co interval sekund"""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with open_storage() as storage:
+                    storage.expire_holds()
+            except Exception:
+                app.logger.exception('Błąd wygaszania rezerwacji')
+
+    thread = threading.Thread(target=run, name='hold-expiry', daemon=True)
+    thread.start()
+    return thread
+
+def start_report_snapshot_refresher(interval):
+    """Wątek w tle odświeżający kopię raportową co interval sekund"""
+    def run():
+        while True:
+            try:
+                refresh_report_snapshot()
+            except Exception:
+                app.logger.exception('Błąd odświeżania kopii raportowej')
+            time.sleep(interval)
+    thread = threading.Thread(target=run, name='report-snapshot', daemon=True)
+    thread.start()
+    return thread
+
+@app.cli.command('refresh-report-snapshot')
+def refresh_report_snapshot_command():
+    """Odświeża kopię bazy dla raportów (REPORTING_DB_MODE = 'snapshot'), np. z crona"""
+    if _using_postgres():
+        raise click.UsageError('Kopia raportowa dotyczy SQLite - w PostgreSQL użyj POSTGRES_REPORTING_DSN')
+    start = time.perf_counter()
+    refresh_report_snapshot()
+    click.echo('Kopia raportowa zapisana w %s (%.2f s)'
+               % (app.config['REPORTING_SNAPSHOT_PATH'], time.perf_counter() - start))
+
+@app.cli.command('accrue-fines')
+@click.option('--batch-size', type=int, default=None, help='Wypożyczeń na transakcję')
+@click.option('--restart', is_flag=True, help='Zacznij od nowa zamiast od punktu kontrolnego')
+def accrue_fines_command(batch_size, restart):
+    """Nalicza kary za przeterminowane, niezwrócone wypożyczenia (np. z crona)"""
+    start = time.perf_counter()
+    with open_storage() as storage:
+        changed = storage.accrue_fines(batch_size, restart)
+    click.echo('Zaktualizowano kar: %d (%.2f s)' % (changed, time.perf_counter() - start))
+
+@app.cli.command('expire-holds')
+@click.option('--batch-size', type=int, default=None, help='Rezerwacji na transakcję')
+def expire_holds_command(batch_size):
+    """Wygasza nieodebrane rezerwacje i przekazuje egzemplarze dalej w kolejce (np. z crona)"""
+    start = time.perf_counter()
+    with open_storage() as storage:
+        expired = storage.expire_holds(batch_size)
+    click.echo('Wygaszono rezerwacji: %d (%.2f s)' % (expired, time.perf_counter() - start))
+
+@app.cli.command('replay-circulation')
+@click.option('--apply', is_flag=True, help='Zastąp tabele borrows i fines stanem odtworzonym z dziennika')
+def replay_circulation_command(apply):
+    """Odtwarza wypożyczenia i kary z dziennika zdarzeń i porównuje je z bazą (kod 1 przy różnicach).
+    Z --apply zastępuje nimi tabele - aplikacja powinna być wtedy zatrzymana."""
+    start = time.perf_counter()
+    stock = {}
+    with open_storage() as source, open_storage() as target:
+        events = source.circulation_events()
+        try:
+            replayed, borrows_diff, fines_diff, stock_diff = target.replay_circulation(
+                replayed_rows(events, stock), stock, apply)
+        finally:
+            events.close()
+    click.echo('Odtworzono wypożyczeń: %d, niezgodnych z bazą: wypożyczenia %d, kary %d, egzemplarze %d (%.2f s)'
+               % (replayed, borrows_diff, fines_diff, stock_diff, time.perf_counter() - start))
+    if apply:
+        invalidate_cache('catalog', 'popular', 'users')
+        click.echo('Tabele borrows i fines oraz available zastąpione stanem z dziennika')
+    elif borrows_diff or fines_diff or stock_diff:
+        sys.exit(1)
+
+@app.cli.command('rebuild-popularity')
+def rebuild_popularity_command():
+    """Przelicza liczniki popularności (np. po imporcie historii wypożyczeń)"""
+    with open_storage() as storage:
+        storage.rebuild_popularity()
+    click.echo('Liczniki popularności przeliczone')
+
+# Import i eksport katalogu
+BOOK_FILE_FORMATS = ('csv', 'jsonl', 'marc')
+BOOK_FILE_FIELDS = ('title', 'author', 'available', 'isbn')
+
+def book_file_format(filename, fmt=None):
+    """Format pliku z parametru albo z rozszerzenia (.csv, .jsonl, .mrk)"""
+    if fmt:
+        return fmt
+    ext = os.path.splitext(filename or '')[1].lower()
+    return {'.jsonl': 'jsonl', '.json': 'jsonl', '.mrk': 'marc', '.marc': 'marc'}.get(ext, 'csv')
+
+def read_csv_books(f):
+    for line_no, row in enumerate(csv.DictReader(f), 2):
+        yield line_no, row
+
+def read_jsonl_books(f):
+    for line_no, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError:
+            yield line_no, None
+
+def _marc_subfields(value):
+    """'10$aTytuł :$bpodtytuł' -> {'a': 'Tytuł :', 'b': 'podtytuł'}"""
+    parts = value.split('$')
+    return {part[0]: part[1:].strip() for part in parts[1:] if part}
+
+def read_marc_books(f):
+    """MARC-lite: tekst w stylu MARCBreaker (=020, =100, =245, =949 $c egzemplarze),
+    rekordy oddzielone pustą linią"""
+    record, start = {}, None
+    for line_no, line in enumerate(f, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            if record:
+                yield start, record
+            record, start = {}, None
+            continue
+        if start is None:
+            start = line_no
+        if not line.startswith('=') or len(line) < 6:
+            continue
+        tag, subfields = line[1:4], _marc_subfields(line[6:])
+        if tag == '020' and 'a' in subfields:
+            record['isbn'] = subfields['a'].split(' ')[0]
+        elif tag == '100' and 'a' in subfields:
+            record['author'] = subfields['a'].rstrip(',.')
+        elif tag == '245' and 'a' in subfields:
+            title = ' '.join(subfields[code] for code in 'ab' if code in subfields)
+            record['title'] = title.rstrip(' /:;,.')
+        elif tag == '949' and 'c' in subfields:
+            record['available'] = subfields['c']
+    if record:
+        yield start, record
+
+BOOK_READERS = {'csv': read_csv_books, 'jsonl': read_jsonl_books, 'marc': read_marc_books}
+
+def import_books(storage, f, fmt, batch_size=None, on_reject=None, actor_id=None):
+    """Wczytuje książki z pliku partiami (jedna transakcja na partię, Storage.import_book_batch).
+    Istniejący ISBN (a bez ISBN - tytuł i autor) jest aktualizowany; `available` w pliku to
+    liczba posiadanych egzemplarzy.
+    Odrzucone wiersze trafiają do on_reject(numer_linii, błąd). Zwraca (zapisane, odrzucone)."""
+    batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+    now = int(time.time())
+    imported = rejected = 0
+    batch = []
+
+    def flush():
+        storage.import_book_batch(batch, actor_id)
+        batch.clear()
+
+    for line_no, row in BOOK_READERS[fmt](f):
+        if not isinstance(row, dict):
+            error = 'Niepoprawny format wiersza'
+        else:
+            title = str(row.get('title') or '').strip()
+            author = str(row.get('author') or '').strip()
+            available = row.get('available')
+            if available is None or available == '':
+                available = 1
+            isbn = str(row.get('isbn') or '').strip()
+            valid, error = validate_book_data(title, author, available, isbn)
+        if error:
+            rejected += 1
+            if on_reject:
+                on_reject(line_no, error)
+            continue
+        batch.append((title, author, now, int(available), now, canonical_isbn(isbn)))
+        if len(batch) >= batch_size:
+            imported += len(batch)
+            flush()
+    if batch:
+        imported += len(batch)
+        flush()
+    if imported:
+        invalidate_cache('catalog', 'popular')
+    return imported, rejected
+
+def export_books(rows, fmt):
+    """Generator kolejnych fragmentów pliku z wierszy Storage.export_book_rows (czytanych po kawałku)"""
+    try:
+        yield from _export_chunks(rows, fmt)
+    finally:
+        rows.close()
+
+def _export_chunks(c, fmt):
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(BOOK_FILE_FIELDS)
+        for row in c:
+            writer.writerow(row)
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    elif fmt == 'jsonl':
+        for row in c:
+            yield json.dumps(dict(zip(BOOK_FILE_FIELDS, row)), ensure_ascii=False) + '\n'
+    else:
+        for title, author, available, isbn in c:
+            lines = ['=LDR  00000nam a2200000 a 4500']
+            if isbn:
+                lines.append('=020  \\\\$a%s' % isbn)
+            lines.append('=100  1\\$a%s' % author)
+            lines.append('=245  10$a%s' % title)
+            lines.append('=949  \\\\$c%d' % available)
+            yield '\n'.join(lines) + '\n\n'
+
+@app.cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(BOOK_FILE_FORMATS), default=None,
+              help='Domyślnie według rozszerzenia pliku')
+@click.option('--batch-size', type=int, default=None, help='Wierszy na transakcję')
+def import_books_command(path, fmt, batch_size):
+    """Import katalogu z pliku CSV/JSONL/MARC-lite (odrzucone wiersze na stderr)"""
+    start = time.perf_counter()
+    with open_storage() as storage, open(path, encoding='utf-8-sig', newline='') as f:
+        imported, rejected = import_books(
+            storage, f, book_file_format(path, fmt), batch_size,
+            lambda line_no, error: click.echo('linia %d: %s' % (line_no, error), err=True))
+    click.echo('Zapisano książek: %d, odrzucono: %d (%.2f s)'
+               % (imported, rejected, time.perf_counter() - start))
+
+@app.cli.command('export-books')
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(BOOK_FILE_FORMATS), default=None,
+              help='Domyślnie według rozszerzenia pliku')
+def export_books_command(path, fmt):
+    """Eksport katalogu do pliku CSV/JSONL/MARC-lite"""
+    with open_storage() as storage, open(path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in export_books(storage.export_book_rows(), book_file_format(path, fmt)):
+            f.write(chunk)
+    click.echo('Wyeksportowano do %s' % path)
+
+# Warstwa dostępu do danych: trasy korzystają wyłącznie z metod Storage, a SQL
+# konkretnej bazy jest w SQLiteStorage albo PostgresStorage (STORAGE_BACKEND)
+class DuplicateKeyError(Exception):
+    """Naruszenie unikalności (nazwa użytkownika, ISBN) niezależnie od bazy"""
+
+class Storage(ABC):
+    """Interfejs magazynu danych. Wiersze to krotki w kolejności kolumn tabel
+    (szablony odwołują się do pozycji), daty to sekundy epoki.
+
+    Reguły wypożyczeń, rezerwacji i kar są zapisane raz, tutaj, w SQL wspólnym dla
+    obu baz ({0} - znacznik parametru). Backend dostarcza połączenie, transakcję
+    zapisu (_write), blokady wierszy (_for_update, _lock_job) i zapytania zależne
+    od dialektu (wyszukiwanie, import, migracje).
+    """
+
+    param = '?'  # Znacznik parametru w SQL wspólnym dla obu baz
+    epoch_day_sql = EPOCH_DAY_SQL  # Dzień (data lokalna) z sekund epoki
+
+    def _sql(self, sql):
+        return sql.format(self.param)
+
+    @abstractmethod
+    def _write(self):
+        """Menedżer kontekstu transakcji zapisu zwracający kursor"""
+
+    @abstractmethod
+    def _one(self, sql, params=()):
+        """Pierwszy wiersz zapytania albo None"""
+
+    @abstractmethod
+    def _all(self, sql, params=()):
+        """Wszystkie wiersze zapytania"""
+
+    def _for_update(self, of=None, skip_locked=False):
+        """Klauzula blokady wierszy dla SELECT w transakcji zapisu. Pusta dla baz, które
+        jak SQLite (BEGIN IMMEDIATE) dopuszczają naraz tylko jednego zapisującego."""
+        return ''
+
+    def _lock_job(self, c, name):
+        """Nazwana blokada (PG_JOB_LOCKS) do końca transakcji - drugi równoległy przebieg czeka"""
+
+    def _lock_user(self, c, user_id):
+        """Blokuje wiersz użytkownika do końca transakcji (limity sprawdzane bez wyścigu);
+        False, jeśli użytkownika nie ma"""
+        c.execute(self._sql('SELECT id FROM users WHERE id = {0}') + self._for_update(), (user_id,))
+        return c.fetchone() is not None
+
+    def _lock_book(self, c, book_id):
+        """Blokuje wiersz książki - serializuje przydziały z jej kolejki i usunięcie"""
+        c.execute(self._sql('SELECT id FROM books WHERE id = {0}') + self._for_update(), (book_id,))
+        return c.fetchone() is not None
+
+    def _log_event(self, c, created, event, borrow_id, user_id, book_id=None, amount=None,
+                   due_date=None, actor_id=None):
+        """Zdarzenie dziennika wypożyczeń w bieżącej transakcji zapisu (CIRCULATION_LOG_MODE)"""
+        mode = app.config['CIRCULATION_LOG_MODE']
+        if not mode:
+            return
+        event = (created, event, borrow_id, user_id, book_id, amount, due_date, actor_id)
+        if mode == 'sync':
+            c.execute(CIRCULATION_EVENT_SQL.format(self.param), event)
+        self._pending_events.append(event)
+
+    def _publish_events(self):
+        """Po zatwierdzeniu transakcji: w trybie 'batched' zdarzenia trafiają do kolejki zapisu"""
+        events, self._pending_events = self._pending_events, []
+        if not events:
+            return
+        if app.config['CIRCULATION_LOG_MODE'] == 'batched':
+            get_circulation_log().enqueue(events)
+        else:
+            metrics.inc('libraryhub_circulation_events_total', {'mode': 'sync'}, len(events))
+
+    @abstractmethod
+    def migrate(self):
+        """Stosuje brakujące migracje schematu; numer wersji"""
+
+    # Książki
+    @abstractmethod
+    def search_books(self, search):
+        """Wyszukiwanie pełnotekstowe (lub po ISBN) z rankingiem"""
+
+    @abstractmethod
+    def books_page(self, after, limit):
+        """Strona katalogu po (tytuł, id): limit + 1 wierszy, może być leniwym iteratorem"""
+
+    @abstractmethod
+    def get_book(self, book_id):
+        """Wiersz książki albo None"""
+
+    def book_count(self):
+        return self._one('SELECT COUNT(*) FROM books')[0]
+
+    @abstractmethod
+    def isbn_taken(self, isbn, exclude_id=None):
+        """Czy inna książka ma ten ISBN"""
+
+    def _log_stock_changes(self, c, before, after, now, actor_id=None):
+        """Zdarzenia 'adjust' dla zmiany katalogu w bieżącej transakcji: before/after - {id książki:
+        available} sprzed i po niej. Wypożyczenia i odłożone egzemplarze stoją wtedy w miejscu,
+        więc różnica available to zmiana liczby posiadanych egzemplarzy."""
+        for book_id, available in after.items():
+            delta = available - before.get(book_id, 0)
+            if delta:
+                self._log_event(c, now, 'adjust', CATALOG_EVENT_ID, None, book_id, delta, actor_id=actor_id)
+
+    def add_book(self, title, author, available, isbn, actor_id=None):
+        now = int(time.time())
+        with self._write() as c:
+            c.execute(self._sql('''INSERT INTO books (title, author, added_date, available, last_edited, isbn)
+                                   VALUES ({0}, {0}, {0}, {0}, {0}, {0}) RETURNING id'''),
                       (title, author, now, available, now, isbn))
+            self._log_stock_changes(c, {}, {c.fetchone()[0]: available}, now, actor_id)
 
-    conn.commit()
-    conn.close()
+    def update_book(self, book_id, title, author, available, isbn, actor_id=None):
+        now = int(time.time())
+        with self._write() as c:
+            c.execute(self._sql('SELECT available FROM books WHERE id = {0}') + self._for_update(), (book_id,))
+            book = c.fetchone()
+            if book is None:
+                return
+            c.execute(self._sql('''UPDATE books SET title = {0}, author = {0}, available = {0}, last_edited = {0},
+                                                    isbn = {0}, version = version + 1 WHERE id = {0}'''),
+                      (title, author, available, now, isbn, book_id))
+            self._log_stock_changes(c, {book_id: book[0]}, {book_id: available}, now, actor_id)
+            self._allocate_holds(c, book_id, now)
+
+    def delete_book(self, book_id, actor_id=None):
+        """False, jeśli książka jest wypożyczona"""
+        with self._write() as c:
+            # Równoległe wypożyczenie czeka na blokadę albo nie znajdzie już książki
+            self._lock_book(c, book_id)
+            c.execute(self._sql('SELECT COUNT(*) FROM borrows WHERE book_id = {0} AND returned = 0'), (book_id,))
+            if c.fetchone()[0] > 0:
+                return False
+            # Z książką znikają wolne egzemplarze i odłożone dla anulowanych niżej rezerwacji
+            c.execute(self._sql('''SELECT available + (SELECT COUNT(*) FROM reservations
+                                                       WHERE book_id = {0} AND status = 'ready')
+                                   FROM books WHERE id = {0}'''), (book_id, book_id))
+            copies = c.fetchone()
+            if copies is not None:
+                self._log_stock_changes(c, {book_id: copies[0]}, {book_id: 0}, int(time.time()), actor_id)
+            c.execute(self._sql('DELETE FROM books WHERE id = {0}'), (book_id,))
+            c.execute(self._sql('''UPDATE reservations SET status = 'cancelled'
+                                   WHERE book_id = {0} AND status IN ('waiting', 'ready')'''), (book_id,))
+        return True
+
+    @abstractmethod
+    def popular_books(self, days):
+        """Ranking 20 najczęściej wypożyczanych książek (days=None - cała historia)"""
+
+    @abstractmethod
+    def import_book_batch(self, batch, actor_id=None):
+        """Krotki (tytuł, autor, dodano, egzemplarze, edytowano, isbn); istniejący ISBN jest aktualizowany,
+        a wiersz bez ISBN - książka bez ISBN o tym samym tytule i autorze. Zmiany liczby egzemplarzy
+        trafiają do dziennika jako 'adjust'."""
+
+    @abstractmethod
+    def export_book_rows(self):
+        """Iterator (tytuł, autor, egzemplarze, isbn) z metodą close()"""
+
+    # Użytkownicy
+    def get_user(self, user_id):
+        """(id, nazwa, admin) albo None"""
+        return self._one(self._sql('SELECT id, username, is_admin FROM users WHERE id = {0}'), (user_id,))
+
+    def get_user_by_name(self, username):
+        """(id, nazwa, hash hasła, admin) albo None"""
+        return self._one(self._sql('SELECT id, username, password, is_admin FROM users WHERE username = {0}'),
+                         (username,))
+
+    def user_count(self):
+        return self._one('SELECT COUNT(*) FROM users')[0]
+
+    def add_user(self, username, password_hash, is_admin=False):
+        with self._write() as c:
+            c.execute(self._sql('INSERT INTO users (username, password, is_admin) VALUES ({0}, {0}, {0})'),
+                      (username, password_hash, int(is_admin)))
+
+    def update_user(self, user_id, username, is_admin, password_hash=None):
+        with self._write() as c:
+            if password_hash:
+                c.execute(self._sql('UPDATE users SET username = {0}, password = {0}, is_admin = {0} WHERE id = {0}'),
+                          (username, password_hash, int(is_admin), user_id))
+            else:
+                c.execute(self._sql('UPDATE users SET username = {0}, is_admin = {0} WHERE id = {0}'),
+                          (username, int(is_admin), user_id))
+
+    def set_password(self, user_id, password_hash, old_hash=None):
+        """Z old_hash zmienia hasło tylko, jeśli nikt go w międzyczasie nie zmienił"""
+        with self._write() as c:
+            if old_hash is None:
+                c.execute(self._sql('UPDATE users SET password = {0} WHERE id = {0}'), (password_hash, user_id))
+            else:
+                c.execute(self._sql('UPDATE users SET password = {0} WHERE id = {0} AND password = {0}'),
+                          (password_hash, user_id, old_hash))
+
+    def delete_user(self, user_id):
+        """False, jeśli użytkownik ma aktywne wypożyczenia"""
+        with self._write() as c:
+            # Ta sama blokada co w borrow_book - w międzyczasie nie powstanie nowe wypożyczenie
+            self._lock_user(c, user_id)
+            c.execute(self._sql('SELECT COUNT(*) FROM borrows WHERE user_id = {0} AND returned = 0'), (user_id,))
+            if c.fetchone()[0] > 0:
+                return False
+            c.execute(self._sql('DELETE FROM users WHERE id = {0}'), (user_id,))
+            c.execute(self._sql("SELECT id FROM reservations WHERE user_id = {0} AND status IN ('waiting', 'ready')"),
+                      (user_id,))
+            for (reservation_id,) in c.fetchall():
+                self._cancel_reservation(c, reservation_id, user_id)
+        return True
+
+    def users_with_active_borrows(self):
+        return self._all('''
+            SELECT u.id, u.username, u.is_admin,
+                   COALESCE(COUNT(b.id), 0) as active_borrows
+            FROM users u
+            LEFT JOIN borrows b ON u.id = b.user_id AND b.returned = 0
+            GROUP BY u.id, u.username, u.is_admin
+            ORDER BY u.username
+        ''')
+
+    # Wypożyczenia
+    def borrowed_book_ids(self, user_id):
+        return [row[0] for row in self._all(
+            self._sql('SELECT book_id FROM borrows WHERE user_id = {0} AND returned = 0'), (user_id,))]
+
+    def active_loans(self, user_id):
+        """[(id wypożyczenia, termin zwrotu)] niezwróconych książek"""
+        return self._all(self._sql('SELECT id, return_date FROM borrows WHERE user_id = {0} AND returned = 0'),
+                         (user_id,))
+
+    def borrow_book(self, user_id, book_id):
+        now = int(time.time())
+        with self._write() as c:
+            # W READ COMMITTED limit sprawdzony przez dwie równoległe transakcje mógłby zostać
+            # przekroczony - blokada wiersza użytkownika serializuje jego wypożyczenia
+            if not self._lock_user(c, user_id):
+                return False
+            # Limit i ponowne wypożyczenie tej samej książki jednym zapytaniem (indeks częściowy)
+            c.execute(self._sql('''SELECT COUNT(*), COUNT(*) FILTER (WHERE book_id = {0})
+                                   FROM borrows WHERE user_id = {0} AND returned = 0'''), (book_id, user_id))
+            active_count, already_borrowed = c.fetchone()
+            if active_count >= MAX_BORROWS_PER_USER or already_borrowed:
+                return False
+
+            # Egzemplarz odłożony dla gotowej rezerwacji nie jest już liczony w available
+            c.execute(self._sql('''UPDATE reservations SET status = 'fulfilled'
+                                   WHERE user_id = {0} AND status = 'ready' AND book_id = {0}
+                                     AND expires_date > {0}'''), (user_id, book_id, now))
+            if c.rowcount == 1:
+                c.execute(self._sql('UPDATE books SET borrow_count = borrow_count + 1 WHERE id = {0}'), (book_id,))
+            else:
+                # Warunkowe zmniejszenie - ostatni egzemplarz może zabrać tylko jedna transakcja
+                c.execute(self._sql('''UPDATE books SET available = available - 1, borrow_count = borrow_count + 1,
+                                                        version = version + 1
+                                       WHERE id = {0} AND available > 0'''), (book_id,))
+                if c.rowcount != 1:
+                    return False
+                # Czekający w kolejce, który trafił na wolny egzemplarz, opuszcza kolejkę
+                c.execute(self._sql('''UPDATE reservations SET status = 'fulfilled'
+                                       WHERE user_id = {0} AND status = 'waiting' AND book_id = {0}
+                                       RETURNING queue_seq'''),
+                          (user_id, book_id))
+                left = c.fetchone()
+                if left is not None:
+                    self._leave_queue(c, book_id, left[0])
+
+            c.execute(self._sql('''INSERT INTO borrows (user_id, book_id, borrow_date, return_date, returned, fine_amount)
+                                   VALUES ({0}, {0}, {0}, {0}, 0, 0) RETURNING id'''),
+                      (user_id, book_id, now, now + LOAN_DAYS * DAY))
+            borrow_id = c.fetchone()[0]
+            # Dzienne liczniki popularności w tej samej transakcji
+            c.execute(self._sql('''INSERT INTO book_daily_borrows (day, book_id, borrows) VALUES ({0}, {0}, 1)
+                                   ON CONFLICT (day, book_id) DO UPDATE SET borrows = book_daily_borrows.borrows + 1'''),
+                      (date.fromtimestamp(now).isoformat(), book_id))
+            prune_daily_borrows(c, now, self.param)
+            self._log_event(c, now, 'borrow', borrow_id, user_id, book_id, due_date=now + LOAN_DAYS * DAY)
+        return True
+
+    def _close_borrow(self, c, borrow_id, user_id, book_id, due_date, now, actor_id=None):
+        """Zwraca wypożyczenie (wiersz zablokowany przez _for_update) w bieżącej transakcji zapisu,
+        nalicza karę i zapisuje zdarzenie 'return'. False, jeśli wypożyczenie zostało już zamknięte."""
+        fine = calculate_fine(due_date, now)
+        c.execute(self._sql('''UPDATE borrows SET returned = 1, return_date = {0}, fine_amount = {0}
+                               WHERE id = {0} AND returned = 0'''), (now, fine, borrow_id))
+        if c.rowcount != 1:
+            return False
+        self._release_hold(c, book_id, now)
+
+        # Dodanie kary jeśli istnieje (mogła już zostać naliczona przez accrue_fines)
+        if fine > 0:
+            c.execute(self._sql('''INSERT INTO fines (borrow_id, user_id, amount, calculated_date, paid)
+                                   VALUES ({0}, {0}, {0}, {0}, 0)
+                                   ON CONFLICT (borrow_id) DO UPDATE SET amount = excluded.amount,
+                                                                         calculated_date = excluded.calculated_date
+                                   WHERE fines.paid = 0'''), (borrow_id, user_id, fine, now))
+        self._log_event(c, now, 'return', borrow_id, user_id, book_id, fine, actor_id=actor_id)
+        return True
+
+    def return_book(self, user_id, book_id):
+        now = int(time.time())
+        with self._write() as c:
+            c.execute(self._sql('''SELECT id, return_date FROM borrows
+                                   WHERE user_id = {0} AND book_id = {0} AND returned = 0''') + self._for_update(),
+                      (user_id, book_id))
+            borrow = c.fetchone()
+            return borrow is not None and self._close_borrow(c, borrow[0], user_id, book_id, borrow[1], now)
+
+    def return_book_by_title(self, user_id, title, actor_id=None):
+        """Id zwróconej książki albo None; actor_id - administrator (zapisany w zdarzeniu 'return')"""
+        now = int(time.time())
+        with self._write() as c:
+            c.execute(self._sql('''SELECT br.id, br.return_date, br.book_id
+                                   FROM borrows br
+                                   JOIN books b ON br.book_id = b.id
+                                   WHERE br.user_id = {0} AND b.title = {0} AND br.returned = 0
+                                   LIMIT 1''') + self._for_update(of='br'), (user_id, title))
+            borrow = c.fetchone()
+            if borrow is not None and self._close_borrow(c, borrow[0], user_id, borrow[2], borrow[1], now, actor_id):
+                return borrow[2]
+        return None
+
+    def profile(self, user_id, before=None, limit=None):
+        """Dane strony profilu jednym zapytaniem (PROFILE_SQL): (wypożyczenia, liczba aktywnych,
+        nieopłacone kary, kursor następnej strony historii)"""
+        limit = limit or app.config['PROFILE_PAGE_SIZE']
+        now = int(time.time())
+        rows = self._all(self._sql(PROFILE_SQL),
+                         (user_id, user_id, now, now, user_id, before is None, user_id,
+                          before[0] if before else 2 ** 63 - 1, before[1] if before else 2 ** 63 - 1, limit + 1))
+        return profile_from_rows(rows, limit)
+
+    def rebuild_popularity(self):
+        with self._write() as c:
+            rebuild_popularity(c, self.param, self.epoch_day_sql)
+
+    # Kary
+    def unpaid_fines(self):
+        return self._all('''
+            SELECT f.id, u.username, b.title, f.amount, f.calculated_date, f.paid, br.id, br.borrow_date
+            FROM fines f
+            JOIN users u ON f.user_id = u.id
+            JOIN borrows br ON f.borrow_id = br.id
+            JOIN books b ON br.book_id = b.id
+            WHERE f.paid = 0
+            ORDER BY f.calculated_date DESC
+        ''')
+
+    def pay_fine(self, borrow_id, actor_id=None):
+        """(id użytkownika, id książki), jeśli opłacenie zamknęło wypożyczenie, inaczej None"""
+        now = int(time.time())
+        closed = None
+        with self._write() as c:
+            # Oznacz karę jako zapłaconą
+            c.execute(self._sql('UPDATE fines SET paid = 1 WHERE borrow_id = {0} AND paid = 0 RETURNING user_id, amount'),
+                      (borrow_id,))
+            fine = c.fetchone()
+            # Zwróć książkę jeśli jeszcze nie została zwrócona
+            c.execute(self._sql('''UPDATE borrows SET returned = 1, return_date = {0}
+                                   WHERE id = {0} AND returned = 0 RETURNING user_id, book_id'''), (now, borrow_id))
+            borrow = c.fetchone()
+            if borrow:
+                self._release_hold(c, borrow[1], now)
+                closed = tuple(borrow)
+            if fine or closed:
+                self._log_event(c, now, 'payment', borrow_id, (fine or closed)[0], closed and closed[1],
+                                fine and fine[1], actor_id=actor_id)
+        return closed
+
+    def _job_state(self, c, name):
+        c.execute(self._sql('SELECT value FROM job_state WHERE name = {0}'), (name,))
+        row = c.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_job_state(self, c, name, value):
+        if value is None:
+            c.execute(self._sql('DELETE FROM job_state WHERE name = {0}'), (name,))
+        else:
+            c.execute(self._sql('''INSERT INTO job_state (name, value) VALUES ({0}, {0})
+                                   ON CONFLICT (name) DO UPDATE SET value = excluded.value'''),
+                      (name, json.dumps(value)))
+
+    def accrue_fines(self, batch_size=None, restart=False):
+        """Nalicza kary wszystkim przeterminowanym, niezwróconym wypożyczeniom.
+
+        Kwoty liczone są w SQL partiami po batch_size wypożyczeń w kolejności
+        (return_date, id) z indeksu idx_borrows_active_due. Po każdej partii punkt kontrolny
+        trafia do job_state w tej samej transakcji, więc przerwany przebieg jest wznawiany
+        od miejsca przerwania z tym samym momentem odniesienia. Zwraca liczbę zmienionych kar.
+        """
+        batch_size = batch_size or app.config['FINE_ACCRUAL_BATCH_SIZE']
+        changed = 0
+        while True:
+            with self._write() as c:
+                # Drugi równoległy przebieg (inny węzeł) czeka, zamiast liczyć te same partie
+                self._lock_job(c, 'fine_accrual')
+                run = None if restart else self._job_state(c, 'fine_accrual')
+                restart = False
+                if run is None:
+                    now = int(time.time())
+                    # Kara należy się od pierwszego pełnego dnia spóźnienia
+                    run = {'now': now, 'cutoff': now - DAY, 'after': [0, 0]}
+
+                # Koniec bieżącej partii
+                c.execute(self._sql('''SELECT return_date, id FROM borrows
+                                       WHERE returned = 0 AND return_date <= {0} AND (return_date, id) > ({0}, {0})
+                                       ORDER BY return_date, id LIMIT 1 OFFSET {0}'''),
+                          (run['cutoff'], run['after'][0], run['after'][1], batch_size - 1))
+                batch_end = c.fetchone()
+                # Ostatnia partia: górna granica to maksymalny możliwy id
+                upper = list(batch_end) if batch_end else [run['cutoff'], 2 ** 63 - 1]
+
+                c.execute(self._sql('''INSERT INTO fines (borrow_id, user_id, amount, calculated_date, paid)
+                                       SELECT id, user_id, (({0} - return_date) / {0}) * {0}, {0}, 0
+                                       FROM borrows
+                                       WHERE returned = 0 AND return_date <= {0}
+                                         AND (return_date, id) > ({0}, {0}) AND (return_date, id) <= ({0}, {0})
+                                       ON CONFLICT (borrow_id) DO UPDATE SET amount = excluded.amount,
+                                                                             calculated_date = excluded.calculated_date
+                                       WHERE fines.paid = 0 AND fines.amount != excluded.amount'''),
+                          (run['now'], DAY, FINE_PER_DAY, run['now'], run['cutoff'],
+                           run['after'][0], run['after'][1], upper[0], upper[1]))
+                changed += c.rowcount
+                if app.config['CIRCULATION_LOG_MODE']:
+                    # Zadanie i tak działa partiami - zdarzenia idą w tej samej transakcji
+                    c.execute(self._sql(ACCRUED_FINE_EVENTS_SQL),
+                              (run['cutoff'], run['after'][0], run['after'][1], upper[0], upper[1], run['now']))
+
+                if batch_end is None:
+                    self._set_job_state(c, 'fine_accrual', None)
+                    self._set_job_state(c, 'fine_accrual_last_run', run['now'])
+                    break
+                run['after'] = upper
+                self._set_job_state(c, 'fine_accrual', run)
+        if changed:
+            invalidate_cache('users')
+        return changed
+
+    # Rezerwacje: kolejka FIFO na książkę (po id), indeks (book_id, status, id) daje głowę
+    # kolejki jednym odczytem niezależnie od jej długości. Zwrócony egzemplarz trafia do
+    # pierwszej osoby w kolejce jako 'ready' (nie wraca do available) na HOLD_DAYS dni.
+    def _allocate_holds(self, c, book_id, now):
+        """Przydziela wolne egzemplarze książki kolejnym osobom z kolejki w bieżącej transakcji zapisu.
+        Zwraca liczbę przydzielonych egzemplarzy."""
+        self._lock_book(c, book_id)
+        allocated = 0
+        while True:
+            c.execute(self._sql('''SELECT id FROM reservations WHERE book_id = {0} AND status = 'waiting'
+                                   ORDER BY id LIMIT 1'''), (book_id,))
+            head = c.fetchone()
+            if head is None:
+                return allocated
+            c.execute(self._sql('''UPDATE books SET available = available - 1, version = version + 1
+                                   WHERE id = {0} AND available > 0'''), (book_id,))
+            if c.rowcount != 1:
+                return allocated
+            c.execute(self._sql("UPDATE reservations SET status = 'ready', expires_date = {0} WHERE id = {0}"),
+                      (now + HOLD_DAYS * DAY, head[0]))
+            allocated += 1
+
+    def _leave_queue(self, c, book_id, queue_seq):
+        """Czekający opuścił kolejkę przed jej początkiem - osoby za nim przesuwają się o jedno
+        miejsce. Wywoływane pod blokadą książki, jak przydział i dopisanie do kolejki."""
+        c.execute(self._sql('''UPDATE reservations SET queue_seq = queue_seq - 1
+                               WHERE book_id = {0} AND status = 'waiting' AND queue_seq > {0}'''),
+                  (book_id, queue_seq))
+
+    def _release_hold(self, c, book_id, now):
+        """Zwolniony egzemplarz (zwrot, anulowana lub wygasła rezerwacja) trafia do pierwszej osoby
+        z kolejki, a bez kolejki do available"""
+        c.execute(self._sql('UPDATE books SET available = available + 1, version = version + 1 WHERE id = {0}'),
+                  (book_id,))
+        self._allocate_holds(c, book_id, now)
+
+    def reserve_book(self, user_id, book_id):
+        """Dopisuje użytkownika na koniec kolejki. 'waiting' / 'ready' (egzemplarz był od razu wolny)
+        albo None (brak książki, już wypożyczona lub zarezerwowana, limit)"""
+        with self._write() as c:
+            # Blokada użytkownika jak w borrow_book - limit i duplikaty sprawdzane bez wyścigu
+            if not self._lock_user(c, user_id):
+                return None
+            c.execute(self._sql('''SELECT EXISTS (SELECT 1 FROM books WHERE id = {0}),
+                                          EXISTS (SELECT 1 FROM borrows
+                                                  WHERE user_id = {0} AND book_id = {0} AND returned = 0),
+                                          COUNT(*), COUNT(*) FILTER (WHERE book_id = {0})
+                                   FROM reservations WHERE user_id = {0} AND status IN ('waiting', 'ready')'''),
+                      (book_id, user_id, book_id, book_id, user_id))
+            book_exists, borrowed, active_count, already_reserved = c.fetchone()
+            if not book_exists or borrowed or already_reserved or active_count >= MAX_RESERVATIONS_PER_USER:
+                return None
+            now = int(time.time())
+            # Kolejny numer w kolejce książki bez wyścigu z równoległą rezerwacją
+            self._lock_book(c, book_id)
+            c.execute(self._sql('''INSERT INTO reservations (user_id, book_id, created_date, status, queue_seq)
+                                   SELECT {0}, {0}, {0}, 'waiting', COALESCE(MAX(queue_seq), 0) + 1
+                                   FROM reservations WHERE book_id = {0} AND status = 'waiting'
+                                   RETURNING id'''), (user_id, book_id, now, book_id))
+            reservation_id = c.fetchone()[0]
+            self._allocate_holds(c, book_id, now)
+            c.execute(self._sql('SELECT status FROM reservations WHERE id = {0}'), (reservation_id,))
+            return c.fetchone()[0]
+
+    def _cancel_reservation(self, c, reservation_id, user_id):
+        # Najpierw książka, potem rezerwacja - w tej kolejności blokuje je _allocate_holds
+        c.execute(self._sql('SELECT book_id FROM reservations WHERE id = {0}'), (reservation_id,))
+        book = c.fetchone()
+        if book is None:
+            return None
+        self._lock_book(c, book[0])
+        c.execute(self._sql('''SELECT book_id, status, queue_seq FROM reservations
+                               WHERE id = {0} AND user_id = {0} AND status IN ('waiting', 'ready')''')
+                  + self._for_update(), (reservation_id, user_id))
+        reservation = c.fetchone()
+        if reservation is None:
+            return None
+        c.execute(self._sql("UPDATE reservations SET status = 'cancelled' WHERE id = {0}"), (reservation_id,))
+        if reservation[1] == 'ready':
+            self._release_hold(c, reservation[0], int(time.time()))
+        else:
+            self._leave_queue(c, reservation[0], reservation[2])
+        return reservation[0]
+
+    def cancel_reservation(self, user_id, reservation_id):
+        """Anuluje rezerwację użytkownika; odłożony egzemplarz przechodzi dalej. Id książki albo None."""
+        with self._write() as c:
+            return self._cancel_reservation(c, reservation_id, user_id)
+
+    def user_reservations(self, user_id):
+        """[(id, id książki, tytuł, status, miejsce w kolejce lub None, termin odbioru lub None)]"""
+        return self._all(self._sql(USER_RESERVATIONS_SQL), (user_id,))
+
+    def expire_holds(self, batch_size=None):
+        """Wygasza nieodebrane rezerwacje (partiami, po indeksie idx_reservations_ready_expiry;
+        SKIP LOCKED pozwala kilku węzłom PostgreSQL dzielić się pracą); ich egzemplarze przechodzą
+        do kolejnych osób. Na końcu przydziela egzemplarze kolejkom książek, które mają wolne
+        sztuki (np. po zmianie liczby egzemplarzy bezpośrednio w bazie). Zwraca liczbę wygaszonych."""
+        batch_size = batch_size or app.config['HOLD_EXPIRY_BATCH_SIZE']
+        now = int(time.time())
+        expired = 0
+        while True:
+            with self._write() as c:
+                c.execute(self._sql('''SELECT id, book_id FROM reservations WHERE status = 'ready' AND expires_date <= {0}
+                                       ORDER BY expires_date LIMIT {0}''') + self._for_update(skip_locked=True),
+                          (now, batch_size))
+                batch = c.fetchall()
+                for reservation_id, book_id in batch:
+                    c.execute(self._sql("UPDATE reservations SET status = 'expired' WHERE id = {0} AND status = 'ready'"),
+                              (reservation_id,))
+                    if c.rowcount == 1:
+                        self._release_hold(c, book_id, now)
+                        expired += 1
+            if len(batch) < batch_size:
+                break
+        with self._write() as c:
+            c.execute('''SELECT DISTINCT r.book_id FROM reservations r JOIN books b ON b.id = r.book_id
+                         WHERE r.status = 'waiting' AND b.available > 0''')
+            allocated = sum(self._allocate_holds(c, book_id, now) for (book_id,) in c.fetchall())
+        if expired or allocated:
+            invalidate_cache('catalog')
+        return expired
+
+    # Dziennik wypożyczeń
+    @abstractmethod
+    def append_circulation_events(self, events):
+        """Partia zdarzeń z kolejki CirculationLog jedną transakcją"""
+
+    @abstractmethod
+    def circulation_events(self):
+        """Iterator zdarzeń w kolejności CIRCULATION_REPLAY_SQL z metodą close()"""
+
+    @abstractmethod
+    def replay_circulation(self, rows, stock, apply=False):
+        """Porównuje wiersze z replayed_rows z tabelami borrows i fines, a egzemplarze z dziennika
+        (stock, wypełniane przez replayed_rows) z available; z apply zastępuje stanem z dziennika
+        tabele borrows i fines oraz niezgodne available. Zwraca (odtworzonych wypożyczeń, różnych
+        wypożyczeń, różnych kar, książek z innym available)."""
+
+    # Zdarzenia /events wspólne dla procesów (DatabaseEventBroker)
+    def append_live_event(self, event, data, user_id=None):
+        """Dopisuje zdarzenie (data - JSON) i usuwa starsze niż ostatnie LIVE_EVENTS_KEPT; id zdarzenia"""
+        with self._write() as c:
+            # Id zatwierdzane w kolejności nadania - czytający po id nie pominie późniejszego zatwierdzenia
+            self._lock_job(c, 'live_events')
+            c.execute(self._sql('INSERT INTO live_events (event, data, user_id) VALUES ({0}, {0}, {0}) RETURNING id'),
+                      (event, data, user_id))
+            event_id = c.fetchone()[0]
+            c.execute(self._sql('DELETE FROM live_events WHERE id <= {0}'), (event_id - LIVE_EVENTS_KEPT,))
+        return event_id
+
+    def live_events(self, after, until=None, limit=1000):
+        """[(id, zdarzenie, dane JSON, id użytkownika lub None)] o id z (after, until] w kolejności id"""
+        return self._all(self._sql('''SELECT id, event, data, user_id FROM live_events
+                                      WHERE id > {0} AND id <= {0} ORDER BY id LIMIT {0}'''),
+                         (after, 2 ** 63 - 1 if until is None else until, limit))
+
+    def last_live_event_id(self):
+        return self._one('SELECT COALESCE(MAX(id), 0) FROM live_events')[0]
+
+class SQLiteStorage(Storage):
+    """Plik SQLite (DATABASE): FTS5, migracje w PRAGMA user_version, jeden zapisujący naraz"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._pending_events = []
+
+    @contextmanager
+    def _write(self):
+        try:
+            with write_transaction(self.conn) as c:
+                yield c
+        except BaseException as e:
+            self._pending_events = []
+            if isinstance(e, sqlite3.IntegrityError):
+                raise DuplicateKeyError(str(e)) from e
+            raise
+        self._publish_events()
+
+    def _one(self, sql, params=()):
+        return self.conn.execute(sql, params).fetchone()
+
+    def _all(self, sql, params=()):
+        return self.conn.execute(sql, params).fetchall()
+
+    def migrate(self):
+        # WAL jest zapisywany w pliku bazy - czytelnicy przestają czekać na zapisy
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        return migrate_db(self.conn)
+
+    def search_books(self, search):
+        return search_books(self.conn.cursor(), search)
+
+    def books_page(self, after, limit):
+        return query_books_page(self.conn.cursor(), after, limit)
+
+    def get_book(self, book_id):
+        return self._one('SELECT * FROM books WHERE id = ?', (book_id,))
+
+    def isbn_taken(self, isbn, exclude_id=None):
+        return self._one('SELECT id FROM books WHERE isbn = ? AND id IS NOT ?', (isbn, exclude_id)) is not None
+
+    def popular_books(self, days):
+        return load_popular(self.conn.cursor(), days)
+
+    def import_book_batch(self, batch, actor_id=None):
+        # Wyzwalacze FTS działają wiersz po wierszu i dominują w czasie importu, więc
+        # na czas partii są usuwane, a books_fts aktualizowane zbiorczo. DDL jest częścią
+        # transakcji (BEGIN IMMEDIATE), więc inne połączenia nigdy nie widzą bazy bez nich.
+        with self._write() as c:
+            c.execute('''CREATE TEMP TABLE IF NOT EXISTS import_batch
+                         (seq INTEGER PRIMARY KEY, title TEXT, author TEXT, added_date INTEGER,
+                          available INTEGER, last_edited INTEGER, isbn TEXT, book_id INTEGER)''')
+            c.execute('DELETE FROM temp.import_batch')
+            c.executemany('''INSERT INTO temp.import_batch (title, author, added_date, available, last_edited, isbn)
+                             VALUES (?, ?, ?, ?, ?, ?)''', batch)
+            # Bez ISBN książkę rozpoznaje para (tytuł, autor) wśród książek bez ISBN -
+            # ponowny import eksportu nie tworzy duplikatów; w partii wygrywa ostatni wiersz
+            c.execute('''DELETE FROM temp.import_batch WHERE isbn IS NULL AND seq NOT IN
+                             (SELECT MAX(seq) FROM temp.import_batch WHERE isbn IS NULL GROUP BY title, author)''')
+            c.execute('''UPDATE temp.import_batch SET book_id =
+                             (SELECT MIN(b.id) FROM books b WHERE b.isbn IS NULL
+                              AND b.title = import_batch.title AND b.author = import_batch.author)
+                         WHERE isbn IS NULL''')
+            # Jedyny zapisujący - nowe książki to id powyżej max_id
+            c.execute('SELECT COALESCE(MAX(id), 0) FROM books')
+            max_id = c.fetchone()[0]
+            matched_sql = '''SELECT id, available FROM books WHERE id IN (SELECT book_id FROM temp.import_batch)
+                             OR isbn IN (SELECT isbn FROM temp.import_batch) OR id > ?'''
+            before = dict(c.execute(matched_sql, (max_id,)).fetchall())
+            c.execute('''UPDATE books SET last_edited = i.last_edited, version = books.version + 1,
+                             available = MAX(0, i.available - (SELECT COUNT(*) FROM borrows
+                                 WHERE borrows.book_id = books.id AND borrows.returned = 0)
+                                 - (SELECT COUNT(*) FROM reservations r
+                                    WHERE r.book_id = books.id AND r.status = 'ready'))
+                         FROM temp.import_batch i WHERE i.book_id = books.id''')
+            for trigger in ('books_fts_insert', 'books_fts_update'):
+                c.execute('DROP TRIGGER %s' % trigger)
+            c.execute('''INSERT INTO books_fts (books_fts, rowid, title, author)
+                         SELECT 'delete', id, %s, %s FROM books
+                         WHERE isbn IN (SELECT isbn FROM temp.import_batch)'''
+                      % (FTS_FOLD_SQL.format('title'), FTS_FOLD_SQL.format('author')))
+            c.execute('''INSERT INTO books (title, author, added_date, available, last_edited, isbn)
+                         SELECT title, author, added_date, available, last_edited, isbn
+                         FROM temp.import_batch WHERE book_id IS NULL ORDER BY seq
+                         ON CONFLICT (isbn) DO UPDATE SET
+                             title = excluded.title, author = excluded.author,
+                             last_edited = excluded.last_edited, version = books.version + 1,
+                             available = MAX(0, excluded.available - (SELECT COUNT(*) FROM borrows
+                                 WHERE borrows.book_id = books.id AND borrows.returned = 0)
+                                 - (SELECT COUNT(*) FROM reservations r
+                                    WHERE r.book_id = books.id AND r.status = 'ready'))''')
+            c.execute('''INSERT INTO books_fts (rowid, title, author)
+                         SELECT id, %s, %s FROM books
+                         WHERE id > ? OR isbn IN (SELECT isbn FROM temp.import_batch)'''
+                      % (FTS_FOLD_SQL.format('title'), FTS_FOLD_SQL.format('author')), (max_id,))
+            _create_books_fts_triggers(c)
+            now = int(time.time())
+            self._log_stock_changes(c, before, dict(c.execute(matched_sql, (max_id,)).fetchall()), now, actor_id)
+            # Czekająca kolejka przy wolnych egzemplarzach = import zwiększył ich liczbę
+            c.execute('''SELECT DISTINCT r.book_id FROM reservations r JOIN books b ON b.id = r.book_id
+                         WHERE r.status = 'waiting' AND b.available > 0
+                         AND (b.isbn IN (SELECT isbn FROM temp.import_batch)
+                              OR b.id IN (SELECT book_id FROM temp.import_batch))''')
+            for (book_id,) in c.fetchall():
+                self._allocate_holds(c, book_id, now)
+
+    def export_book_rows(self):
+        return self.conn.execute('''SELECT b.title, b.author,
+                                           b.available + (SELECT COUNT(*) FROM borrows br
+                                                          WHERE br.book_id = b.id AND br.returned = 0)
+                                           + (SELECT COUNT(*) FROM reservations r
+                                              WHERE r.book_id = b.id AND r.status = 'ready'),
+                                           b.isbn
+                                    FROM books b ORDER BY b.id''')
+
+    def append_circulation_events(self, events):
+        with write_transaction(self.conn) as c:
+            c.executemany(CIRCULATION_EVENT_SQL.format('?'), events)
+
+    def circulation_events(self):
+        return self.conn.execute(CIRCULATION_REPLAY_SQL)
+
+    def replay_circulation(self, rows, stock, apply=False):
+        # Odtworzony stan w tabelach tymczasowych - zapisy do nich nie blokują bazy
+        c = self.conn.cursor()
+        c.execute('DROP TABLE IF EXISTS temp.replay_borrows')
+        c.execute('DROP TABLE IF EXISTS temp.replay_fines')
+        c.execute('DROP TABLE IF EXISTS temp.replay_stock')
+        c.execute('''CREATE TEMP TABLE replay_borrows
+                     (id INTEGER PRIMARY KEY, user_id INTEGER, book_id INTEGER, borrow_date INTEGER,
+                      return_date INTEGER, returned INTEGER, fine_amount REAL)''')
+        c.execute('''CREATE TEMP TABLE replay_fines
+                     (borrow_id INTEGER PRIMARY KEY, user_id INTEGER, amount REAL,
+                      calculated_date INTEGER, paid INTEGER)''')
+        replayed = 0
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, app.config['IMPORT_BATCH_SIZE']))
+            if not batch:
+                break
+            c.executemany('INSERT INTO temp.replay_borrows VALUES (?, ?, ?, ?, ?, ?, ?)', [b for b, f in batch])
+            c.executemany('INSERT INTO temp.replay_fines VALUES (?, ?, ?, ?, ?)', [f for b, f in batch if f])
+            self.conn.commit()
+            replayed += len(batch)
+        c.execute('CREATE TEMP TABLE replay_stock (book_id INTEGER PRIMARY KEY, copies INTEGER)')
+        c.executemany('INSERT INTO temp.replay_stock VALUES (?, ?)', stock.items())
+        self.conn.commit()
+        borrows_diff, fines_diff = c.execute(CIRCULATION_DIFF_SQL).fetchone()
+        available = c.execute(CIRCULATION_STOCK_DIFF_SQL).fetchall()
+        if apply:
+            with write_transaction(self.conn) as w:
+                w.execute('DELETE FROM fines')
+                w.execute('DELETE FROM borrows')
+                w.execute('INSERT INTO borrows (id, user_id, book_id, borrow_date, return_date, returned, fine_amount) '
+                          'SELECT * FROM temp.replay_borrows')
+                w.execute('INSERT INTO fines (borrow_id, user_id, amount, calculated_date, paid) '
+                          'SELECT * FROM temp.replay_fines')
+                w.executemany('UPDATE books SET available = ?, version = version + 1 WHERE id = ?',
+                              [(copies, book_id) for book_id, copies in available])
+        c.execute('DROP TABLE temp.replay_borrows')
+        c.execute('DROP TABLE temp.replay_fines')
+        c.execute('DROP TABLE temp.replay_stock')
+        return replayed, borrows_diff, fines_diff, len(available)
+
+# PostgreSQL: tsvector zamiast FTS5. Polskie znaki są zamieniane na litery bez
+# ogonków po obu stronach (kolumna generowana i zapytanie), jak w books_fts.
+PG_FOLD_FROM = 'ąćęłńóśźżĄĆĘŁŃÓŚŹŻ'
+PG_FOLD_TO = 'acelnoszzACELNOSZZ'
+PG_FOLD_SQL = "translate(coalesce({0}, ''), '%s', '%s')" % (PG_FOLD_FROM, PG_FOLD_TO)
+PG_BOOK_SELECT = 'SELECT id, title, author, added_date, available, last_edited, isbn, borrow_count, version FROM books'
+
+def build_pg_tsquery(search):
+    """Odpowiednik build_fts_query dla to_tsquery('simple', ...): wszystkie słowa, prefiksowo"""
+    folded = search.translate(str.maketrans(PG_FOLD_FROM, PG_FOLD_TO))
+    return ' & '.join('%s:*' % word for word in re.findall(r'\w+', folded))
+
+def _pg_migration_1_schema(c):
+    """Schemat odpowiadający wersji 6 bazy SQLite"""
+    c.execute('''CREATE TABLE users
+                 (id BIGSERIAL PRIMARY KEY, username TEXT UNIQUE, password TEXT, is_admin INTEGER)''')
+    # Tytuł ważniejszy od autora (wagi A i B w ts_rank)
+    c.execute('''CREATE TABLE books
+                 (id BIGSERIAL PRIMARY KEY, title TEXT, author TEXT, added_date BIGINT,
+                  available INTEGER, last_edited BIGINT, isbn TEXT UNIQUE,
+                  borrow_count INTEGER NOT NULL DEFAULT 0,
+                  search tsvector GENERATED ALWAYS AS (
+                      setweight(to_tsvector('simple', %s), 'A') ||
+                      setweight(to_tsvector('simple', %s), 'B')) STORED)'''
+              % (PG_FOLD_SQL.format('title'), PG_FOLD_SQL.format('author')))
+    c.execute('''CREATE TABLE borrows
+                 (id BIGSERIAL PRIMARY KEY, user_id BIGINT, book_id BIGINT,
+                  borrow_date BIGINT, return_date BIGINT, returned INTEGER, fine_amount DOUBLE PRECISION)''')
+    c.execute('''CREATE TABLE fines
+                 (id BIGSERIAL PRIMARY KEY, borrow_id BIGINT, user_id BIGINT,
+                  amount DOUBLE PRECISION, calculated_date BIGINT, paid INTEGER)''')
+    c.execute('''CREATE TABLE book_daily_borrows
+                 (day DATE, book_id BIGINT, borrows INTEGER NOT NULL, PRIMARY KEY (day, book_id))''')
+    c.execute('CREATE TABLE job_state (name TEXT PRIMARY KEY, value TEXT)')
+
+    c.execute('CREATE INDEX idx_books_search ON books USING gin (search)')
+    c.execute('CREATE INDEX idx_books_title ON books(title, id)')
+    c.execute('CREATE INDEX idx_books_borrow_count ON books(borrow_count DESC)')
+    c.execute('CREATE INDEX idx_borrows_active_user ON borrows(user_id, book_id) WHERE returned = 0')
+    c.execute('CREATE INDEX idx_borrows_active_book ON borrows(book_id) WHERE returned = 0')
+    c.execute('CREATE INDEX idx_borrows_user_date ON borrows(user_id, borrow_date)')
+    c.execute('CREATE INDEX idx_borrows_book ON borrows(book_id)')
+    c.execute('CREATE INDEX idx_borrows_active_due ON borrows(return_date, id) INCLUDE (user_id) WHERE returned = 0')
+    c.execute('CREATE INDEX idx_fines_unpaid_user ON fines(user_id) INCLUDE (amount) WHERE paid = 0')
+    c.execute('CREATE INDEX idx_fines_paid_date ON fines(paid, calculated_date)')
+    c.execute('CREATE UNIQUE INDEX idx_fines_borrow ON fines(borrow_id)')
+
+def _pg_migration_2_row_versions(c):
+    """Jak migracja 7 SQLite"""
+    c.execute('ALTER TABLE books ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+def _pg_migration_3_canonical_isbn(c):
+    """Jak migracja 8 SQLite"""
+    backfill_canonical_isbns(c, '%s')
+
+def _pg_migration_4_reservations(c):
+    """Jak migracja 9 SQLite"""
+    c.execute('''CREATE TABLE reservations
+                 (id BIGSERIAL PRIMARY KEY, user_id BIGINT, book_id BIGINT, created_date BIGINT,
+                  status TEXT NOT NULL, expires_date BIGINT)''')
+    c.execute('CREATE INDEX idx_reservations_book ON reservations(book_id, status, id)')
+    c.execute('CREATE INDEX idx_reservations_user ON reservations(user_id, status, book_id)')
+    c.execute("CREATE INDEX idx_reservations_ready_expiry ON reservations(expires_date) WHERE status = 'ready'")
+
+def _pg_migration_5_circulation_events(c):
+    """Jak migracja 10 SQLite"""
+    c.execute('''CREATE TABLE circulation_events
+                 (id BIGSERIAL PRIMARY KEY, created_date BIGINT NOT NULL, event TEXT NOT NULL,
+                  borrow_id BIGINT NOT NULL, user_id BIGINT, book_id BIGINT, amount DOUBLE PRECISION,
+                  due_date BIGINT, actor_id BIGINT)''')
+    backfill_circulation_events(c)
+
+def _pg_migration_6_reservation_queue_seq(c):
+    """Jak migracja 11 SQLite"""
+    c.execute('ALTER TABLE reservations ADD COLUMN queue_seq BIGINT')
+    backfill_reservation_queue(c)
+    c.execute("CREATE INDEX idx_reservations_queue ON reservations(book_id, queue_seq) WHERE status = 'waiting'")
+
+def _pg_migration_7_live_events(c):
+    """Jak migracja 12 SQLite"""
+    c.execute('''CREATE TABLE live_events
+                 (id BIGSERIAL PRIMARY KEY, event TEXT NOT NULL, data TEXT NOT NULL, user_id TEXT)''')
+
+def _pg_migration_8_stock_events(c):
+    """Jak migracja 13 SQLite"""
+    backfill_stock_events(c)
+
+# Lista migracji PostgreSQL - jak MIGRATIONS, nowe dopisujemy wyłącznie na końcu
+PG_MIGRATIONS = [
+    (1, _pg_migration_1_schema),
+    (2, _pg_migration_2_row_versions),
+    (3, _pg_migration_3_canonical_isbn),
+    (4, _pg_migration_4_reservations),
+    (5, _pg_migration_5_circulation_events),
+    (6, _pg_migration_6_reservation_queue_seq),
+    (7, _pg_migration_7_live_events),
+    (8, _pg_migration_8_stock_events),
+]
+
+# Klucze pg_advisory_xact_lock (zamiast BEGIN IMMEDIATE z SQLite)
+PG_MIGRATION_LOCK = 0x4c6962
+PG_JOB_LOCKS = {'fine_accrual': 0x4c6963, 'live_events': 0x4c6964}
+
+class PostgresPool:
+    """Pula psycopg2 dla jednego DSN. ThreadedConnectionPool zgłasza błąd, gdy brak
+    wolnych połączeń - semafor każe żądaniu poczekać (do DB_BUSY_TIMEOUT)."""
+
+    def __init__(self, dsn, size, readonly=False):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(0, size, dsn)
+        self._slots = threading.BoundedSemaphore(size)
+        self.readonly = readonly
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=app.config['DB_BUSY_TIMEOUT'] / 1000):
+            raise RuntimeError('Brak wolnego połączenia z PostgreSQL')
+        try:
+            conn = self._pool.getconn()
+            if not conn.autocommit:
+                # Transakcje otwiera jawnie PostgresStorage._write, odczyty nie trzymają migawki
+                conn.set_session(readonly=self.readonly, autocommit=True)
+        except Exception:
+            self._slots.release()
+            raise
+        return conn
+
+    def putconn(self, conn):
+        try:
+            broken = bool(conn.closed)
+            if not broken and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.cursor().execute('ROLLBACK')
+                except psycopg2.Error:
+                    broken = True
+            self._pool.putconn(conn, close=broken)
+        finally:
+            self._slots.release()
+
+_pg_pools = {}
+_pg_pools_lock = threading.Lock()
+
+def get_pg_pool(reporting=False):
+    """Pula połączeń procesu; raporty mogą czytać z repliki (POSTGRES_REPORTING_DSN)"""
+    dsn = app.config['POSTGRES_DSN']
+    if reporting:
+        dsn = app.config['POSTGRES_REPORTING_DSN'] or dsn
+    key = (dsn, reporting)
+    pool = _pg_pools.get(key)
+    if pool is None:
+        if psycopg2 is None:
+            raise RuntimeError("STORAGE_BACKEND = 'postgresql' wymaga pakietu psycopg2")
+        with _pg_pools_lock:
+            pool = _pg_pools.get(key)
+            if pool is None:
+                pool = _pg_pools[key] = PostgresPool(dsn, app.config['POSTGRES_POOL_SIZE'], readonly=reporting)
+    return pool
+
+class PostgresStorage(Storage):
+    """Serwer PostgreSQL: wiele procesów i węzłów aplikacji zapisuje równolegle"""
+
+    param = '%s'
+    epoch_day_sql = 'to_timestamp({0})::date'
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._pending_events = []
+
+    def _for_update(self, of=None, skip_locked=False):
+        # READ COMMITTED: limity i kolejki chronią blokady wierszy, SKIP LOCKED dzieli partie między węzły
+        return ' FOR UPDATE' + (' OF ' + of if of else '') + (' SKIP LOCKED' if skip_locked else '')
+
+    def _lock_job(self, c, name):
+        c.execute('SELECT pg_advisory_xact_lock(%s)', (PG_JOB_LOCKS[name],))
+
+    @contextmanager
+    def _write(self):
+        """Transakcja READ COMMITTED; wyścigi rozstrzygają warunkowe UPDATE i blokady wierszy"""
+        c = self.conn.cursor()
+        c.execute('BEGIN')
+        try:
+            yield c
+        except BaseException as e:
+            c.execute('ROLLBACK')
+            self._pending_events = []
+            if isinstance(e, psycopg2.errors.UniqueViolation):
+                raise DuplicateKeyError(str(e)) from e
+            raise
+        c.execute('COMMIT')
+        self._publish_events()
+
+    def _all(self, sql, params=()):
+        with self.conn.cursor() as c:
+            c.execute(sql, params)
+            return c.fetchall()
+
+    def _one(self, sql, params=()):
+        with self.conn.cursor() as c:
+            c.execute(sql, params)
+            return c.fetchone()
+
+    def migrate(self):
+        with self._write() as c:
+            c.execute('SELECT pg_advisory_xact_lock(%s)', (PG_MIGRATION_LOCK,))
+            c.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+            c.execute('SELECT version FROM schema_version')
+            row = c.fetchone()
+            version = row[0] if row else 0
+            for number, migration in PG_MIGRATIONS:
+                if number > version:
+                    migration(c)
+                    version = number
+            c.execute('DELETE FROM schema_version')
+            c.execute('INSERT INTO schema_version (version) VALUES (%s)', (version,))
+        return version
+
+    def search_books(self, search):
+        isbn = clean_isbn(search)
+        if ISBN_PATTERN.fullmatch(isbn):
+            books = self._all(PG_BOOK_SELECT + ' WHERE isbn = %s', (canonical_isbn(isbn) or isbn,))
+            if books:
+                return books
+
+        query = build_pg_tsquery(search)
+        if not query:
+            return []
+        return self._all(PG_BOOK_SELECT + ''', to_tsquery('simple', %s) q
+                         WHERE search @@ q
+                         ORDER BY ts_rank(search, q) DESC
+                         LIMIT %s''', (query, app.config['CATALOG_SEARCH_LIMIT']))
+
+    def books_page(self, after, limit):
+        if after:
+            return self._all(PG_BOOK_SELECT + ' WHERE (title, id) > (%s, %s) ORDER BY title, id LIMIT %s',
+                             (after[0], after[1], limit + 1))
+        return self._all(PG_BOOK_SELECT + ' ORDER BY title, id LIMIT %s', (limit + 1,))
+
+    def get_book(self, book_id):
+        return self._one(PG_BOOK_SELECT + ' WHERE id = %s', (book_id,))
+
+    def isbn_taken(self, isbn, exclude_id=None):
+        return self._one('SELECT id FROM books WHERE isbn = %s AND id IS DISTINCT FROM %s',
+                         (isbn, exclude_id)) is not None
+
+    def popular_books(self, days):
+        if days is None:
+            return self._all('SELECT id, title, author, borrow_count FROM books ORDER BY borrow_count DESC LIMIT 20')
+        return self._all('''
+            SELECT b.id, b.title, b.author, SUM(d.borrows) as borrow_count
+            FROM book_daily_borrows d
+            JOIN books b ON b.id = d.book_id
+            WHERE d.day > %s
+            GROUP BY b.id
+            ORDER BY borrow_count DESC
+            LIMIT 20
+        ''', (date.today() - timedelta(days=days),))
+
+    def import_book_batch(self, batch, actor_id=None):
+        # ON CONFLICT nie może zmienić tego samego wiersza dwa razy w jednym zapytaniu -
+        # przy powtórzonym ISBN wygrywa ostatni wiersz partii (jak w SQLite)
+        latest = {}
+        untagged = {}
+        for row in batch:
+            if row[5]:
+                latest[row[5]] = row
+            else:
+                untagged[row[0], row[1]] = row
+        matched = []
+        with self._write() as c:
+            # Książki, które import może zmienić, zablokowane do końca - różnica available
+            # to wtedy tylko zmiana liczby egzemplarzy (dziennik 'adjust')
+            c.execute('''SELECT id, available FROM books
+                         WHERE isbn = ANY(%s::text[]) OR (isbn IS NULL AND (title, author) IN
+                               (SELECT * FROM unnest(%s::text[], %s::text[])))
+                         FOR UPDATE''',
+                      (list(latest), [title for title, _ in untagged], [author for _, author in untagged]))
+            before = dict(c.fetchall())
+            if untagged:
+                # Bez ISBN - aktualizacja książki bez ISBN o tym samym tytule i autorze
+                matched = psycopg2.extras.execute_values(c, '''
+                    UPDATE books SET last_edited = v.last_edited, version = books.version + 1,
+                        available = GREATEST(0, v.available - (SELECT COUNT(*) FROM borrows
+                            WHERE borrows.book_id = books.id AND borrows.returned = 0)
+                            - (SELECT COUNT(*) FROM reservations r
+                               WHERE r.book_id = books.id AND r.status = 'ready'))
+                    FROM (VALUES %s) AS v (title, author, available, last_edited)
+                    WHERE books.id = (SELECT MIN(b.id) FROM books b WHERE b.isbn IS NULL
+                                      AND b.title = v.title AND b.author = v.author)
+                    RETURNING books.id, v.title, v.author''',
+                    [(title, author, available, edited) for title, author, _, available, edited, _
+                     in untagged.values()], page_size=1000, fetch=True)
+                for _, title, author in matched:
+                    untagged.pop((title, author), None)
+            rows = list(untagged.values()) + list(latest.values())
+            upserted = psycopg2.extras.execute_values(c, '''
+                INSERT INTO books (title, author, added_date, available, last_edited, isbn) VALUES %s
+                ON CONFLICT (isbn) DO UPDATE SET
+                    title = excluded.title, author = excluded.author,
+                    last_edited = excluded.last_edited, version = books.version + 1,
+                    available = GREATEST(0, excluded.available - (SELECT COUNT(*) FROM borrows
+                        WHERE borrows.book_id = books.id AND borrows.returned = 0)
+                        - (SELECT COUNT(*) FROM reservations r
+                           WHERE r.book_id = books.id AND r.status = 'ready'))
+                RETURNING id, available''', rows, page_size=1000, fetch=True)
+            now = int(time.time())
+            after = dict(upserted)
+            after.update((book_id, available) for book_id, available in self._all(
+                'SELECT id, available FROM books WHERE id = ANY(%s)', ([row[0] for row in matched],)))
+            self._log_stock_changes(c, before, after, now, actor_id)
+            # Czekająca kolejka przy wolnych egzemplarzach = import zwiększył ich liczbę
+            c.execute('''SELECT DISTINCT r.book_id FROM reservations r JOIN books b ON b.id = r.book_id
+                         WHERE r.status = 'waiting' AND b.available > 0
+                         AND (b.isbn = ANY(%s) OR b.id = ANY(%s))''',
+                      (list(latest), [row[0] for row in matched]))
+            for (book_id,) in c.fetchall():
+                self._allocate_holds(c, book_id, now)
+
+    def export_book_rows(self):
+        # Kursor po stronie serwera - tabela nie jest wczytywana do pamięci naraz
+        c = self.conn.cursor(name='export_books', withhold=True)
+        c.itersize = 2000
+        c.execute('''SELECT b.title, b.author,
+                            b.available + (SELECT COUNT(*) FROM borrows br
+                                           WHERE br.book_id = b.id AND br.returned = 0)
+                            + (SELECT COUNT(*) FROM reservations r
+                               WHERE r.book_id = b.id AND r.status = 'ready'),
+                            b.isbn
+                     FROM books b ORDER BY b.id''')
+        return c
+
+    def append_circulation_events(self, events):
+        with self._write() as c:
+            psycopg2.extras.execute_values(c, CIRCULATION_EVENT_INSERT + '%s', events)
+
+    def circulation_events(self):
+        c = self.conn.cursor(name='circulation_events', withhold=True)
+        c.itersize = 10000
+        c.execute(CIRCULATION_REPLAY_SQL)
+        return c
+
+    def replay_circulation(self, rows, stock, apply=False):
+        with self.conn.cursor() as c:
+            c.execute('DROP TABLE IF EXISTS replay_borrows, replay_fines, replay_stock')
+            c.execute('''CREATE TEMP TABLE replay_borrows
+                         (id BIGINT PRIMARY KEY, user_id BIGINT, book_id BIGINT, borrow_date BIGINT,
+                          return_date BIGINT, returned INTEGER, fine_amount DOUBLE PRECISION)''')
+            c.execute('''CREATE TEMP TABLE replay_fines
+                         (borrow_id BIGINT PRIMARY KEY, user_id BIGINT, amount DOUBLE PRECISION,
+                          calculated_date BIGINT, paid INTEGER)''')
+            replayed = 0
+            rows = iter(rows)
+            while True:
+                batch = list(islice(rows, app.config['IMPORT_BATCH_SIZE']))
+                if not batch:
+                    break
+                psycopg2.extras.execute_values(c, 'INSERT INTO replay_borrows VALUES %s', [b for b, f in batch])
+                psycopg2.extras.execute_values(c, 'INSERT INTO replay_fines VALUES %s', [f for b, f in batch if f])
+                replayed += len(batch)
+            c.execute('CREATE TEMP TABLE replay_stock (book_id BIGINT PRIMARY KEY, copies BIGINT)')
+            psycopg2.extras.execute_values(c, 'INSERT INTO replay_stock VALUES %s', list(stock.items()))
+            c.execute(CIRCULATION_DIFF_SQL)
+            borrows_diff, fines_diff = c.fetchone()
+            c.execute(CIRCULATION_STOCK_DIFF_SQL)
+            available = c.fetchall()
+        if apply:
+            with self._write() as c:
+                c.execute('DELETE FROM fines')
+                c.execute('DELETE FROM borrows')
+                c.execute('INSERT INTO borrows (id, user_id, book_id, borrow_date, return_date, returned, fine_amount) '
+                          'SELECT * FROM replay_borrows')
+                c.execute('INSERT INTO fines (borrow_id, user_id, amount, calculated_date, paid) '
+                          'SELECT * FROM replay_fines')
+                c.executemany('UPDATE books SET available = %s, version = version + 1 WHERE id = %s',
+                              [(copies, book_id) for book_id, copies in available])
+        with self.conn.cursor() as c:
+            c.execute('DROP TABLE replay_borrows, replay_fines, replay_stock')
+        return replayed, borrows_diff, fines_diff, len(available)
+
+def _using_postgres():
+    return app.config['STORAGE_BACKEND'] == 'postgresql'
+
+def get_storage():
+    """Magazyn danych bieżącego żądania (połączenie oddawane do puli w close_db)"""
+    if 'storage' not in g:
+        if _using_postgres():
+            g.storage = PostgresStorage(_get_pg_conn(get_pg_pool()))
+        else:
+            g.storage = SQLiteStorage(get_db())
+    return g.storage
+
+def get_report_storage():
+    """Magazyn dla ciężkich odczytów administracyjnych (REPORTING_DB_MODE)"""
+    if 'report_storage' not in g:
+        if _using_postgres():
+            if app.config['REPORTING_DB_MODE'] == 'primary':
+                return get_storage()
+            g.report_storage = PostgresStorage(_get_pg_conn(get_pg_pool(reporting=True)))
+        else:
+            g.report_storage = SQLiteStorage(get_report_db())
+    return g.report_storage
+
+def _get_pg_conn(pool):
+    conn = pool.getconn()
+    g.setdefault('pg_conns', []).append((pool, conn))
+    return conn
+
+@contextmanager
+def open_storage():
+    """Magazyn na osobnym połączeniu - dla poleceń CLI i wątków w tle"""
+    if _using_postgres():
+        pool = get_pg_pool()
+        conn = pool.getconn()
+        try:
+            yield PostgresStorage(conn)
+        finally:
+            pool.putconn(conn)
+    else:
+        conn = connect_db()
+        try:
+            yield SQLiteStorage(conn)
+        finally:
+            conn.close()
+
+def _load_user_row(user_id):
+    return get_storage().get_user(user_id)
+
+def remember_user_in_session(user):
+    """Zapisuje (id, nazwa, admin, czas) w podpisanej sesji - patrz SESSION_USER_TTL"""
+    if app.config['SESSION_USER_TTL']:
+        session['_user'] = [user[0], user[1], user[2], int(time.time())]
 
 @login_manager.user_loader
 def load_user(user_id):
+    # Zmiana uprawnień w edit_user dociera do sesji najpóźniej po SESSION_USER_TTL
+    payload = session.get('_user')
+    if (payload and str(payload[0]) == user_id
+            and payload[3] + app.config['SESSION_USER_TTL'] > time.time()):
+        return User(payload[0], payload[1], payload[2])
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-        c.execute('SELECT id, username, is_admin FROM users WHERE id = ?', (user_id,))
-        user = c.fetchone()
-        conn.close()
+        user = get_cache().get_or_set('auth', user_id, lambda: _load_user_row(user_id),
+                                      app.config['USER_CACHE_TTL'])
         if user:
+            remember_user_in_session(user)
             return User(user[0], user[1], user[2])
     except Exception:
-        pass
+        report_error()
     return None
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+_fragment_cache = None
+
+def render_book_cells(books):
+    """Komórki wierszy katalogu wspólne dla wszystkich użytkowników (catalog_row.html).
+    Kluczem są wyświetlane kolumny, więc edycja, wypożyczenie i zwrot dają nowy
+    wpis, a stare wypadają z LRU. Akcje użytkownika renderuje catalog.html."""
+    global _fragment_cache
+    if _fragment_cache is None:
+        _fragment_cache = MemoryCacheBackend(app.config['FRAGMENT_CACHE_MAX_ENTRIES'])
+    template = None
+    cells = []
+    misses = 0
+    for book in books:
+        key = tuple(book[:7])
+        html = _fragment_cache.get(key)
+        if html is None:
+            template = template or app.jinja_env.get_template('catalog_row.html')
+            html = Markup(template.render(book=book))
+            _fragment_cache.set(key, html)
+            misses += 1
+        cells.append(html)
+    metrics.inc('libraryhub_cache_hits_total', {'namespace': 'catalog_rows'}, len(cells) - misses)
+    metrics.inc('libraryhub_cache_misses_total', {'namespace': 'catalog_rows'}, misses)
+    return cells
+
+def load_catalog_page(storage, search, after, limit):
+    """(książki, kursor następnej strony) - wspólne dla katalogu i /api/v1/books"""
+    def load_books():
+        if search:
+            return storage.search_books(search), None
+        books = list(storage.books_page(after, limit))
+        if len(books) > limit:
+            return books[:limit], encode_cursor(books[limit - 1])
+        return books, None
+
+    # Lista książek jest taka sama dla wszystkich użytkowników
+    return get_cache().get_or_set('catalog', repr((search, after, limit)), load_books)
+
 @app.route('/catalog')
 def catalog():
     search = request.args.get('search', '').strip()
+    after = decode_cursor(request.args.get('after'))
+    limit = get_page_size()
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-        if search:
-            c.execute('''SELECT * FROM books
-                        WHERE title LIKE ? OR author LIKE ? OR isbn LIKE ?
-                        ORDER BY title''',
-                      ('%' + search + '%', '%' + search + '%', '%' + search + '%'))
-        else:
-            c.execute('SELECT * FROM books ORDER BY title')
-        books = c.fetchall()
+        storage = get_storage()
+        books, next_cursor = load_catalog_page(storage, search, after, limit)
 
-        # Sprawdzenie wypożyczonych książek i limitu
+        # Sprawdzenie wypożyczonych książek, rezerwacji i limitu
         borrowed_books = []
+        reservations = {}
         user_borrow_count = 0
         if current_user.is_authenticated:
-            c.execute('SELECT book_id FROM borrows WHERE user_id = ? AND returned = 0', (current_user.id,))
-            borrowed_books = [row[0] for row in c.fetchall()]
+            borrowed_books = storage.borrowed_book_ids(current_user.id)
+            reservations = {row[1]: row for row in storage.user_reservations(current_user.id)}
             user_borrow_count = len(borrowed_books)
 
-        conn.close()
         return render_template('catalog.html',
                                books=books,
+                               book_cells=render_book_cells(books),
                                borrowed_books=borrowed_books,
+                               reservations=reservations,
                                user_borrow_count=user_borrow_count,
-                               max_borrows=MAX_BORROWS_PER_USER)
+                               max_borrows=MAX_BORROWS_PER_USER,
+                               next_cursor=next_cursor,
+                               is_first_page=after is None)
     except Exception as e:
+        report_error()
         return render_template('catalog.html',
                                books=[],
                                borrowed_books=[],
+                               reservations={},
                                user_borrow_count=0,
                                max_borrows=MAX_BORROWS_PER_USER,
                                error=f"Błąd: {str(e)}")
 
+@app.route('/api/books')
+def api_books():
+    """Katalog w JSON, strumieniowany wiersz po wierszu (?search=, ?after=, ?limit=)"""
+    search = request.args.get('search', '').strip()
+    limit = get_page_size()
+    storage = get_storage()
+    if search:
+        rows = storage.search_books(search)[:limit]
+    else:
+        rows = storage.books_page(decode_cursor(request.args.get('after')), limit)
+
+    def generate():
+        yield '{"books": ['
+        last = None
+        has_more = False
+        for index, row in enumerate(rows):
+            if index == limit:
+                has_more = True
+                break
+            yield (',' if index else '') + json.dumps(dict(zip(BOOK_COLUMNS, row)), ensure_ascii=False)
+            last = row
+        next_cursor = encode_cursor(last) if has_more else None
+        yield '], "next": %s}' % json.dumps(next_cursor)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+# API JSON v1 (aplikacja mobilna, kioski). Odpowiedzi GET mają ETag - klient odsyła go
+# w If-None-Match i dostaje 304 bez treści, jeśli dane się nie zmieniły.
+def book_json(book):
+    data = dict(zip(BOOK_COLUMNS, book))
+    data['version'] = book[8]
+    return data
+
+def book_etag(book):
+    """Z licznika zmian wiersza (books.version) - bez porównywania treści"""
+    return 'b%d.%d' % (book[0], book[8])
+
+def digest_etag(*parts):
+    """ETag listy jako skrót jej składników (np. par id, version)"""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:24]
+
+def api_response(etag, build, status=200):
+    """JSON z ETagiem; build() wywoływane tylko, gdy klient nie ma aktualnej wersji"""
+    if request.method == 'GET' and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+        response.status_code = status
+    response.set_etag(etag)
+    # Klient może trzymać kopię, ale przed użyciem musi ją potwierdzić (If-None-Match)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def api_error(status, message):
+    return jsonify({'error': message}), status
+
+def api_login_required(view):
+    """Jak login_required, ale 401 w JSON zamiast przekierowania na stronę logowania"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return api_error(401, 'Wymagane zalogowanie')
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/v1/books')
+def api_v1_books():
+    """Strona katalogu lub wyniki wyszukiwania (?search=, ?after=, ?limit=) jak na /catalog"""
+    search = request.args.get('search', '').strip()
+    after = decode_cursor(request.args.get('after'))
+    limit = get_page_size()
+    books, next_cursor = load_catalog_page(get_storage(), search, after, limit)
+    etag = digest_etag(search, after, limit, next_cursor, [(book[0], book[8]) for book in books])
+    return api_response(etag, lambda: {'books': [book_json(book) for book in books], 'next': next_cursor})
+
+@app.route('/api/v1/books/<int:book_id>')
+def api_v1_book(book_id):
+    book = get_storage().get_book(book_id)
+    if book is None:
+        return api_error(404, 'Nie znaleziono książki')
+    return api_response(book_etag(book), lambda: book_json(book))
+
+@app.route('/api/v1/books/<int:book_id>/borrow', methods=['POST'])
+@api_login_required
+def api_v1_borrow(book_id):
+    """Zwraca książkę po zmianie (z nowym ETagiem) albo 404/409"""
+    try:
+        storage = get_storage()
+        borrowed = borrow_and_notify(storage, current_user.id, book_id)
+        book = storage.get_book(book_id)
+    except Exception:
+        report_error()
+        return api_error(500, 'Błąd wypożyczenia')
+    if book is None:
+        return api_error(404, 'Nie znaleziono książki')
+    if not borrowed:
+        return api_error(409, 'Brak wolnych egzemplarzy, książka już wypożyczona lub osiągnięto limit %d'
+                         % MAX_BORROWS_PER_USER)
+    return api_response(book_etag(book), lambda: book_json(book))
+
+@app.route('/api/v1/books/<int:book_id>/return', methods=['POST'])
+@api_login_required
+def api_v1_return(book_id):
+    try:
+        storage = get_storage()
+        returned = return_and_notify(storage, current_user.id, book_id)
+        book = storage.get_book(book_id)
+    except Exception:
+        report_error()
+        return api_error(500, 'Błąd zwrotu')
+    if book is None:
+        return api_error(404, 'Nie znaleziono książki')
+    if not returned:
+        return api_error(409, 'Książka nie jest wypożyczona przez tego użytkownika')
+    return api_response(book_etag(book), lambda: book_json(book))
+
+@app.route('/api/v1/profile')
+@api_login_required
+def api_v1_profile():
+    """Wypożyczenia i kary zalogowanego użytkownika; historia stronicowana ?before= jak /profile"""
+    profile = get_storage().profile(current_user.id, decode_history_cursor(request.args.get('before')))
+    borrows, active_count, unpaid_total, next_cursor = profile
+    # Pozostałe dni zmieniają się z upływem czasu, więc ETag liczony jest z całych danych
+    return api_response(digest_etag(profile), lambda: {
+        'active': active_count,
+        'max_borrows': MAX_BORROWS_PER_USER,
+        'unpaid_fines': unpaid_total,
+        'borrows': [{'id': borrow[6], 'book_id': borrow[7], 'title': borrow[0], 'borrow_date': borrow[1],
+                     'return_date': borrow[2], 'returned': bool(borrow[3]), 'days_left': borrow[4],
+                     'fine': borrow[5]} for borrow in borrows],
+        'next': next_cursor,
+    })
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -245,18 +3538,26 @@ def login():
             return render_template('login.html', error='Hasło nie może być puste')
 
         try:
-            conn = sqlite3.connect('database/library.db')
-            c = conn.cursor()
-            c.execute('SELECT id, username, password, is_admin FROM users WHERE username = ?', (username,))
-            user = c.fetchone()
-            conn.close()
-
-            if user and bcrypt.checkpw(password.encode('utf-8'), user[2].encode('utf-8')):
+            storage = get_storage()
+            user = storage.get_user_by_name(username)
+
+            hasher = get_password_hasher()
+            if user and hasher.check(password, user[2]):
+                if hasher.needs_rehash(user[2]):
+                    # Zmieniono BCRYPT_ROUNDS - przeliczamy hash, póki znamy hasło
+                    try:
+                        storage.set_password(user[0], hasher.hash(password), old_hash=user[2])
+                    except Exception:
+                        report_error()
                 login_user(User(user[0], user[1], user[3]))
+                remember_user_in_session((user[0], user[1], user[3]))
                 return redirect(url_for('index'))
             else:
                 return render_template('login.html', error='Błędny login lub hasło')
+        except PasswordHasherBusy:
+            return render_template('login.html', error=BUSY_MESSAGE), 503
         except Exception as e:
+            report_error()
             return render_template('login.html', error='Błąd logowania')
 
     return render_template('login.html')
@@ -277,17 +3578,17 @@ def register():
             return render_template('register.html', error=error)
 
         try:
-            hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-            conn = sqlite3.connect('database/library.db')
-            c = conn.cursor()
-            c.execute('INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)',
-                      (username, hashed.decode('utf-8'), 0))
-            conn.commit()
-            conn.close()
+            hashed = get_password_hasher().hash(password)
+            get_storage().add_user(username, hashed)
+            # 'auth' pamięta też brak użytkownika, a nowe konto może dostać id usuniętego
+            invalidate_cache('users', 'auth')
             return redirect(url_for('login'))
-        except sqlite3.IntegrityError:
+        except DuplicateKeyError:
             return render_template('register.html', error='Nazwa użytkownika już istnieje')
+        except PasswordHasherBusy:
+            return render_template('register.html', error=BUSY_MESSAGE), 503
         except Exception as e:
+            report_error()
             return render_template('register.html', error='Błąd rejestracji')
 
     return render_template('register.html')
@@ -310,30 +3611,66 @@ def add_book():
             return render_template('add_book.html', error=error)
 
         try:
-            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            conn = sqlite3.connect('database/library.db')
-            c = conn.cursor()
+            storage = get_storage()
 
             # Sprawdź czy ISBN już istnieje
-            if isbn:
-                isbn_clean = isbn.replace('-', '').replace(' ', '')
-                c.execute('SELECT id FROM books WHERE isbn = ?', (isbn_clean,))
-                if c.fetchone():
-                    conn.close()
-                    return render_template('add_book.html', error='Książka z tym ISBN już istnieje')
-
-            c.execute('INSERT INTO books (title, author, added_date, available, last_edited, isbn) VALUES (?, ?, ?, ?, ?, ?)',
-                      (title, author, now, int(available), now, isbn_clean if isbn else None))
-            conn.commit()
-            conn.close()
+            isbn_key = canonical_isbn(isbn)
+            if isbn_key and storage.isbn_taken(isbn_key):
+                return render_template('add_book.html', error='Książka z tym ISBN już istnieje')
+
+            storage.add_book(title, author, int(available), isbn_key, actor_id=current_user.id)
+            invalidate_cache('catalog', 'popular')
             return redirect(url_for('catalog'))
-        except sqlite3.IntegrityError:
+        except DuplicateKeyError:
             return render_template('add_book.html', error='Książka z tym ISBN już istnieje')
         except Exception as e:
+            report_error()
             return render_template('add_book.html', error=f"Błąd: {str(e)}")
 
     return render_template('add_book.html')
 
+@app.route('/import_books', methods=['GET', 'POST'])
+@login_required
+def import_books_view():
+    if not current_user.is_admin:
+        return redirect(url_for('catalog'))
+
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            return render_template('import_books.html', error='Wybierz plik do importu')
+        fmt = request.form.get('format') or None
+        if fmt not in BOOK_FILE_FORMATS + (None,):
+            return render_template('import_books.html', error='Nieznany format pliku')
+
+        rejects = []
+        def on_reject(line_no, error):
+            if len(rejects) < app.config['IMPORT_MAX_REJECTS_SHOWN']:
+                rejects.append((line_no, error))
+        try:
+            f = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+            imported, rejected = import_books(get_storage(), f, book_file_format(upload.filename, fmt),
+                                              on_reject=on_reject, actor_id=current_user.id)
+        except Exception as e:
+            report_error()
+            return render_template('import_books.html', error=f"Błąd importu: {str(e)}")
+        return render_template('import_books.html', imported=imported, rejected=rejected, rejects=rejects)
+
+    return render_template('import_books.html')
+
+@app.route('/export_books')
+@login_required
+def export_books_view():
+    if not current_user.is_admin:
+        return redirect(url_for('catalog'))
+    fmt = request.args.get('format', 'csv')
+    if fmt not in BOOK_FILE_FORMATS:
+        fmt = 'csv'
+    extension = {'csv': 'csv', 'jsonl': 'jsonl', 'marc': 'mrk'}[fmt]
+    mimetype = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson', 'marc': 'text/plain'}[fmt]
+    return Response(stream_with_context(export_books(get_storage().export_book_rows(), fmt)), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=books.%s' % extension})
+
 @app.route('/edit_book/<int:book_id>', methods=['GET', 'POST'])
 @login_required
 def edit_book(book_id):
@@ -341,8 +3678,7 @@ def edit_book(book_id):
         return redirect(url_for('catalog'))
 
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
+        storage = get_storage()
 
         if request.method == 'POST':
             title = request.form.get('title', '').strip()
@@ -353,44 +3689,32 @@ def edit_book(book_id):
             # Walidacja
             valid, error = validate_book_data(title, author, available, isbn)
             if not valid:
-                c.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-                book = c.fetchone()
-                conn.close()
-                return render_template('edit_book.html', book=book, error=error)
+                return render_template('edit_book.html', book=storage.get_book(book_id), error=error)
 
             try:
-                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                isbn_clean = isbn.replace('-', '').replace(' ', '') if isbn else None
+                isbn_key = canonical_isbn(isbn)
 
                 # Sprawdź czy ISBN już istnieje (ale nie dla tej samej książki)
-                if isbn_clean:
-                    c.execute('SELECT id FROM books WHERE isbn = ? AND id != ?', (isbn_clean, book_id))
-                    if c.fetchone():
-                        c.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-                        book = c.fetchone()
-                        conn.close()
-                        return render_template('edit_book.html', book=book, error='Książka z tym ISBN już istnieje')
-
-                c.execute('UPDATE books SET title = ?, author = ?, available = ?, last_edited = ?, isbn = ? WHERE id = ?',
-                          (title, author, int(available), now, isbn_clean, book_id))
-                conn.commit()
-                conn.close()
+                if isbn_key and storage.isbn_taken(isbn_key, exclude_id=book_id):
+                    return render_template('edit_book.html', book=storage.get_book(book_id),
+                                           error='Książka z tym ISBN już istnieje')
+
+                storage.update_book(book_id, title, author, int(available), isbn_key, actor_id=current_user.id)
+                invalidate_cache('catalog', 'popular')
+                publish_availability(storage, book_id)
                 return redirect(url_for('catalog'))
-            except sqlite3.IntegrityError:
-                c.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-                book = c.fetchone()
-                conn.close()
-                return render_template('edit_book.html', book=book, error='Książka z tym ISBN już istnieje')
+            except DuplicateKeyError:
+                return render_template('edit_book.html', book=storage.get_book(book_id),
+                                       error='Książka z tym ISBN już istnieje')
 
-        c.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-        book = c.fetchone()
-        conn.close()
+        book = storage.get_book(book_id)
 
         if not book:
             return redirect(url_for('catalog'))
         return render_template('edit_book.html', book=book)
 
     except Exception as e:
+        report_error()
         return redirect(url_for('catalog'))
 
 @app.route('/delete_book/<int:book_id>')
@@ -400,58 +3724,39 @@ def delete_book(book_id):
         return redirect(url_for('catalog'))
 
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-
-        # Sprawdź czy książka nie jest wypożyczona
-        c.execute('SELECT COUNT(*) FROM borrows WHERE book_id = ? AND returned = 0', (book_id,))
-        if c.fetchone()[0] > 0:
-            conn.close()
-            # Przekieruj z błędem
-            return redirect(url_for('catalog'))
-
-        c.execute('DELETE FROM books WHERE id = ?', (book_id,))
-        conn.commit()
-        conn.close()
+        # Wypożyczonej książki nie usuwamy
+        if get_storage().delete_book(book_id, actor_id=current_user.id):
+            invalidate_cache('catalog', 'popular')
     except Exception:
-        pass
+        report_error()
 
     return redirect(url_for('catalog'))
 
+def borrow_and_notify(storage, user_id, book_id):
+    """Wypożyczenie wraz z unieważnieniem pamięci podręcznej i zdarzeniami /events"""
+    if not storage.borrow_book(user_id, book_id):
+        return False
+    invalidate_cache('catalog', 'popular', 'users')
+    publish_availability(storage, book_id)
+    publish_loans(storage, user_id)
+    return True
+
+def return_and_notify(storage, user_id, book_id):
+    """Zwrot wraz z unieważnieniem pamięci podręcznej i zdarzeniami /events"""
+    if not storage.return_book(user_id, book_id):
+        return False
+    invalidate_cache('catalog', 'users')
+    publish_availability(storage, book_id)
+    publish_loans(storage, user_id)
+    return True
+
 @app.route('/borrow_book/<int:book_id>')
 @login_required
 def borrow_book(book_id):
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-
-        # Sprawdź limit wypożyczeń
-        user_borrow_count = get_user_borrow_count(current_user.id)
-        if user_borrow_count >= MAX_BORROWS_PER_USER:
-            conn.close()
-            return redirect(url_for('catalog'))
-
-        # Sprawdzenie dostępności
-        c.execute('SELECT available FROM books WHERE id = ?', (book_id,))
-        book = c.fetchone()
-
-        # Sprawdzenie czy już wypożyczona
-        c.execute('SELECT id FROM borrows WHERE user_id = ? AND book_id = ? AND returned = 0',
-                  (current_user.id, book_id))
-        already_borrowed = c.fetchone()
-
-        if book and book[0] > 0 and not already_borrowed:
-            now = datetime.now()
-            return_date = (now + timedelta(days=30)).strftime('%Y-%m-%d %H:%M:%S')
-
-            c.execute('UPDATE books SET available = ? WHERE id = ?', (book[0] - 1, book_id))
-            c.execute('INSERT INTO borrows (user_id, book_id, borrow_date, return_date, returned, fine_amount) VALUES (?, ?, ?, ?, ?, ?)',
-                      (current_user.id, book_id, now.strftime('%Y-%m-%d %H:%M:%S'), return_date, 0, 0))
-            conn.commit()
-
-        conn.close()
+        borrow_and_notify(get_storage(), current_user.id, book_id)
     except Exception:
-        pass
+        report_error()
 
     return redirect(url_for('catalog'))
 
@@ -459,62 +3764,79 @@ def borrow_book(book_id):
 @login_required
 def return_book(book_id):
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-
-        # Pobranie informacji o wypożyczeniu
-        c.execute('SELECT id, return_date FROM borrows WHERE user_id = ? AND book_id = ? AND returned = 0',
-                  (current_user.id, book_id))
-        borrow = c.fetchone()
-
-        if borrow:
-            now = datetime.now()
-            now_str = now.strftime('%Y-%m-%d %H:%M:%S')
-
-            # Obliczenie kary
-            fine = calculate_fine(now_str, borrow[1], True, now_str)
-
-            # Aktualizacja książki
-            c.execute('SELECT available FROM books WHERE id = ?', (book_id,))
-            book = c.fetchone()
-            if book:
-                c.execute('UPDATE books SET available = ? WHERE id = ?', (book[0] + 1, book_id))
+        return_and_notify(get_storage(), current_user.id, book_id)
+    except Exception:
+        report_error()
 
-            # Aktualizacja wypożyczenia
-            c.execute('UPDATE borrows SET returned = ?, return_date = ?, fine_amount = ? WHERE id = ?',
-                      (1, now_str, fine, borrow[0]))
+    return redirect(url_for('catalog'))
 
-            # Dodanie kary jeśli istnieje
-            if fine > 0:
-                c.execute('INSERT INTO fines (borrow_id, user_id, amount, calculated_date, paid) VALUES (?, ?, ?, ?, ?)',
-                          (borrow[0], current_user.id, fine, now_str, 0))
+@app.route('/reserve_book/<int:book_id>')
+@login_required
+def reserve_book(book_id):
+    """Miejsce w kolejce do wypożyczonej książki; zwrócony egzemplarz zostanie odłożony"""
+    try:
+        storage = get_storage()
+        status = storage.reserve_book(current_user.id, book_id)
+        if status:
+            invalidate_cache('catalog')
+        if status == 'ready':
+            publish_availability(storage, book_id)
+    except Exception:
+        report_error()
 
-            conn.commit()
+    return redirect(url_for('catalog'))
 
-        conn.close()
+@app.route('/cancel_reservation/<int:reservation_id>')
+@login_required
+def cancel_reservation_view(reservation_id):
+    try:
+        storage = get_storage()
+        book_id = storage.cancel_reservation(current_user.id, reservation_id)
+        if book_id:
+            invalidate_cache('catalog')
+            publish_availability(storage, book_id)
     except Exception:
-        pass
+        report_error()
 
-    return redirect(url_for('catalog'))
+    return redirect(url_for('profile'))
+
+# Okresy rankingu popularności: nazwa -> liczba dni (None = cała historia)
+POPULAR_PERIODS = {'all': None, 'month': 30, 'week': 7}
 
 @app.route('/popular')
 def popular():
+    period = request.args.get('period', 'all')
+    if period not in POPULAR_PERIODS:
+        period = 'all'
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
+        storage = get_report_storage()
+        days = POPULAR_PERIODS[period]
+        books = get_cache().get_or_set('popular', period, lambda: storage.popular_books(days))
+        return render_template('popular.html', books=books, period=period)
+    except Exception:
+        report_error()
+        return render_template('popular.html', books=[], period=period)
+
+def load_popular(c, days):
+    """Ranking 20 najczęściej wypożyczanych książek (days=None - cała historia)"""
+    if days is None:
         c.execute('''
-            SELECT b.id, b.title, b.author, COUNT(br.id) as borrow_count
-            FROM books b
-            LEFT JOIN borrows br ON b.id = br.book_id
-            GROUP BY b.id
+            SELECT id, title, author, borrow_count
+            FROM books
             ORDER BY borrow_count DESC
             LIMIT 20
         ''')
-        books = c.fetchall()
-        conn.close()
-        return render_template('popular.html', books=books)
-    except Exception:
-        return render_template('popular.html', books=[])
+    else:
+        c.execute('''
+            SELECT b.id, b.title, b.author, SUM(d.borrows) as borrow_count
+            FROM book_daily_borrows d
+            JOIN books b ON b.id = d.book_id
+            WHERE d.day > date('now', 'localtime', ?)
+            GROUP BY d.book_id
+            ORDER BY borrow_count DESC
+            LIMIT 20
+        ''', ('-%d days' % days,))
+    return c.fetchall()
 
 @app.route('/manage_users')
 @login_required
@@ -523,23 +3845,67 @@ def manage_users():
         return redirect(url_for('catalog'))
 
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-        # Pobierz użytkowników wraz z liczbą aktywnych wypożyczeń
-        c.execute('''
-            SELECT u.id, u.username, u.is_admin,
-                   COALESCE(COUNT(b.id), 0) as active_borrows
-            FROM users u
-            LEFT JOIN borrows b ON u.id = b.user_id AND b.returned = 0
-            GROUP BY u.id, u.username, u.is_admin
-            ORDER BY u.username
-        ''')
-        users = c.fetchall()
-        conn.close()
+        # Użytkownicy wraz z liczbą aktywnych wypożyczeń
+        users = get_cache().get_or_set('users', 'all', get_report_storage().users_with_active_borrows)
         return render_template('manage_users.html', users=users)
     except Exception:
+        report_error()
         return render_template('manage_users.html', users=[])
 
+@app.route('/cache_stats')
+@login_required
+def cache_stats():
+    """Liczniki trafień pamięci podręcznej dla monitoringu"""
+    if not current_user.is_admin:
+        return redirect(url_for('catalog'))
+    return jsonify(get_cache().stats())
+
+@app.route('/metrics')
+def metrics_view():
+    """Metryki procesu w formacie Prometheus"""
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != 'Bearer ' + token:
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    elif not (current_user.is_authenticated and current_user.is_admin) \
+            and not (app.config['METRICS_ALLOW_LOCALHOST'] and request.remote_addr in ('127.0.0.1', '::1')):
+        # Za reverse proxy na tym samym hoście każde żądanie przychodzi z localhost
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+
+    cache_stats = get_cache().stats()['namespaces']
+    cache_counters = []
+    for namespace, counts in cache_stats.items():
+        labels = (('namespace', namespace),)
+        cache_counters.append((('libraryhub_cache_hits_total', labels), counts['hits']))
+        cache_counters.append((('libraryhub_cache_misses_total', labels), counts['misses']))
+    return Response(metrics.render(cache_counters), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/events')
+@login_required
+def events_view():
+    """Strumień SSE zalogowanego: dostępność książek i terminy jego zwrotów (każdy strumień
+    zajmuje wątek serwera, więc anonimowi odwiedzający go nie otwierają)"""
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_event_id = None
+    user_id = current_user.id
+    loans = {}
+    try:
+        loans = dict(get_storage().active_loans(user_id))
+    except Exception:
+        report_error()
+    # Połączenie z bazą wraca do puli po zakończeniu widoku - strumień go nie trzyma
+    broker = get_event_broker()
+    subscription = broker.subscribe(user_id, last_event_id, app.config['EVENTS_MAX_CLIENTS'])
+    if subscription is None:
+        return Response('Too many event streams\n', status=503, mimetype='text/plain',
+                        headers={'Retry-After': str(app.config['EVENTS_RETRY_MS'] // 1000)})
+    # Po subskrypcji - każde późniejsze zdarzenie jest już w kolejce strumienia
+    last_id = broker.last_id if last_event_id is None else last_event_id
+    return Response(event_stream(subscription, loans, last_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/edit_user/<int:user_id>', methods=['GET', 'POST'])
 @login_required
 def edit_user(user_id):
@@ -547,8 +3913,7 @@ def edit_user(user_id):
         return redirect(url_for('catalog'))
 
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
+        storage = get_storage()
 
         if request.method == 'POST':
             username = request.form.get('username', '').strip()
@@ -558,45 +3923,32 @@ def edit_user(user_id):
             # Walidacja
             valid, error = validate_username(username)
             if not valid:
-                c.execute('SELECT id, username, is_admin FROM users WHERE id = ?', (user_id,))
-                user = c.fetchone()
-                conn.close()
-                return render_template('edit_user.html', user=user, error=error)
+                return render_template('edit_user.html', user=storage.get_user(user_id), error=error)
 
             if password:
                 valid, error = validate_password(password)
                 if not valid:
-                    c.execute('SELECT id, username, is_admin FROM users WHERE id = ?', (user_id,))
-                    user = c.fetchone()
-                    conn.close()
-                    return render_template('edit_user.html', user=user, error=error)
+                    return render_template('edit_user.html', user=storage.get_user(user_id), error=error)
 
             try:
-                if password:
-                    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-                    c.execute('UPDATE users SET username = ?, password = ?, is_admin = ? WHERE id = ?',
-                              (username, hashed.decode('utf-8'), is_admin, user_id))
-                else:
-                    c.execute('UPDATE users SET username = ?, is_admin = ? WHERE id = ?',
-                              (username, is_admin, user_id))
-                conn.commit()
-                conn.close()
+                hashed = get_password_hasher().hash(password) if password else None
+                storage.update_user(user_id, username, is_admin, hashed)
+                invalidate_cache('users', 'auth')
                 return redirect(url_for('manage_users'))
-            except sqlite3.IntegrityError:
-                c.execute('SELECT id, username, is_admin FROM users WHERE id = ?', (user_id,))
-                user = c.fetchone()
-                conn.close()
-                return render_template('edit_user.html', user=user, error='Nazwa użytkownika już istnieje')
-
-        c.execute('SELECT id, username, is_admin FROM users WHERE id = ?', (user_id,))
-        user = c.fetchone()
-        conn.close()
+            except DuplicateKeyError:
+                return render_template('edit_user.html', user=storage.get_user(user_id),
+                                       error='Nazwa użytkownika już istnieje')
+            except PasswordHasherBusy:
+                return render_template('edit_user.html', user=storage.get_user(user_id), error=BUSY_MESSAGE), 503
+
+        user = storage.get_user(user_id)
 
         if not user:
             return redirect(url_for('manage_users'))
         return render_template('edit_user.html', user=user)
 
     except Exception:
+        report_error()
         return redirect(url_for('manage_users'))
 
 @app.route('/delete_user/<int:user_id>')
@@ -606,20 +3958,11 @@ def delete_user(user_id):
         return redirect(url_for('manage_users'))
 
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-
-        # Sprawdź czy użytkownik ma aktywne wypożyczenia
-        c.execute('SELECT COUNT(*) FROM borrows WHERE user_id = ? AND returned = 0', (user_id,))
-        if c.fetchone()[0] > 0:
-            conn.close()
-            return redirect(url_for('manage_users'))
-
-        c.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        conn.commit()
-        conn.close()
+        # Użytkownika z aktywnymi wypożyczeniami nie usuwamy
+        if get_storage().delete_user(user_id):
+            invalidate_cache('users', 'auth')
     except Exception:
-        pass
+        report_error()
 
     return redirect(url_for('manage_users'))
 
@@ -630,21 +3973,10 @@ def manage_fines():
         return redirect(url_for('catalog'))
 
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-        c.execute('''
-            SELECT f.id, u.username, b.title, f.amount, f.calculated_date, f.paid, br.id, br.borrow_date
-            FROM fines f
-            JOIN users u ON f.user_id = u.id
-            JOIN borrows br ON f.borrow_id = br.id
-            JOIN books b ON br.book_id = b.id
-            WHERE f.paid = 0
-            ORDER BY f.calculated_date DESC
-        ''')
-        fines = c.fetchall()
-        conn.close()
+        fines = get_report_storage().unpaid_fines()
         return render_template('manage_fines.html', fines=fines)
     except Exception:
+        report_error()
         return render_template('manage_fines.html', fines=[])
 
 @app.route('/pay_fine/<int:borrow_id>')
@@ -654,35 +3986,34 @@ def pay_fine(borrow_id):
         return redirect(url_for('catalog'))
 
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-
-        # Oznacz karę jako zapłaconą
-        c.execute('UPDATE fines SET paid = 1 WHERE borrow_id = ?', (borrow_id,))
-
-        # Sprawdź czy wypożyczenie już nie zostało zwrócone
-        c.execute('SELECT returned FROM borrows WHERE id = ?', (borrow_id,))
-        borrow = c.fetchone()
-
-        if borrow and not borrow[0]:
-            # Zwróć książkę jeśli jeszcze nie została zwrócona
-            c.execute('SELECT book_id FROM borrows WHERE id = ?', (borrow_id,))
-            book_id = c.fetchone()[0]
-
-            c.execute('SELECT available FROM books WHERE id = ?', (book_id,))
-            available = c.fetchone()[0]
-
-            c.execute('UPDATE books SET available = ? WHERE id = ?', (available + 1, book_id))
-            c.execute('UPDATE borrows SET returned = 1, return_date = ? WHERE id = ?',
-                      (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), borrow_id))
-
-        conn.commit()
-        conn.close()
+        # Opłacenie kary zamyka też niezwrócone wypożyczenie
+        storage = get_storage()
+        closed = storage.pay_fine(borrow_id, actor_id=current_user.id)
+        invalidate_cache('catalog', 'users')
+        if closed:
+            publish_availability(storage, closed[1])
+            publish_loans(storage, closed[0])
     except Exception:
-        pass
+        report_error()
 
     return redirect(url_for('manage_fines'))
 
+def render_profile(user_id, viewed_user=None, message=None, error=None):
+    """Strona profilu - wypożyczenia i kary z Storage.profile (jedno zapytanie) oraz rezerwacje"""
+    before = decode_history_cursor(request.args.get('before'))
+    try:
+        storage = get_storage()
+        borrows, active_count, unpaid_total, next_cursor = storage.profile(user_id, before)
+        reservations = storage.user_reservations(user_id)
+    except Exception:
+        report_error()
+        borrows, active_count, unpaid_total, next_cursor = [], 0, 0, None
+        reservations = []
+    return render_template('profile.html', borrows=borrows, reservations=reservations, viewed_user=viewed_user,
+                           message=message, error=error, user_borrow_count=active_count,
+                           max_borrows=MAX_BORROWS_PER_USER, unpaid_fines_total=unpaid_total,
+                           next_cursor=next_cursor, is_first_page=before is None)
+
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
@@ -692,71 +4023,20 @@ def profile():
         # Walidacja
         valid, error = validate_password(new_password)
         if not valid:
-            borrows_with_days = get_user_borrows()
-            user_borrow_count = get_user_borrow_count(current_user.id)
-            unpaid_fines_total = get_user_unpaid_fines_total(current_user.id)
-            return render_template('profile.html', error=error, borrows=borrows_with_days,
-                                   message=None, viewed_user=None, user_borrow_count=user_borrow_count,
-                                   max_borrows=MAX_BORROWS_PER_USER, unpaid_fines_total=unpaid_fines_total)
+            return render_profile(current_user.id, error=error)
 
         try:
-            hashed = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-            conn = sqlite3.connect('database/library.db')
-            c = conn.cursor()
-            c.execute('UPDATE users SET password = ? WHERE id = ?', (hashed.decode('utf-8'), current_user.id))
-            conn.commit()
-            conn.close()
-
-            # Pobierz dane do wyświetlenia
-            borrows_with_days = get_user_borrows()
-            user_borrow_count = get_user_borrow_count(current_user.id)
-            unpaid_fines_total = get_user_unpaid_fines_total(current_user.id)
-            return render_template('profile.html', message='Hasło zmienione pomyślnie',
-                                   borrows=borrows_with_days, error=None, viewed_user=None,
-                                   user_borrow_count=user_borrow_count, max_borrows=MAX_BORROWS_PER_USER,
-                                   unpaid_fines_total=unpaid_fines_total)
+            hashed = get_password_hasher().hash(new_password)
+            get_storage().set_password(current_user.id, hashed)
+            invalidate_cache('auth')
+            return render_profile(current_user.id, message='Hasło zmienione pomyślnie')
+        except PasswordHasherBusy:
+            return render_profile(current_user.id, error=BUSY_MESSAGE), 503
         except Exception:
-            borrows_with_days = get_user_borrows()
-            user_borrow_count = get_user_borrow_count(current_user.id)
-            unpaid_fines_total = get_user_unpaid_fines_total(current_user.id)
-            return render_template('profile.html', error="Błąd zmiany hasła",
-                                   borrows=borrows_with_days, message=None, viewed_user=None,
-                                   user_borrow_count=user_borrow_count, max_borrows=MAX_BORROWS_PER_USER,
-                                   unpaid_fines_total=unpaid_fines_total)
-
-    # GET request
-    borrows_with_days = get_user_borrows()
-    user_borrow_count = get_user_borrow_count(current_user.id)
-    unpaid_fines_total = get_user_unpaid_fines_total(current_user.id)
-    return render_template('profile.html', borrows=borrows_with_days, message=None,
-                           error=None, viewed_user=None, user_borrow_count=user_borrow_count,
-                           max_borrows=MAX_BORROWS_PER_USER, unpaid_fines_total=unpaid_fines_total)
-
-def get_user_borrows():
-    """Pomocnicza funkcja do pobierania wypożyczeń użytkownika"""
-    try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-        c.execute('''
-            SELECT b.title, br.borrow_date, br.return_date, br.returned, br.fine_amount
-            FROM borrows br
-            JOIN books b ON br.book_id = b.id
-            WHERE br.user_id = ?
-            ORDER BY br.borrow_date DESC
-        ''', (current_user.id,))
-        borrows = c.fetchall()
-        conn.close()
+            report_error()
+            return render_profile(current_user.id, error="Błąd zmiany hasła")
 
-        # Oblicz dni pozostałe
-        borrows_with_days = []
-        for borrow in borrows:
-            days_left = calculate_days_left(borrow[2]) if not borrow[3] else None
-            fine = borrow[4] if borrow[4] else 0
-            borrows_with_days.append((borrow[0], borrow[1], borrow[2], borrow[3], days_left, fine))
-
-        return borrows_with_days
-    except Exception:
-        return []
+    return render_profile(current_user.id)
 
 @app.route('/view_user_profile/<int:user_id>')
 @login_required
@@ -766,48 +4046,14 @@ def view_user_profile(user_id):
         return redirect(url_for('catalog'))
 
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-
-        # Pobierz dane użytkownika
-        c.execute('SELECT id, username, is_admin FROM users WHERE id = ?', (user_id,))
-        user_data = c.fetchone()
-
-        if not user_data:
-            conn.close()
-            return redirect(url_for('manage_users'))
-
-        viewed_user = User(user_data[0], user_data[1], user_data[2])
-
-        # Pobierz wypożyczenia użytkownika
-        c.execute('''
-            SELECT b.title, br.borrow_date, br.return_date, br.returned, br.fine_amount
-            FROM borrows br
-            JOIN books b ON br.book_id = b.id
-            WHERE br.user_id = ?
-            ORDER BY br.borrow_date DESC
-        ''', (user_id,))
-        borrows = c.fetchall()
-        conn.close()
-
-        # Oblicz dni pozostałe
-        borrows_with_days = []
-        for borrow in borrows:
-            days_left = calculate_days_left(borrow[2]) if not borrow[3] else None
-            fine = borrow[4] if borrow[4] else 0
-            borrows_with_days.append((borrow[0], borrow[1], borrow[2], borrow[3], days_left, fine))
-
-        return render_template('profile.html',
-                               borrows=borrows_with_days,
-                               viewed_user=viewed_user,
-                               message=None,
-                               error=None,
-                               user_borrow_count=len([b for b in borrows_with_days if not b[3]]),
-                               max_borrows=MAX_BORROWS_PER_USER,
-                               unpaid_fines_total=get_user_unpaid_fines_total(user_id))
-
+        user_data = get_storage().get_user(user_id)
     except Exception:
+        report_error()
+        return redirect(url_for('manage_users'))
+
+    if not user_data:
         return redirect(url_for('manage_users'))
+    return render_profile(user_id, viewed_user=User(user_data[0], user_data[1], user_data[2]))
 
 @app.route('/admin_return_book/<int:user_id>/<book_title>')
 @login_required
@@ -817,47 +4063,15 @@ def admin_return_book(user_id, book_title):
         return redirect(url_for('catalog'))
 
     try:
-        conn = sqlite3.connect('database/library.db')
-        c = conn.cursor()
-
-        # Znajdź aktywne wypożyczenie
-        c.execute('''
-            SELECT br.id, br.return_date, br.book_id
-            FROM borrows br
-            JOIN books b ON br.book_id = b.id
-            WHERE br.user_id = ? AND b.title = ? AND br.returned = 0
-        ''', (user_id, book_title))
-
-        borrow = c.fetchone()
-
-        if borrow:
-            now = datetime.now()
-            now_str = now.strftime('%Y-%m-%d %H:%M:%S')
-
-            # Oblicz karę
-            fine = calculate_fine(now_str, borrow[1], True, now_str)
-
-            # Aktualizuj dostępność książki
-            c.execute('SELECT available FROM books WHERE id = ?', (borrow[2],))
-            book = c.fetchone()
-            if book:
-                c.execute('UPDATE books SET available = ? WHERE id = ?', (book[0] + 1, borrow[2]))
-
-            # Oznacz jako zwróconą
-            c.execute('UPDATE borrows SET returned = ?, return_date = ?, fine_amount = ? WHERE id = ?',
-                      (1, now_str, fine, borrow[0]))
-
-            # Dodaj karę jeśli istnieje
-            if fine > 0:
-                c.execute('INSERT INTO fines (borrow_id, user_id, amount, calculated_date, paid) VALUES (?, ?, ?, ?, ?)',
-                          (borrow[0], user_id, fine, now_str, 0))
-
-            conn.commit()
-
-        conn.close()
+        storage = get_storage()
+        book_id = storage.return_book_by_title(user_id, book_title, actor_id=current_user.id)
+        if book_id:
+            invalidate_cache('catalog', 'users')
+            publish_availability(storage, book_id)
+            publish_loans(storage, user_id)
 
     except Exception:
-        pass
+        report_error()
 
     return redirect(url_for('view_user_profile', user_id=user_id))
 
@@ -865,8 +4079,17 @@ def admin_return_book(user_id, book_title):
 @login_required
 def logout():
     logout_user()
+    session.pop('_user', None)
     return redirect(url_for('login'))
 
 if __name__ == '__main__':
+    check_vendor_assets()
     init_db()
-    app.run(debug=True)
\ No newline at end of file
+    if app.config['FINE_ACCRUAL_INTERVAL']:
+        start_fine_accrual_scheduler(app.config['FINE_ACCRUAL_INTERVAL'])
+    if app.config['HOLD_EXPIRY_INTERVAL']:
+        start_hold_expiry_scheduler(app.config['HOLD_EXPIRY_INTERVAL'])
+    if (not _using_postgres() and app.config['REPORTING_DB_MODE'] == 'snapshot'
+            and app.config['REPORTING_SNAPSHOT_INTERVAL']):
+        start_report_snapshot_refresher(app.config['REPORTING_SNAPSHOT_INTERVAL'])
+    app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""Porównanie planów zapytań i czasów przed i po migracji z indeksami.
+
+Użycie (z katalogu głównego projektu):
+    python benchmarks/bench_indexes.py --borrows 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as library  # noqa: E402
+
+SCHEMA_BEFORE = 1  # Schemat bez indeksów
+SCHEMA_AFTER = 2   # Migracja z indeksami
+
+# (nazwa, zapytanie, funkcja zwracająca parametry)
+QUERIES = [
+    ('aktywne wypożyczenia użytkownika',
+     'SELECT book_id FROM borrows WHERE user_id = ? AND returned = 0',
+     lambda a: (random.randint(1, a.users),)),
+    ('liczba aktywnych wypożyczeń',
+     'SELECT COUNT(*) FROM borrows WHERE user_id = ? AND returned = 0',
+     lambda a: (random.randint(1, a.users),)),
+    ('historia w profilu',
+     '''SELECT b.title, br.borrow_date, br.return_date, br.returned, br.fine_amount
+        FROM borrows br JOIN books b ON br.book_id = b.id
+        WHERE br.user_id = ? ORDER BY br.borrow_date DESC''',
+     lambda a: (random.randint(1, a.users),)),
+    ('suma nieopłaconych kar',
+     'SELECT SUM(amount) FROM fines WHERE user_id = ? AND paid = 0',
+     lambda a: (random.randint(1, a.users),)),
+    ('kara po borrow_id (pay_fine)',
+     'SELECT id FROM fines WHERE borrow_id = ?',
+     lambda a: (random.randint(1, a.borrows),)),
+    ('lista nieopłaconych kar',
+     'SELECT id, amount FROM fines WHERE paid = 0 ORDER BY calculated_date DESC LIMIT 50',
+     lambda a: ()),
+    ('czy książka jest wypożyczona',
+     'SELECT COUNT(*) FROM borrows WHERE book_id = ? AND returned = 0',
+     lambda a: (random.randint(1, a.books),)),
+]
+
+
+def populate(conn, args):
+    """Wypełnia bazę syntetycznymi danymi"""
+    rnd = random.Random(42)
+    c = conn.cursor()
+    now = datetime.now()
+    fmt = '%Y-%m-%d %H:%M:%S'
+    c.executemany('INSERT INTO users (id, username, password, is_admin) VALUES (?, ?, ?, 0)',
+                  ((i, 'user%d' % i, 'x') for i in range(1, args.users + 1)))
+    stamp = now.strftime(fmt)
+    c.executemany('INSERT INTO books (id, title, author, added_date, available, last_edited) VALUES (?, ?, ?, ?, ?, ?)',
+                  ((i, 'Tytuł %07d' % rnd.randint(0, 9999999), 'Autor %d' % (i % 5000), stamp, 3, stamp)
+                   for i in range(1, args.books + 1)))
+
+    def borrows():
+        for i in range(1, args.borrows + 1):
+            borrowed = now - timedelta(minutes=rnd.randint(0, 60 * 24 * 365 * 5))
+            returned = 0 if rnd.random() < args.active_ratio else 1
+            yield (i, rnd.randint(1, args.users), rnd.randint(1, args.books), borrowed.strftime(fmt),
+                   (borrowed + timedelta(days=30)).strftime(fmt), returned, 0)
+    c.executemany('INSERT INTO borrows (id, user_id, book_id, borrow_date, return_date, returned, fine_amount) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?)', borrows())
+
+    def fines():
+        for i in range(1, args.borrows + 1, 10):
+            yield (i, rnd.randint(1, args.users), round(rnd.random() * 20, 2),
+                   (now - timedelta(days=rnd.randint(0, 1000))).strftime(fmt), 1 if rnd.random() < 0.9 else 0)
+    c.executemany('INSERT INTO fines (borrow_id, user_id, amount, calculated_date, paid) VALUES (?, ?, ?, ?, ?)', fines())
+    conn.commit()
+
+
+def measure(conn, args):
+    """Zwraca {nazwa: (plan, średni czas w ms)}"""
+    results = {}
+    for name, sql, params in QUERIES:
+        plan = ' | '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params(args)))
+        random.seed(7)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            conn.execute(sql, params(args)).fetchall()
+        elapsed = (time.perf_counter() - start) * 1000 / args.repeat
+        results[name] = (plan, elapsed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--borrows', type=int, default=1000000)
+    parser.add_argument('--active-ratio', type=float, default=0.03)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    library.app.config['DATABASE'] = path
+    conn = library.connect_db()
+    conn.execute('PRAGMA journal_mode = WAL')
+    library.migrate_db(conn, target=SCHEMA_BEFORE)
+    start = time.perf_counter()
+    populate(conn, args)
+    print('Dane: %d wypożyczeń, %d użytkowników, %d książek (%.1f s)'
+          % (args.borrows, args.users, args.books, time.perf_counter() - start))
+
+    before = measure(conn, args)
+    start = time.perf_counter()
+    library.migrate_db(conn, target=SCHEMA_AFTER)
+    print('Migracja z indeksami: %.1f s' % (time.perf_counter() - start))
+    after = measure(conn, args)
+    conn.close()
+
+    for name, _, _ in QUERIES:
+        print('\n%s' % name)
+        print('  przed: %9.3f ms  %s' % (before[name][1], before[name][0]))
+        print('  po:    %9.3f ms  %s' % (after[name][1], after[name][0]))
+
+
+if __name__ == '__main__':
+    main()
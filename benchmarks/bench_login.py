@@ -0,0 +1,103 @@
+"""Przepustowość logowania w zależności od rozmiaru puli haszowania haseł.
+
+Dla każdego rozmiaru puli wiele wątków loguje się jednocześnie, a osobny wątek
+mierzy w tym czasie czas odpowiedzi katalogu - pokazuje, czy fala logowań
+blokuje pozostały ruch. Pula 0 oznacza bcrypt w wątku żądania (jak dawniej).
+
+Użycie (z katalogu głównego projektu):
+    python benchmarks/bench_login.py --workers 0,1,2,4 --threads 16 --rounds 12
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as library  # noqa: E402
+
+PASSWORD = 'bench123'
+
+
+def prepare(args):
+    library.app.config['DATABASE'] = os.path.join(tempfile.mkdtemp(), 'login.db')
+    library.app.config['BCRYPT_ROUNDS'] = args.rounds
+    library.init_db()
+    hashed = library._hash_password_worker(PASSWORD, args.rounds)
+    conn = sqlite3.connect(library.app.config['DATABASE'])
+    conn.executemany('INSERT INTO users (username, password, is_admin) VALUES (?, ?, 0)',
+                     [('bench%d' % i, hashed) for i in range(args.threads)])
+    conn.commit()
+    conn.close()
+
+
+def login_worker(index, args, deadline, counts):
+    client = library.app.test_client()
+    ok = busy = 0
+    while time.perf_counter() < deadline:
+        response = client.post('/login', data={'username': 'bench%d' % index, 'password': PASSWORD})
+        if response.status_code == 302:
+            ok += 1
+            client.get('/logout')
+        elif response.status_code == 503:
+            busy += 1
+    counts.append((ok, busy))
+
+
+def catalog_worker(deadline, latencies):
+    client = library.app.test_client()
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        client.get('/catalog')
+        latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(0.01)
+
+
+def run(workers, args):
+    library.app.config['PASSWORD_HASH_WORKERS'] = workers
+    library.app.config['PASSWORD_HASH_MAX_PENDING'] = args.max_pending
+    library._password_hasher = None
+    hasher = library.get_password_hasher()
+    # Rozgrzewka - start procesów puli nie wlicza się do pomiaru
+    for _ in range(max(workers, 1)):
+        hasher.check(PASSWORD, library._hash_password_worker(PASSWORD, 4))
+
+    deadline = time.perf_counter() + args.duration
+    counts, latencies = [], []
+    threads = [threading.Thread(target=login_worker, args=(i, args, deadline, counts)) for i in range(args.threads)]
+    threads.append(threading.Thread(target=catalog_worker, args=(deadline, latencies)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    hasher.shutdown()
+
+    ok = sum(c[0] for c in counts)
+    busy = sum(c[1] for c in counts)
+    p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else float('nan')
+    print('pula %2d: %6.1f logowań/s, odrzuconych (503): %5d, katalog p50 %6.1f ms, p95 %6.1f ms'
+          % (workers, ok / args.duration, busy, statistics.median(latencies), p95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', default='0,1,2,4', help='rozmiary puli oddzielone przecinkami')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--max-pending', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+
+    prepare(args)
+    print('bcrypt koszt %d, %d wątków logujących, %d procesorów'
+          % (args.rounds, args.threads, os.cpu_count() or 1))
+    for workers in (int(w) for w in args.workers.split(',')):
+        run(workers, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""Generator syntetycznych danych biblioteki w zadanej skali.
+
+Tworzy nową bazę z pełnym schematem (wszystkie migracje) i wypełnia ją
+książkami, użytkownikami, historią wypożyczeń i karami. Dane są
+powtarzalne dla danego --seed. Hasło wszystkich użytkowników to `bench123`
+(bcrypt o koszcie 4), administrator to `admin`.
+
+Użycie (z katalogu głównego projektu):
+    python benchmarks/generate_data.py --database database/bench.db \\
+        --books 1000000 --users 100000 --borrows 10000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import bcrypt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as library  # noqa: E402
+
+PASSWORD = 'bench123'
+DAY = library.DAY
+
+SYLLABLES = ('ka', 'ro', 'mi', 'la', 'wi', 'sz', 'ta', 'no', 'be', 'dro', 'ga', 'pe', 'lu', 'zi', 'mo',
+             'ra', 'ko', 'ny', 'ce', 'dy', 'fa', 'ję', 'ło', 'śn', 'ża', 'ćw', 'ki', 'so', 'we', 'tu')
+FIRST_NAMES = ('Adam', 'Anna', 'Jan', 'Maria', 'Piotr', 'Katarzyna', 'Tomasz', 'Agnieszka', 'Paweł',
+               'Magdalena', 'Michał', 'Joanna', 'Krzysztof', 'Ewa', 'Andrzej', 'Olga', 'Stanisław', 'Zofia')
+LAST_NAMES = ('Nowak', 'Kowalski', 'Wiśniewska', 'Wójcik', 'Kamiński', 'Lewandowska', 'Zieliński',
+              'Szymańska', 'Woźniak', 'Dąbrowski', 'Kozłowska', 'Jankowski', 'Mazur', 'Krawczyk',
+              'Piotrowski', 'Grabowska', 'Nowakowski', 'Pawłowska', 'Michalski', 'Król')
+
+
+def vocabulary(rnd, size):
+    """Słowa do tytułów (również źródło fraz wyszukiwania w run_benchmarks.py)"""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))).capitalize())
+    return sorted(words)
+
+
+def insert_books(c, rnd, args):
+    """Książki wstawiane bez wyzwalaczy FTS; indeks pełnotekstowy budowany jednym zapytaniem"""
+    words = vocabulary(random.Random(args.seed), args.vocabulary)
+    now = int(time.time())
+    copies = [0] * (args.books + 1)
+
+    def books():
+        for book_id in range(1, args.books + 1):
+            copies[book_id] = rnd.randint(1, 5)
+            added = now - rnd.randint(0, 10 * 365 * DAY)
+            title = ' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 4)))
+            author = '%s %s' % (rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES))
+            isbn = '978%09d' % book_id
+            yield (book_id, title, author, added, copies[book_id], added, isbn + library.isbn13_check_digit(isbn))
+
+    for trigger in ('books_fts_insert', 'books_fts_update', 'books_fts_delete'):
+        c.execute('DROP TRIGGER %s' % trigger)
+    c.executemany('INSERT INTO books (id, title, author, added_date, available, last_edited, isbn) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?)', books())
+    c.execute('INSERT INTO books_fts (rowid, title, author) SELECT id, %s, %s FROM books'
+              % (library.FTS_FOLD_SQL.format('title'), library.FTS_FOLD_SQL.format('author')))
+    library._create_books_fts_triggers(c)
+    return copies
+
+
+def insert_users(c, args):
+    hashed = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(4)).decode('utf-8')
+    c.execute('INSERT INTO users (id, username, password, is_admin) VALUES (1, ?, ?, 1)', ('admin', hashed))
+    c.executemany('INSERT INTO users (id, username, password, is_admin) VALUES (?, ?, ?, 0)',
+                  ((user_id, 'user%d' % user_id, hashed) for user_id in range(2, args.users + 2)))
+
+
+def insert_borrows(c, rnd, args, copies):
+    """Zwrócone wypożyczenia z ostatnich lat plus aktywne (maks. limit na użytkownika,
+    nigdy więcej niż liczba egzemplarzy); część zwrotów po terminie z karą"""
+    now = int(time.time())
+    loan = library.LOAN_DAYS * DAY
+    fines = []
+    active_per_user = {}
+    active_total = int(args.borrows * args.active_ratio)
+
+    def borrows():
+        for borrow_id in range(1, args.borrows - active_total + 1):
+            user_id = rnd.randint(2, args.users + 1)
+            book_id = rnd.randint(1, args.books)
+            borrowed = now - rnd.randint(40 * DAY, args.history_days * DAY)
+            if rnd.random() < args.late_ratio:
+                returned = borrowed + loan + rnd.randint(1, 60) * DAY
+                fine = library.calculate_fine(borrowed + loan, returned)
+                fines.append((borrow_id, user_id, fine, returned, 1 if rnd.random() < args.paid_ratio else 0))
+            else:
+                returned = borrowed + rnd.randint(1, library.LOAN_DAYS) * DAY
+                fine = 0
+            yield (borrow_id, user_id, book_id, borrowed, returned, 1, fine)
+
+        borrow_id = args.borrows - active_total
+        attempts = 0
+        while borrow_id < args.borrows and attempts < active_total * 10:
+            attempts += 1
+            user_id = rnd.randint(2, args.users + 1)
+            book_id = rnd.randint(1, args.books)
+            held = active_per_user.setdefault(user_id, set())
+            if len(held) >= library.MAX_BORROWS_PER_USER or book_id in held or not copies[book_id]:
+                continue
+            held.add(book_id)
+            copies[book_id] -= 1
+            borrow_id += 1
+            # Część aktywnych jest już po terminie - kary naliczy accrue_fines
+            borrowed = now - rnd.randint(0, 45) * DAY
+            yield (borrow_id, user_id, book_id, borrowed, borrowed + loan, 0, 0)
+
+    c.executemany('INSERT INTO borrows (id, user_id, book_id, borrow_date, return_date, returned, fine_amount) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?)', borrows())
+    c.executemany('INSERT INTO fines (borrow_id, user_id, amount, calculated_date, paid) VALUES (?, ?, ?, ?, ?)',
+                  fines)
+    c.executemany('UPDATE books SET available = ? WHERE id = ?',
+                  ((copies[book_id], book_id) for held in active_per_user.values() for book_id in held))
+    # Historia w dzienniku wypożyczeń, jak po migracji istniejącej bazy
+    library.backfill_circulation_events(c)
+    library.backfill_stock_events(c)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='database/bench.db')
+    parser.add_argument('--force', action='store_true', help='Nadpisz istniejący plik bazy')
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--borrows', type=int, default=1000000)
+    parser.add_argument('--active-ratio', type=float, default=0.01, help='Część wypożyczeń niezwróconych')
+    parser.add_argument('--late-ratio', type=float, default=0.05, help='Część zwrotów po terminie')
+    parser.add_argument('--paid-ratio', type=float, default=0.9, help='Część kar opłaconych')
+    parser.add_argument('--history-days', type=int, default=5 * 365)
+    parser.add_argument('--vocabulary', type=int, default=5000, help='Liczba różnych słów w tytułach')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if os.path.exists(args.database):
+        if not args.force:
+            parser.error('%s już istnieje (użyj --force, aby go nadpisać)' % args.database)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.database + suffix):
+                os.remove(args.database + suffix)
+
+    library.app.config['DATABASE'] = args.database
+    conn = library.connect_db()
+    conn.execute('PRAGMA journal_mode = WAL')
+    library.migrate_db(conn)
+    conn.execute('PRAGMA synchronous = OFF')
+    rnd = random.Random(args.seed)
+    c = conn.cursor()
+
+    for name, step in (('książki', lambda: insert_books(c, rnd, args)),
+                       ('użytkownicy', lambda: insert_users(c, args)),
+                       ('wypożyczenia i kary', lambda: insert_borrows(c, rnd, args, copies))):
+        start = time.perf_counter()
+        c.execute('BEGIN')
+        result = step()
+        conn.commit()
+        if name == 'książki':
+            copies = result
+        print('%-20s %.1f s' % (name, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    with library.app.app_context():
+        library.SQLiteStorage(conn).accrue_fines()
+    c.execute('BEGIN IMMEDIATE')
+    library.rebuild_popularity(c)
+    conn.commit()
+    c.execute('ANALYZE')
+    print('%-20s %.1f s' % ('kary, liczniki', time.perf_counter() - start))
+    conn.close()
+    print('Gotowe: %s' % args.database)
+
+
+if __name__ == '__main__':
+    main()
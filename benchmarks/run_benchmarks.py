@@ -0,0 +1,199 @@
+"""Pomiar przepustowości i opóźnień głównych stron na bazie z generate_data.py.
+
+Każdy scenariusz działa przez --duration sekund w --threads wątkach (klient
+testowy Flask, bez sieci). Wynik trafia do pliku JSON, który można porównać
+z wynikiem z innego commita przez --compare.
+
+Użycie (z katalogu głównego projektu):
+    python benchmarks/generate_data.py --database database/bench.db
+    python benchmarks/run_benchmarks.py --database database/bench.db --output wyniki.json
+    python benchmarks/run_benchmarks.py --database database/bench.db --compare wyniki.json
+
+Scenariusz borrow_return zapisuje do bazy (wypożycza i od razu zwraca).
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as library  # noqa: E402
+from generate_data import PASSWORD, vocabulary  # noqa: E402
+
+
+class Scenario:
+    """Scenariusz: step(klient, rnd, dane) wykonuje jedną iterację i zwraca listę odpowiedzi;
+    user='admin' loguje wątki jako administrator"""
+
+    def __init__(self, name, step, user='user'):
+        self.name = name
+        self.step = step
+        self.user = user
+
+
+def borrow_return(client, rnd, data):
+    book_id = rnd.choice(data['books'])
+    return [client.get('/borrow_book/%d' % book_id), client.get('/return_book/%d' % book_id)]
+
+
+def scenarios(args, data):
+    words = data['words']
+    return [
+        Scenario('catalog_search', lambda c, r, s: [c.get('/catalog', query_string={'search': r.choice(words)})]),
+        Scenario('catalog_page', lambda c, r, s: [c.get('/catalog')]),
+        Scenario('catalog_gzip', lambda c, r, s: [c.get('/catalog', headers={'Accept-Encoding': 'gzip'})]),
+        Scenario('api_books', lambda c, r, s: [c.get('/api/books', query_string={'limit': 100})]),
+        Scenario('borrow_return', borrow_return),
+        Scenario('profile', lambda c, r, s: [c.get('/profile')]),
+        Scenario('popular', lambda c, r, s: [c.get('/popular', query_string={'period': r.choice(('all', 'month', 'week'))})]),
+        Scenario('manage_fines', lambda c, r, s: [c.get('/manage_fines')], user='admin'),
+    ]
+
+
+def load_data(args):
+    conn = sqlite3.connect(args.database)
+    users = [row[0] for row in conn.execute(
+        '''SELECT username FROM users u WHERE is_admin = 0 AND NOT EXISTS
+           (SELECT 1 FROM borrows b WHERE b.user_id = u.id AND b.returned = 0)
+           ORDER BY id LIMIT ?''', (args.threads,))]
+    books = [row[0] for row in conn.execute('SELECT id FROM books WHERE available > 0 ORDER BY random() LIMIT 1000')]
+    sizes = {table: conn.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+             for table in ('books', 'users', 'borrows', 'fines')}
+    conn.close()
+    if len(users) < args.threads:
+        sys.exit('Za mało użytkowników bez aktywnych wypożyczeń dla %d wątków' % args.threads)
+    return {'users': users, 'books': books, 'sizes': sizes,
+            'words': vocabulary(random.Random(args.seed), args.vocabulary)}
+
+
+def run_scenario(scenario, args, data):
+    latencies, errors = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads + 1)
+
+    def worker(index):
+        rnd = random.Random(args.seed + index)
+        client = library.app.test_client()
+        username = 'admin' if scenario.user == 'admin' else data['users'][index]
+        client.post('/login', data={'username': username, 'password': PASSWORD})
+        local_latencies, local_errors = [], 0
+        barrier.wait()
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            responses = scenario.step(client, rnd, data)
+            for response in responses:
+                # Odpowiedzi strumieniowane liczą się dopiero po odczytaniu całej treści
+                response.get_data()
+                response.close()
+            local_latencies.append(time.perf_counter() - start)
+            local_errors += sum(1 for response in responses if response.status_code >= 400)
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    return {
+        'iterations': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'mean_ms': statistics.mean(latencies) * 1000 if latencies else None,
+        'p50_ms': percentile(0.50) if latencies else None,
+        'p95_ms': percentile(0.95) if latencies else None,
+        'p99_ms': percentile(0.99) if latencies else None,
+        'errors': sum(errors),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print('%-16s %10s %9s %9s %9s %7s' % ('scenariusz', 'iter/s', 'p50 ms', 'p95 ms', 'p99 ms', 'błędy'))
+    for name, result in results['scenarios'].items():
+        line = '%-16s %10.1f %9.2f %9.2f %9.2f %7d' % (
+            name, result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors'])
+        old = (baseline or {}).get('scenarios', {}).get(name)
+        if old and old['throughput']:
+            line += '   %+6.1f%% iter/s, p95 %+6.1f%%' % (
+                (result['throughput'] / old['throughput'] - 1) * 100,
+                (result['p95_ms'] / old['p95_ms'] - 1) * 100 if old['p95_ms'] else 0)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='database/bench.db')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5.0, help='Sekundy na scenariusz')
+    parser.add_argument('--only', help='Nazwy scenariuszy oddzielone przecinkami')
+    parser.add_argument('--no-cache', action='store_true', help='Wyłącz pamięć podręczną stron')
+    parser.add_argument('--output', help='Plik JSON z wynikami')
+    parser.add_argument('--compare', help='Plik JSON z wcześniejszymi wynikami do porównania')
+    parser.add_argument('--seed', type=int, default=42, help='Jak w generate_data.py')
+    parser.add_argument('--vocabulary', type=int, default=5000, help='Jak w generate_data.py')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        sys.exit('Brak bazy %s - uruchom najpierw generate_data.py' % args.database)
+    library.app.config.update(DATABASE=args.database, BCRYPT_ROUNDS=4, PASSWORD_HASH_WORKERS=0,
+                              PASSWORD_HASH_MAX_PENDING=max(args.threads, 8))
+    if args.no_cache:
+        # Pusty LRU usuwa każdy wpis zaraz po zapisaniu
+        library.app.config['CACHE_MAX_ENTRIES'] = 0
+    library.init_db()
+
+    data = load_data(args)
+    selected = set(args.only.split(',')) if args.only else None
+    results = {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'threads': args.threads,
+        'duration': args.duration,
+        'cache': not args.no_cache,
+        'dataset': data['sizes'],
+        'scenarios': {},
+    }
+    for scenario in scenarios(args, data):
+        if selected and scenario.name not in selected:
+            continue
+        results['scenarios'][scenario.name] = run_scenario(scenario, args, data)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print('Porównanie z %s (commit %s)' % (args.compare, baseline.get('commit')))
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print('Zapisano %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Test obciążeniowy: wiele wątków jednocześnie wypożycza i zwraca ten sam tytuł.
+
+Po zakończeniu sprawdza niezmienniki: dostępne egzemplarze nigdy nie spadają
+poniżej zera, dostępne + aktywne wypożyczenia = liczba egzemplarzy, żaden
+użytkownik nie ma tej samej książki dwa razy ani więcej niż limit.
+
+Użycie (z katalogu głównego projektu):
+    python benchmarks/stress_borrow.py --threads 32 --copies 3 --rounds 50
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import bcrypt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as library  # noqa: E402
+
+PASSWORD = 'stress123'
+
+
+def prepare(args):
+    """Baza z jedną książką o args.copies egzemplarzach i args.threads użytkownikami"""
+    library.app.config['DATABASE'] = os.path.join(tempfile.mkdtemp(), 'stress.db')
+    # Niski koszt bcrypt - testujemy transakcje, nie hashowanie (bez przeliczania przy logowaniu)
+    library.app.config['BCRYPT_ROUNDS'] = 4
+    library.init_db()
+    hashed = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(4)).decode('utf-8')
+    conn = sqlite3.connect(library.app.config['DATABASE'])
+    conn.executemany('INSERT INTO users (username, password, is_admin) VALUES (?, ?, 0)',
+                     [('stress%d' % i, hashed) for i in range(args.threads)])
+    conn.execute('UPDATE books SET available = ? WHERE id = 1', (args.copies,))
+    conn.commit()
+    conn.close()
+
+
+def worker(index, args, barrier, errors):
+    client = library.app.test_client()
+    client.post('/login', data={'username': 'stress%d' % index, 'password': PASSWORD})
+    barrier.wait()
+    for _ in range(args.rounds):
+        for path in ('/borrow_book/1', '/borrow_book/1', '/return_book/1'):
+            response = client.get(path)
+            if response.status_code != 302:
+                errors.append((index, path, response.status_code))
+
+
+def check(args):
+    conn = sqlite3.connect(library.app.config['DATABASE'])
+    available = conn.execute('SELECT available FROM books WHERE id = 1').fetchone()[0]
+    active = conn.execute('SELECT COUNT(*) FROM borrows WHERE book_id = 1 AND returned = 0').fetchone()[0]
+    duplicates = conn.execute('''SELECT COUNT(*) FROM (SELECT user_id FROM borrows WHERE returned = 0
+                                 GROUP BY user_id, book_id HAVING COUNT(*) > 1)''').fetchone()[0]
+    total = conn.execute('SELECT COUNT(*) FROM borrows WHERE book_id = 1').fetchone()[0]
+    conn.close()
+    print('Wypożyczeń łącznie: %d, aktywnych: %d, dostępnych: %d' % (total, active, available))
+    problems = []
+    if available < 0:
+        problems.append('ujemna liczba dostępnych egzemplarzy')
+    if available + active != args.copies:
+        problems.append('dostępne + aktywne (%d) != egzemplarze (%d)' % (available + active, args.copies))
+    if duplicates:
+        problems.append('%d użytkowników ma tę samą książkę dwa razy' % duplicates)
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--copies', type=int, default=3)
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    prepare(args)
+    barrier = threading.Barrier(args.threads)
+    errors = []
+    threads = [threading.Thread(target=worker, args=(i, args, barrier, errors)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    requests = args.threads * args.rounds * 3
+    print('%d żądań w %.2f s (%.0f żądań/s)' % (requests, elapsed, requests / elapsed))
+
+    problems = check(args) + ['błąd HTTP %s' % (error,) for error in errors[:10]]
+    for problem in problems:
+        print('BŁĄD: ' + problem)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
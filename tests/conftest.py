@@ -0,0 +1,149 @@
+"""Wspólne fixture testów: ten sam zestaw testów Storage dla SQLite i PostgreSQL.
+
+PostgreSQL jest używany, gdy dostępny jest psycopg2 oraz serwer: wskazany przez
+LIBRARYHUB_TEST_POSTGRES_DSN albo uruchomiony na czas testów z initdb/pg_ctl
+(z PATH lub `pg_config --bindir`). W przeciwnym razie testy PostgreSQL są pomijane.
+
+Użycie (z katalogu głównego projektu):
+    python -m pytest -q
+    LIBRARYHUB_TEST_POSTGRES_DSN='host=localhost user=postgres dbname=postgres' python -m pytest -q
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as library  # noqa: E402
+
+
+def postgres_bindir():
+    """Katalog z initdb i pg_ctl albo None"""
+    if shutil.which('initdb') and shutil.which('pg_ctl'):
+        return os.path.dirname(shutil.which('initdb'))
+    if shutil.which('pg_config'):
+        bindir = subprocess.run(['pg_config', '--bindir'], capture_output=True, text=True).stdout.strip()
+        if os.path.exists(os.path.join(bindir, 'initdb')):
+            return bindir
+    return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def postgres_server():
+    """DSN serwera, na którym testy mogą tworzyć i usuwać bazy"""
+    if library.psycopg2 is None:
+        pytest.skip('brak pakietu psycopg2')
+    dsn = os.environ.get('LIBRARYHUB_TEST_POSTGRES_DSN')
+    if dsn:
+        yield dsn
+        return
+    bindir = postgres_bindir()
+    if bindir is None:
+        pytest.skip('brak serwera PostgreSQL (initdb/pg_ctl) i LIBRARYHUB_TEST_POSTGRES_DSN')
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        pytest.skip('PostgreSQL nie działa z konta root - ustaw LIBRARYHUB_TEST_POSTGRES_DSN')
+
+    data = tempfile.mkdtemp(prefix='lhpg')
+    port = free_port()
+    pg_ctl = os.path.join(bindir, 'pg_ctl')
+    subprocess.run([os.path.join(bindir, 'initdb'), '-D', data, '-U', 'postgres', '-A', 'trust',
+                    '-E', 'UTF8', '--locale=C'], check=True, capture_output=True)
+    # Gniazdo w katalogu klastra, bez TCP i bez fsync - serwer żyje tylko na czas testów
+    subprocess.run([pg_ctl, '-D', data, '-w', '-l', os.path.join(data, 'server.log'), '-o',
+                    '-p %d -k %s -c listen_addresses= -c fsync=off' % (port, data), 'start'],
+                   check=True, capture_output=True)
+    try:
+        yield 'host=%s port=%d user=postgres dbname=postgres' % (data, port)
+    finally:
+        subprocess.run([pg_ctl, '-D', data, '-m', 'immediate', 'stop'], capture_output=True)
+        shutil.rmtree(data, ignore_errors=True)
+
+
+def _admin_execute(dsn, sql):
+    """CREATE/DROP DATABASE nie działają w transakcji"""
+    conn = library.psycopg2.connect(dsn)
+    try:
+        conn.autocommit = True
+        conn.cursor().execute(sql)
+    finally:
+        conn.close()
+
+
+def _close_pg_pools():
+    for pool in library._pg_pools.values():
+        pool._pool.closeall()
+    library._pg_pools.clear()
+
+
+@pytest.fixture(scope='session')
+def postgres_template(postgres_server):
+    """Baza ze schematem i danymi z init_db - każdy test dostaje jej kopię (CREATE DATABASE ... TEMPLATE)"""
+    name = 'libraryhub_template_%s' % uuid.uuid4().hex[:8]
+    _admin_execute(postgres_server, 'CREATE DATABASE %s' % name)
+    config = dict(library.app.config)
+    library.app.config.update(STORAGE_BACKEND='postgresql', POSTGRES_DSN='%s dbname=%s' % (postgres_server, name),
+                              BCRYPT_ROUNDS=4)
+    try:
+        library.init_db()
+    finally:
+        _close_pg_pools()
+        library.app.config.update(config)
+    yield name
+    _admin_execute(postgres_server, 'DROP DATABASE IF EXISTS %s' % name)
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def backend(request, tmp_path, monkeypatch):
+    """Konfiguracja aplikacji dla świeżej bazy z init_db (admin i pięć książek)"""
+    config = library.app.config
+    monkeypatch.setitem(config, 'BCRYPT_ROUNDS', 4)
+    monkeypatch.setitem(config, 'CIRCULATION_LOG_MODE', 'sync')
+    monkeypatch.setitem(config, 'CACHE_BACKEND', 'memory')
+    monkeypatch.setattr(library, '_cache', None)
+    monkeypatch.setattr(library, '_event_broker', None)
+    monkeypatch.setattr(library, '_daily_borrows_pruned', None)
+    if request.param == 'sqlite':
+        monkeypatch.setitem(config, 'STORAGE_BACKEND', 'sqlite')
+        monkeypatch.setitem(config, 'DATABASE', str(tmp_path / 'library.db'))
+        library.init_db()
+        yield request.param
+        return
+
+    server = request.getfixturevalue('postgres_server')
+    template = request.getfixturevalue('postgres_template')
+    name = 'libraryhub_test_%s' % uuid.uuid4().hex[:8]
+    _admin_execute(server, 'CREATE DATABASE %s TEMPLATE %s' % (name, template))
+    monkeypatch.setitem(config, 'STORAGE_BACKEND', 'postgresql')
+    monkeypatch.setitem(config, 'POSTGRES_DSN', '%s dbname=%s' % (server, name))
+    try:
+        yield request.param
+    finally:
+        _close_pg_pools()
+        _admin_execute(server, 'DROP DATABASE IF EXISTS %s' % name)
+
+
+@pytest.fixture
+def storage(backend):
+    with library.app.app_context(), library.open_storage() as storage:
+        yield storage
+
+
+@pytest.fixture
+def make_user(storage):
+    """make_user('jan') -> id nowego użytkownika"""
+    def make(username):
+        storage.add_user(username, 'x')
+        return storage.get_user_by_name(username)[0]
+    return make
@@ -0,0 +1,294 @@
+"""Testy tras przez klienta testowego Flask - na SQLite i PostgreSQL, jak test_storage.py.
+
+Trasy łapią wyjątki i pokazują stronę zastępczą (report_error), więc w testach
+report_error zgłasza wyjątek dalej - błąd SQL nie może zostać przeoczony.
+"""
+import io
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app as library
+
+
+@pytest.fixture
+def app_client(backend, monkeypatch):
+    monkeypatch.setitem(library.app.config, 'TESTING', True)
+    monkeypatch.setitem(library.app.config, 'PASSWORD_HASH_WORKERS', 0)
+    monkeypatch.setattr(library, '_password_hasher', None)
+
+    def reraise():
+        raise
+    monkeypatch.setattr(library, 'report_error', reraise)
+
+    def login(username, password='secret1', register=True):
+        client = library.app.test_client()
+        if register:
+            assert client.post('/register', data={'username': username, 'password': password}).status_code == 302
+        assert client.post('/login', data={'username': username, 'password': password}).status_code == 302
+        return client
+    return login
+
+
+def book_id(title):
+    with library.app.app_context(), library.open_storage() as storage:
+        return next(book[0] for book in storage.search_books(title) if book[1] == title)
+
+
+def user_id(username):
+    with library.app.app_context(), library.open_storage() as storage:
+        return storage.get_user_by_name(username)[0]
+
+
+def test_catalog_and_search(app_client):
+    client = app_client('jan')
+    page = client.get('/catalog').get_data(as_text=True)
+    assert 'Wiedźmin' in page and 'Solaris' in page
+    found = client.get('/catalog', query_string={'search': 'lem'}).get_data(as_text=True)
+    assert 'Solaris' in found and 'Wiedźmin' not in found
+
+
+def test_catalog_live_actions(app_client):
+    jan, ola, ewa = app_client('jan'), app_client('ola'), app_client('ewa')
+    solaris = book_id('Solaris')
+    jan.get('/borrow_book/%d' % solaris)
+    ola.get('/borrow_book/%d' % solaris)
+
+    # Przy zerze egzemplarzy wiersz ma ukryty przycisk wypożyczenia, który /events może pokazać
+    page = ewa.get('/catalog', query_string={'search': 'lem'}).get_data(as_text=True)
+    assert 'data-available-for="%d"' % solaris in page
+    assert 'data-unavailable-for="%d"' % solaris in page
+    assert 'EventSource' in page
+    anonymous = library.app.test_client()
+    assert 'EventSource' not in anonymous.get('/catalog').get_data(as_text=True)
+    assert anonymous.get('/events').status_code == 302
+
+
+def test_borrow_return_and_profile(app_client):
+    client = app_client('jan')
+    solaris = book_id('Solaris')
+
+    assert client.get('/borrow_book/%d' % solaris).status_code == 302
+    assert client.get('/api/v1/books/%d' % solaris).get_json()['available'] == 1
+    profile = client.get('/api/v1/profile').get_json()
+    assert profile['active'] == 1 and profile['borrows'][0]['title'] == 'Solaris'
+    assert 'Solaris' in client.get('/profile').get_data(as_text=True)
+
+    assert client.get('/return_book/%d' % solaris).status_code == 302
+    assert client.get('/api/v1/profile').get_json()['active'] == 0
+
+
+def test_register_reuses_cached_missing_id(app_client):
+    new_id = user_id('admin') + 1
+    with library.app.test_request_context():
+        assert library.load_user(str(new_id)) is None  # brak użytkownika trafia do pamięci 'auth'
+
+    client = app_client('jan')
+    assert user_id('jan') == new_id
+    assert client.get('/api/v1/profile').status_code == 200
+
+
+def test_api_borrow_conflicts(app_client):
+    jan, ola, ewa = app_client('jan'), app_client('ola'), app_client('ewa')
+    solaris = book_id('Solaris')
+
+    assert jan.post('/api/v1/books/%d/borrow' % solaris).status_code == 200
+    assert jan.post('/api/v1/books/%d/borrow' % solaris).status_code == 409
+    assert ola.post('/api/v1/books/%d/borrow' % solaris).get_json()['available'] == 0
+    assert ewa.post('/api/v1/books/%d/borrow' % solaris).status_code == 409
+    assert ewa.post('/api/v1/books/%d/return' % solaris).status_code == 409
+    assert jan.post('/api/v1/books/%d/return' % solaris).get_json()['available'] == 1
+
+
+def test_api_borrow_parallel(app_client):
+    # Jak benchmarks/stress_borrow.py: każdy użytkownik prosi dwa razy o każdą książkę naraz
+    copies = {book_id(title): count for title, count in
+              (('Wiedźmin', 5), ('Lalka', 3), ('Solaris', 2), ('Pan Tadeusz', 4), ('Quo Vadis', 3))}
+    users = ['czytelnik%d' % i for i in range(4)]
+    for username in users:
+        app_client(username)
+    # Osobny klient na żądanie - klient testowy nie jest bezpieczny wątkowo
+    requests = [(app_client(username, register=False), book)
+                for username in users for book in copies for _ in range(2)]
+    barrier = threading.Barrier(len(requests))
+
+    def borrow(request):
+        client, book = request
+        barrier.wait()
+        return client.post('/api/v1/books/%d/borrow' % book).status_code
+
+    with ThreadPoolExecutor(len(requests)) as executor:
+        statuses = list(executor.map(borrow, requests))
+    assert set(statuses) <= {200, 409}
+
+    with library.app.app_context(), library.open_storage() as storage:
+        c = storage.conn.cursor()
+        c.execute('SELECT id, available FROM books')
+        available = dict(c.fetchall())
+        c.execute('SELECT user_id, book_id FROM borrows WHERE returned = 0')
+        active = c.fetchall()
+    assert statuses.count(200) == len(active)
+    assert len(set(active)) == len(active)  # nikt nie ma tej samej książki dwa razy
+    for book, count in copies.items():
+        loans = sum(1 for _, borrowed in active if borrowed == book)
+        assert available[book] >= 0 and available[book] + loans == count
+    for username in users:
+        loans = sum(1 for borrower, _ in active if borrower == user_id(username))
+        assert loans <= library.MAX_BORROWS_PER_USER
+
+
+def test_events_reach_streams_of_other_workers(backend):
+    # Dwa brokery jak w dwóch workerach - wspólna jest tylko tabela live_events
+    worker_a, worker_b = library.DatabaseEventBroker(0.01), library.DatabaseEventBroker(0.01)
+    public, own = worker_b.subscribe(), worker_b.subscribe('2')
+    poller = worker_b._thread
+    try:
+        worker_a.publish('availability', {'book_id': 1, 'available': 0})
+        worker_a.publish('loans', {'loans': []}, user_id='3')
+        worker_a.publish('loans', {'loans': [[7, 100]]}, user_id='2')
+        first = public.get(timeout=5)
+        assert first[1:] == ('availability', {'book_id': 1, 'available': 0}, None)
+        assert own.get(timeout=5)[0] == first[0]
+        assert own.get(timeout=5)[1:] == ('loans', {'loans': [[7, 100]]}, '2')
+        with pytest.raises(queue.Empty):
+            public.get(timeout=0.1)
+
+        # Wznowienie z Last-Event-ID na innym workerze
+        resumed = worker_a.subscribe('2', last_event_id=first[0])
+        try:
+            assert resumed.get(timeout=5)[1] == 'loans'
+        finally:
+            worker_a.unsubscribe(resumed)
+    finally:
+        worker_b.unsubscribe(public)
+        worker_b.unsubscribe(own)
+        poller.join(5)
+
+
+def test_reservation_routes(app_client):
+    jan, ola, ewa = app_client('jan'), app_client('ola'), app_client('ewa')
+    solaris = book_id('Solaris')
+    jan.get('/borrow_book/%d' % solaris)
+    ola.get('/borrow_book/%d' % solaris)
+
+    ewa.get('/reserve_book/%d' % solaris)
+    jan.get('/return_book/%d' % solaris)
+    ola.get('/return_book/%d' % solaris)
+    # Pierwszy zwrot czeka na ewę, drugi jest wolny dla wszystkich
+    assert jan.get('/api/v1/books/%d' % solaris).get_json()['available'] == 1
+    ewa.get('/borrow_book/%d' % solaris)
+    assert ewa.get('/api/v1/profile').get_json()['active'] == 1
+
+
+def test_admin_pages_and_fines(app_client):
+    admin = app_client('admin', 'admin123', register=False)
+    jan = app_client('jan')
+    lalka = book_id('Lalka')
+    jan.get('/borrow_book/%d' % lalka)
+
+    for url in ('/manage_users', '/manage_fines', '/popular?period=week', '/cache_stats'):
+        assert admin.get(url).status_code == 200, url
+    assert 'Lalka' in admin.get('/popular').get_data(as_text=True)
+
+    borrow = jan.get('/api/v1/profile').get_json()['borrows'][0]['id']
+    with library.app.app_context(), library.open_storage() as storage:
+        c = storage.conn.cursor()
+        c.execute('UPDATE borrows SET return_date = return_date - 40 * %d WHERE id = %s'
+                  % (library.DAY, storage.param), (borrow,))
+        storage.conn.commit()
+        assert storage.accrue_fines() == 1
+
+    assert 'Lalka' in admin.get('/manage_fines').get_data(as_text=True)
+    assert admin.get('/pay_fine/%d' % borrow).status_code == 302
+    profile = jan.get('/api/v1/profile').get_json()
+    assert profile['active'] == 0 and profile['unpaid_fines'] == 0
+    assert admin.get('/view_user_profile/%d' % user_id('jan')).status_code == 200
+
+
+def test_metrics_access(app_client, monkeypatch):
+    # Klient testowy łączy się z 127.0.0.1, jak reverse proxy na tym samym hoście
+    anonymous = library.app.test_client()
+    assert anonymous.get('/metrics').status_code == 403
+    assert app_client('jan').get('/metrics').status_code == 403
+    assert app_client('admin', 'admin123', register=False).get('/metrics').status_code == 200
+
+    monkeypatch.setitem(library.app.config, 'METRICS_ALLOW_LOCALHOST', True)
+    assert anonymous.get('/metrics').status_code == 200
+    monkeypatch.setitem(library.app.config, 'METRICS_TOKEN', 'sekret')
+    assert anonymous.get('/metrics').status_code == 401
+    assert anonymous.get('/metrics', headers={'Authorization': 'Bearer sekret'}).status_code == 200
+
+
+def test_admin_return(app_client):
+    admin = app_client('admin', 'admin123', register=False)
+    jan = app_client('jan')
+    jan.get('/borrow_book/%d' % book_id('Lalka'))
+    jan_id = user_id('jan')
+
+    assert admin.get('/admin_return_book/%d/Lalka' % jan_id).status_code == 302
+    assert jan.get('/api/v1/profile').get_json()['active'] == 0
+
+
+def test_import_and_export_views(app_client):
+    admin = app_client('admin', 'admin123', register=False)
+    upload = io.BytesIO('title,author,available,isbn\nNowa,Jan Nowak,2,0-306-40615-2\n'.encode('utf-8'))
+    response = admin.post('/import_books', data={'file': (upload, 'ksiazki.csv')},
+                          content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert 'Nowa' in admin.get('/catalog', query_string={'search': 'nowak'}).get_data(as_text=True)
+
+    exported = admin.get('/export_books', query_string={'format': 'jsonl'}).get_data(as_text=True)
+    assert len(exported.splitlines()) == 6
+    assert '9780306406157' in exported
+
+
+def test_password_hasher_slot_held_until_job_finishes():
+    hasher = library.PasswordHasher(4, 0, 1, 0.05)
+    hasher._executor = ThreadPoolExecutor(1)  # zamiast puli procesów - zadanie czeka na zdarzenie
+    release = threading.Event()
+    try:
+        with pytest.raises(library.PasswordHasherBusy):
+            hasher._run(release.wait)
+        # Zadanie po przekroczeniu czasu wciąż trwa, więc miejsce jest zajęte
+        assert not hasher._slots.acquire(blocking=False)
+    finally:
+        release.set()
+        hasher.shutdown()
+    assert hasher._slots.acquire(blocking=False)
+
+
+def test_file_cache_sweeps_old_generations(tmp_path, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(library.time, 'time', lambda: now[0])
+    cache = library.Cache(library.FileCacheBackend(str(tmp_path), sweep_interval=30), default_ttl=60)
+
+    # Każda zmiana danych to nowa generacja 'catalog' i nowy plik strony
+    for i in range(50):
+        cache.invalidate('catalog')
+        assert cache.get_or_set('catalog', 'page', lambda: i) == i
+        now[0] += 10
+    # Zostają wpisy z ostatnich TTL + sweep_interval sekund i plik generacji
+    assert len(cache.backend) <= (60 + 30) // 10 + 1
+
+
+def test_missing_vendor_assets_fail_instead_of_cdn(tmp_path, monkeypatch):
+    monkeypatch.setattr(library.app, 'static_folder', str(tmp_path))
+    monkeypatch.setitem(library.app.config, 'VENDOR_ASSETS_FROM_CDN', False)
+    css = 'vendor/bootstrap/css/bootstrap.min.css'
+    with pytest.raises(RuntimeError, match='vendor-assets'):
+        library.check_vendor_assets()
+    with library.app.test_request_context():
+        assert library.asset_url(css).startswith('/static/')
+
+        for filename in library.VENDOR_ASSETS:
+            path = tmp_path.joinpath(*filename.split('/'))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b'/* */')
+        library.check_vendor_assets()
+        assert library.asset_url(css).startswith('/static/%s?v=' % css)
+
+        # CDN tylko na jawne życzenie
+        monkeypatch.setitem(library.app.config, 'VENDOR_ASSETS_FROM_CDN', True)
+        assert library.asset_url(css) == library.VENDOR_ASSETS[css]
@@ -0,0 +1,485 @@
+"""Testy warstwy Storage - każdy test działa na SQLite i na PostgreSQL (fixture backend).
+
+Baza startuje z danymi z init_db: administrator i pięć książek z ISBN
+(Wiedźmin 5 egz., Lalka 3, Solaris 2, Pan Tadeusz 4, Quo Vadis 3).
+"""
+import io
+import time
+
+import pytest
+
+import app as library
+
+DAY = library.DAY
+
+
+def execute(storage, sql, params=()):
+    """Bezpośrednia zmiana danych testowych (np. przesunięcie terminu zwrotu)"""
+    c = storage.conn.cursor()
+    c.execute(sql.replace('?', storage.param), params)
+    storage.conn.commit()
+
+
+def book_id(storage, title):
+    return next(book[0] for book in storage.search_books(title) if book[1] == title)
+
+
+def available(storage, book):
+    return storage.get_book(book)[4]
+
+
+def exported_rows(storage):
+    rows = storage.export_book_rows()
+    try:
+        return sorted(rows)
+    finally:
+        rows.close()
+
+
+def make_overdue(storage, user_id, book, days):
+    """Termin zwrotu aktywnego wypożyczenia minął days dni temu (także w zdarzeniu 'borrow'
+    dziennika); id wypożyczenia"""
+    due = int(time.time()) - days * DAY - 60
+    borrow = next(loan[0] for loan in storage.active_loans(user_id)
+                  if loan[0] in {b[6] for b in storage.profile(user_id)[0] if b[7] == book})
+    execute(storage, 'UPDATE borrows SET borrow_date = ?, return_date = ? WHERE id = ?',
+            (due - library.LOAN_DAYS * DAY, due, borrow))
+    execute(storage, "UPDATE circulation_events SET created_date = ?, due_date = ? WHERE borrow_id = ? AND event = 'borrow'",
+            (due - library.LOAN_DAYS * DAY, due, borrow))
+    return borrow
+
+
+# Wypożyczenia
+def test_borrow_and_return(storage, make_user):
+    user = make_user('jan')
+    solaris = book_id(storage, 'Solaris')
+
+    assert storage.borrow_book(user, solaris)
+    assert available(storage, solaris) == 1
+    assert storage.borrowed_book_ids(user) == [solaris]
+    assert len(storage.active_loans(user)) == 1
+
+    assert storage.return_book(user, solaris)
+    assert available(storage, solaris) == 2
+    assert storage.borrowed_book_ids(user) == []
+    assert not storage.return_book(user, solaris)
+
+
+def test_borrow_limit_and_last_copy(storage, make_user):
+    jan, ola, ewa = make_user('jan'), make_user('ola'), make_user('ewa')
+    titles = ['Wiedźmin', 'Lalka', 'Pan Tadeusz', 'Quo Vadis']
+    books = [book_id(storage, title) for title in titles]
+
+    for book in books[:library.MAX_BORROWS_PER_USER]:
+        assert storage.borrow_book(jan, book)
+    assert not storage.borrow_book(jan, books[library.MAX_BORROWS_PER_USER])
+    # Ta sama książka drugi raz
+    assert not storage.borrow_book(jan, books[0])
+
+    solaris = book_id(storage, 'Solaris')
+    assert storage.borrow_book(ola, solaris)
+    assert storage.borrow_book(ewa, solaris)
+    assert available(storage, solaris) == 0
+    assert not storage.borrow_book(jan, solaris)
+
+
+def test_delete_book_and_user_with_active_borrow(storage, make_user):
+    user = make_user('jan')
+    lalka = book_id(storage, 'Lalka')
+    storage.borrow_book(user, lalka)
+
+    assert not storage.delete_book(lalka)
+    assert not storage.delete_user(user)
+    storage.return_book(user, lalka)
+    assert storage.delete_book(lalka)
+    assert storage.delete_user(user)
+    assert storage.get_book(lalka) is None
+
+
+def test_duplicate_username(storage, make_user):
+    make_user('jan')
+    with pytest.raises(library.DuplicateKeyError):
+        storage.add_user('jan', 'x')
+
+
+# Katalog
+def test_search(storage):
+    assert [book[1] for book in storage.search_books('lem')] == ['Solaris']
+    assert [book[1] for book in storage.search_books('Stanisław')] == ['Solaris']
+    assert [book[1] for book in storage.search_books('sapk')] == ['Wiedźmin']
+    assert [book[1] for book in storage.search_books('978-83-240-0123-1')] == ['Lalka']
+    assert storage.search_books('nieistniejące') == []
+
+
+def test_search_follows_edits(storage):
+    lalka = book_id(storage, 'Lalka')
+    book = storage.get_book(lalka)
+    storage.update_book(lalka, 'Emancypantki', book[2], book[4], book[6])
+
+    assert storage.search_books('lalka') == []
+    assert [b[0] for b in storage.search_books('emancypantki')] == [lalka]
+
+
+def test_books_page(storage):
+    first = list(storage.books_page(None, 2))
+    assert [book[1] for book in first] == ['Lalka', 'Pan Tadeusz', 'Quo Vadis']
+    second = list(storage.books_page((first[1][1], first[1][0]), 2))
+    assert [book[1] for book in second] == ['Quo Vadis', 'Solaris', 'Wiedźmin']
+
+
+def test_isbn_taken(storage):
+    lalka = book_id(storage, 'Lalka')
+    assert storage.isbn_taken('9788324001231')
+    assert not storage.isbn_taken('9788324001231', exclude_id=lalka)
+    assert not storage.isbn_taken('9780306406157')
+
+
+# Profil
+def test_profile(storage, make_user):
+    user = make_user('jan')
+    for title in ('Lalka', 'Solaris', 'Quo Vadis'):
+        storage.borrow_book(user, book_id(storage, title))
+    storage.return_book(user, book_id(storage, 'Lalka'))
+
+    borrows, active_count, unpaid, cursor = storage.profile(user)
+    assert active_count == 2
+    assert unpaid == 0
+    assert cursor is None
+    assert sorted((b[0], b[3]) for b in borrows) == [('Lalka', 1), ('Quo Vadis', 0), ('Solaris', 0)]
+    # Aktywne mają pozostałe dni, zwrócone nie
+    assert all(b[4] == library.LOAN_DAYS for b in borrows if not b[3])
+
+
+def test_profile_history_pages(storage, make_user):
+    user = make_user('jan')
+    lalka = book_id(storage, 'Lalka')
+    for _ in range(3):
+        storage.borrow_book(user, lalka)
+        storage.return_book(user, lalka)
+
+    borrows, _, _, cursor = storage.profile(user, limit=2)
+    assert len(borrows) == 2 and cursor is not None
+    rest, _, _, cursor = storage.profile(user, before=library.decode_history_cursor(cursor), limit=2)
+    assert len(rest) == 1 and cursor is None
+    assert {b[6] for b in borrows}.isdisjoint(b[6] for b in rest)
+
+
+# Kary
+def test_late_return_creates_fine(storage, make_user):
+    user = make_user('jan')
+    lalka = book_id(storage, 'Lalka')
+    storage.borrow_book(user, lalka)
+    borrow = make_overdue(storage, user, lalka, 3)
+
+    assert storage.return_book(user, lalka)
+    fines = storage.unpaid_fines()
+    assert [(f[1], f[2], f[6]) for f in fines] == [('jan', 'Lalka', borrow)]
+    assert fines[0][3] == pytest.approx(3 * library.FINE_PER_DAY)
+    assert storage.profile(user)[2] == pytest.approx(3 * library.FINE_PER_DAY)
+
+    assert storage.pay_fine(borrow) is None
+    assert storage.unpaid_fines() == []
+
+
+def test_accrue_fines_and_payment(storage, make_user):
+    user = make_user('jan')
+    lalka, solaris = book_id(storage, 'Lalka'), book_id(storage, 'Solaris')
+    storage.borrow_book(user, lalka)
+    storage.borrow_book(user, solaris)
+    overdue = make_overdue(storage, user, lalka, 4)
+
+    assert storage.accrue_fines() == 1
+    fines = storage.unpaid_fines()
+    assert [f[6] for f in fines] == [overdue]
+    assert fines[0][3] == pytest.approx(4 * library.FINE_PER_DAY)
+    # Powtórny przebieg bez zmian kwot niczego nie zapisuje
+    assert storage.accrue_fines() == 0
+
+    # Opłacenie kary zamyka przeterminowane wypożyczenie i zwalnia egzemplarz
+    before = available(storage, lalka)
+    assert storage.pay_fine(overdue) == (user, lalka)
+    assert available(storage, lalka) == before + 1
+    assert storage.unpaid_fines() == []
+    assert storage.borrowed_book_ids(user) == [solaris]
+    assert storage.pay_fine(overdue) is None
+
+
+def test_accrue_fines_batches(storage, make_user):
+    users = [make_user('u%d' % i) for i in range(3)]
+    lalka = book_id(storage, 'Lalka')
+    for days, user in enumerate(users, 2):
+        storage.borrow_book(user, lalka)
+        make_overdue(storage, user, lalka, days)
+
+    assert storage.accrue_fines(batch_size=1) == 3
+    assert sorted(round(f[3] / library.FINE_PER_DAY) for f in storage.unpaid_fines()) == [2, 3, 4]
+
+
+# Import i eksport
+CSV_BOOKS = '''title,author,available,isbn
+Nowa książka,Jan Nowak,2,0-306-40615-2
+Lalka,Bolesław Prus,6,978-83-240-0123-1
+Bez numeru,Anna Kowalska,1,
+Zły wiersz,,1,
+'''
+
+
+def test_import_books(storage):
+    rejected = []
+    imported, rejected_count = library.import_books(storage, io.StringIO(CSV_BOOKS), 'csv',
+                                                    on_reject=lambda line, error: rejected.append(line))
+    assert (imported, rejected_count, rejected) == (3, 1, [5])
+    assert storage.book_count() == 7
+
+    new = storage.search_books('9780306406157')
+    assert [(b[1], b[4]) for b in new] == [('Nowa książka', 2)]
+    assert available(storage, book_id(storage, 'Lalka')) == 6
+    assert [b[1] for b in storage.search_books('kowalska')] == ['Bez numeru']
+
+
+def test_import_keeps_borrowed_copies(storage, make_user):
+    user = make_user('jan')
+    lalka = book_id(storage, 'Lalka')
+    storage.borrow_book(user, lalka)
+
+    library.import_books(storage, io.StringIO(CSV_BOOKS), 'csv')
+    # 6 posiadanych egzemplarzy, jeden wypożyczony
+    assert available(storage, lalka) == 5
+
+
+@pytest.mark.parametrize('fmt', library.BOOK_FILE_FORMATS)
+def test_export_reimport_round_trip(storage, make_user, fmt):
+    library.import_books(storage, io.StringIO(CSV_BOOKS), 'csv')
+    user = make_user('jan')
+    storage.borrow_book(user, book_id(storage, 'Bez numeru'))
+    exported = ''.join(library.export_books(storage.export_book_rows(), fmt))
+    before = exported_rows(storage)
+
+    imported, rejected = library.import_books(storage, io.StringIO(exported), fmt)
+    assert (imported, rejected) == (7, 0)
+    # Ponowny import eksportu (także książek bez ISBN) nie tworzy duplikatów
+    assert storage.book_count() == 7
+    assert exported_rows(storage) == before
+
+
+def test_export_reimport_keeps_ready_holds(storage, make_user):
+    user = make_user('jan')
+    wiedzmin = book_id(storage, 'Wiedźmin')
+    storage.reserve_book(user, wiedzmin)
+    # Jeden z 5 egzemplarzy odłożony dla jana, 4 wolne
+    execute(storage, "UPDATE reservations SET status = 'ready', expires_date = ? WHERE user_id = ?",
+            (int(time.time()) + DAY, user))
+    execute(storage, 'UPDATE books SET available = 4 WHERE id = ?', (wiedzmin,))
+
+    for _ in range(3):
+        exported = ''.join(library.export_books(storage.export_book_rows(), 'csv'))
+        library.import_books(storage, io.StringIO(exported), 'csv')
+        assert available(storage, wiedzmin) == 4
+    assert storage.user_reservations(user)[0][3] == 'ready'
+
+
+# Rezerwacje
+def test_reservation_queue(storage, make_user):
+    jan, ola, ewa = make_user('jan'), make_user('ola'), make_user('ewa')
+    solaris = book_id(storage, 'Solaris')
+    storage.borrow_book(jan, solaris)
+    storage.borrow_book(ola, solaris)
+
+    assert storage.reserve_book(ewa, solaris) == 'waiting'
+    assert storage.reserve_book(ewa, solaris) is None
+    assert storage.reserve_book(jan, solaris) is None
+    assert [(r[1], r[3], r[4]) for r in storage.user_reservations(ewa)] == [(solaris, 'waiting', 1)]
+
+    # Zwrócony egzemplarz czeka na pierwszą osobę z kolejki
+    storage.return_book(jan, solaris)
+    assert available(storage, solaris) == 0
+    reservation = storage.user_reservations(ewa)[0]
+    assert reservation[3] == 'ready' and reservation[5] > time.time()
+    assert not storage.borrow_book(jan, solaris)
+    assert storage.borrow_book(ewa, solaris)
+    assert storage.user_reservations(ewa) == []
+
+
+
+def test_reservation_queue_positions(storage, make_user):
+    jan, ola, ewa, adam, iga, tom = (make_user(name) for name in ('jan', 'ola', 'ewa', 'adam', 'iga', 'tom'))
+    solaris = book_id(storage, 'Solaris')
+    storage.borrow_book(jan, solaris)
+    storage.borrow_book(ola, solaris)
+    for user in (ewa, adam, iga, tom):
+        storage.reserve_book(user, solaris)
+
+    def positions():
+        return [storage.user_reservations(user)[0][4] for user in (ewa, iga, tom)]
+
+    # Rezygnacja ze środka kolejki przesuwa osoby za nią
+    storage.cancel_reservation(adam, storage.user_reservations(adam)[0][0])
+    assert positions() == [1, 2, 3]
+    # Początek kolejki dostaje egzemplarz, nowa osoba staje na końcu
+    storage.return_book(jan, solaris)
+    assert positions() == [None, 1, 2]
+    storage.reserve_book(adam, solaris)
+    assert storage.user_reservations(adam)[0][4] == 3
+
+def test_cancel_ready_reservation_passes_copy_on(storage, make_user):
+    jan, ola, ewa, adam = (make_user(name) for name in ('jan', 'ola', 'ewa', 'adam'))
+    solaris = book_id(storage, 'Solaris')
+    storage.borrow_book(jan, solaris)
+    storage.borrow_book(ola, solaris)
+    storage.reserve_book(ewa, solaris)
+    storage.reserve_book(adam, solaris)
+    storage.return_book(jan, solaris)
+
+    ready = storage.user_reservations(ewa)[0]
+    assert storage.cancel_reservation(ewa, ready[0]) == solaris
+    assert storage.user_reservations(adam)[0][3] == 'ready'
+    assert storage.cancel_reservation(ewa, ready[0]) is None
+
+
+def test_expire_holds(storage, make_user):
+    jan, ola, ewa, adam = (make_user(name) for name in ('jan', 'ola', 'ewa', 'adam'))
+    solaris = book_id(storage, 'Solaris')
+    storage.borrow_book(jan, solaris)
+    storage.borrow_book(ola, solaris)
+    storage.reserve_book(ewa, solaris)
+    storage.reserve_book(adam, solaris)
+    storage.return_book(jan, solaris)
+    execute(storage, "UPDATE reservations SET expires_date = ? WHERE status = 'ready'", (int(time.time()) - 1,))
+
+    assert storage.expire_holds() == 1
+    assert storage.user_reservations(ewa) == []
+    assert storage.user_reservations(adam)[0][3] == 'ready'
+
+
+def test_import_adding_copies_allocates_holds(storage, make_user):
+    jan, ola, ewa = make_user('jan'), make_user('ola'), make_user('ewa')
+    solaris = book_id(storage, 'Solaris')
+    storage.borrow_book(jan, solaris)
+    storage.borrow_book(ola, solaris)
+    storage.reserve_book(ewa, solaris)
+    storage.add_book('Bez numeru', 'Anna Kowalska', 0, None)
+    untagged = book_id(storage, 'Bez numeru')
+    storage.reserve_book(jan, untagged)
+
+    library.import_books(storage, io.StringIO('title,author,available,isbn\n'
+                                              'Solaris,Stanisław Lem,4,978-83-7392-845-9\n'
+                                              'Bez numeru,Anna Kowalska,1,\n'), 'csv')
+    # Dwa nowe egzemplarze: jeden odłożony dla ewy od razu, drugi wolny
+    assert storage.user_reservations(ewa)[0][3] == 'ready'
+    assert available(storage, solaris) == 1
+    assert storage.user_reservations(jan)[0][3] == 'ready'
+    assert available(storage, untagged) == 0
+
+
+def test_reservation_limit(storage, make_user):
+    user = make_user('jan')
+    other = make_user('ola')
+    execute(storage, 'UPDATE books SET available = 0')
+    for i in range(library.MAX_RESERVATIONS_PER_USER + 1):
+        storage.add_book('Tom %d' % i, 'Autor', 0, None)
+    books = [book_id(storage, 'Tom %d' % i) for i in range(library.MAX_RESERVATIONS_PER_USER + 1)]
+
+    for book in books[:-1]:
+        assert storage.reserve_book(user, book) == 'waiting'
+    assert storage.reserve_book(user, books[-1]) is None
+    assert storage.reserve_book(other, books[-1]) == 'waiting'
+
+
+# Popularność
+def test_popular_books(storage, make_user):
+    users = [make_user('u%d' % i) for i in range(3)]
+    lalka, solaris = book_id(storage, 'Lalka'), book_id(storage, 'Solaris')
+    for user in users:
+        storage.borrow_book(user, lalka)
+        storage.return_book(user, lalka)
+    storage.borrow_book(users[0], solaris)
+
+    for days in (None, 7, 30):
+        ranking = [(b[0], b[3]) for b in storage.popular_books(days)][:2]
+        assert ranking == [(lalka, 3), (solaris, 1)], days
+
+    storage.rebuild_popularity()
+    assert [(b[0], b[3]) for b in storage.popular_books(7)][:2] == [(lalka, 3), (solaris, 1)]
+
+
+def test_daily_counters_outside_window_are_pruned(storage, make_user):
+    user = make_user('jan')
+    lalka = book_id(storage, 'Lalka')
+    execute(storage, 'INSERT INTO book_daily_borrows (day, book_id, borrows) VALUES (?, ?, 5)',
+            ('2000-01-01', lalka))
+
+    storage.borrow_book(user, lalka)
+    c = storage.conn.cursor()
+    c.execute('SELECT COUNT(*) FROM book_daily_borrows WHERE day < %s' % storage.param, ('2001-01-01',))
+    assert c.fetchone()[0] == 0
+
+
+# Dziennik wypożyczeń
+def test_circulation_replay_matches_tables(storage, make_user):
+    jan, ola = make_user('jan'), make_user('ola')
+    lalka, solaris = book_id(storage, 'Lalka'), book_id(storage, 'Solaris')
+    storage.borrow_book(jan, lalka)
+    storage.borrow_book(jan, solaris)
+    storage.borrow_book(ola, lalka)
+    make_overdue(storage, jan, lalka, 2)
+    storage.return_book(jan, lalka)
+    overdue = make_overdue(storage, jan, solaris, 5)
+    storage.accrue_fines()
+    storage.pay_fine(overdue)
+    storage.return_book_by_title(ola, 'Lalka', actor_id=1)
+    c = storage.conn.cursor()
+    c.execute("SELECT event, actor_id FROM circulation_events WHERE user_id = %s ORDER BY id DESC LIMIT 1"
+              % storage.param, (ola,))
+    assert c.fetchone() == ('return', 1)
+
+    result = library.app.test_cli_runner().invoke(args=['replay-circulation'])
+    assert result.exit_code == 0, result.output
+    assert 'wypożyczenia 0, kary 0' in result.output
+
+
+
+def test_circulation_replay_checks_copies(storage, make_user):
+    jan, ola = make_user('jan'), make_user('ola')
+    solaris, lalka = book_id(storage, 'Solaris'), book_id(storage, 'Lalka')
+    storage.borrow_book(jan, solaris)
+    storage.borrow_book(ola, solaris)
+    storage.reserve_book(make_user('ewa'), solaris)
+    # Zmiany administratora: dodatkowy egzemplarz (od razu odłożony dla rezerwacji), import, usunięcie
+    book = storage.get_book(solaris)
+    storage.update_book(solaris, book[1], book[2], 1, book[6], actor_id=1)
+    library.import_books(storage, io.StringIO('title,author,available,isbn\n'
+                                              'Nowa,Anna Nowak,2,\n'), 'csv', actor_id=1)
+    storage.delete_book(lalka, actor_id=1)
+    c = storage.conn.cursor()
+    c.execute("SELECT book_id, amount, actor_id FROM circulation_events WHERE event = 'adjust' AND actor_id = 1 "
+              "ORDER BY id")
+    assert c.fetchall() == [(solaris, 1, 1), (book_id(storage, 'Nowa'), 2, 1), (lalka, -3, 1)]
+
+    runner = library.app.test_cli_runner()
+    result = runner.invoke(args=['replay-circulation'])
+    assert result.exit_code == 0, result.output
+    assert 'egzemplarze 0' in result.output
+
+    # Zmiana poza aplikacją jest wykrywana i cofana z --apply
+    execute(storage, 'UPDATE books SET available = 7 WHERE id = ?', (solaris,))
+    result = runner.invoke(args=['replay-circulation'])
+    assert result.exit_code == 1 and 'egzemplarze 1' in result.output
+    assert runner.invoke(args=['replay-circulation', '--apply']).exit_code == 0
+    assert available(storage, solaris) == 0
+
+def test_failed_flush_keeps_queue_within_limit(monkeypatch):
+    log = library.CirculationLog(3600, 100, 5)
+    monkeypatch.setattr(log, '_thread', object())  # bez wątku w tle - flush wołany ręcznie
+    log.enqueue([(i, 'borrow') for i in range(5)])
+
+    def failing_storage():
+        log.enqueue([(i, 'borrow') for i in range(100, 103)])  # nowe zdarzenia w trakcie zapisu
+        raise RuntimeError('baza niedostępna')
+    monkeypatch.setattr(library, 'open_storage', failing_storage)
+    monkeypatch.setattr(library, 'metrics', library.Metrics())
+
+    assert log.flush() == 0
+    # Zostają najnowsze zdarzenia, najstarsze z nieudanej partii giną i są liczone
+    assert [event[0] for event in log._pending] == [3, 4, 100, 101, 102]
+    assert library.metrics._counters[('libraryhub_circulation_events_dropped_total', ())] == 3
+    log._pending.clear()  # atexit nie może zapisać zdarzeń testowych